@@ -0,0 +1,305 @@
+#!/usr/bin/env python3
+"""
+Benchmark do broker e do proxy com diferentes configurações de runtime.
+
+Cada cenário sobe o broker.py ou o proxy.py como subprocesso, com as
+variáveis de ambiente do cenário (threads de I/O, HWM, buffers do kernel,
+fragmentos, árvore de proxies), gera carga com processos locais e mede a
+vazão.
+
+  python benchmark.py                     # todos os cenários
+  python benchmark.py proxy --duration 10
+  python benchmark.py broker --set BROKER_IO_THREADS=4 --set BROKER_SNDHWM=100000
+
+Broker: clientes DEALER mantêm 'window' requisições pendentes cada e
+workers REP respondem com eco (modo proxy do broker; o modo smart depende
+do reference server). Proxy: publicadores PUB enviam o mais rápido que
+conseguem e inscritos SUB contam o que recebem; a diferença entre
+publicado e entregue é o que os HWMs descartaram.
+"""
+
+import argparse
+import multiprocessing
+import os
+import subprocess
+import sys
+import time
+
+import msgpack
+import zmq
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+HOST = '127.0.0.1'
+
+BROKER_FRONTEND = 25555
+BROKER_BACKEND = 25556
+PROXY_XSUB = 25557
+PROXY_XPUB = 25558
+SHARD_STEP = 10
+EDGE_XPUB = 25658  # bordas da árvore: 25658, 25668, ...
+
+BROKER_SCENARIOS = [
+    ('padrão', {}),
+    ('2 threads de I/O', {'BROKER_IO_THREADS': '2'}),
+    ('4 threads de I/O', {'BROKER_IO_THREADS': '4'}),
+    ('HWM 100k', {'BROKER_SNDHWM': '100000', 'BROKER_RCVHWM': '100000'}),
+    ('buffers 4 MB', {'BROKER_SNDBUF': '4194304', 'BROKER_RCVBUF': '4194304'}),
+    ('4 threads + HWM + buffers', {'BROKER_IO_THREADS': '4', 'BROKER_SNDHWM': '100000',
+                                   'BROKER_RCVHWM': '100000', 'BROKER_SNDBUF': '4194304',
+                                   'BROKER_RCVBUF': '4194304'}),
+]
+
+PROXY_SCENARIOS = [
+    ('padrão', {}),
+    ('2 threads de I/O', {'PROXY_IO_THREADS': '2'}),
+    ('4 threads de I/O', {'PROXY_IO_THREADS': '4'}),
+    ('HWM 100k', {'PROXY_SNDHWM': '100000', 'PROXY_RCVHWM': '100000'}),
+    ('buffers 4 MB', {'PROXY_SNDBUF': '4194304', 'PROXY_RCVBUF': '4194304'}),
+    ('2 fragmentos', {'PROXY_SHARDS': '2'}),
+    ('4 fragmentos', {'PROXY_SHARDS': '4'}),
+    ('4 fragmentos + 4 threads', {'PROXY_SHARDS': '4', 'PROXY_IO_THREADS': '4'}),
+    ('cache 20/tópico', {'PROXY_CACHE': '20'}),
+    # Árvore: raiz + N proxies de borda (PROXY_UPSTREAM), inscritos divididos entre as bordas
+    ('árvore: raiz + 2 bordas', {}, 2),
+    ('árvore: raiz + 4 bordas', {}, 4),
+]
+
+
+def port_addresses(port, shards):
+    return [f"tcp://{HOST}:{port + shard * SHARD_STEP}" for shard in range(shards)]
+
+
+def start(component, env, wait=1.0):
+    """Sobe broker/broker.py ou proxy/proxy.py com o ambiente do cenário"""
+    script = os.path.join(ROOT, component, f"{component}.py")
+    process = subprocess.Popen([sys.executable, script], cwd=os.path.dirname(script),
+                               env={**os.environ, **env},
+                               stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    time.sleep(wait)
+    if process.poll() is not None:
+        raise RuntimeError(f"{component} não iniciou: {process.stderr.read().decode(errors='replace')}")
+    return process
+
+
+def stop(process):
+    process.terminate()
+    try:
+        process.wait(timeout=5)
+    except subprocess.TimeoutExpired:
+        process.kill()
+
+
+# ========== BROKER ==========
+
+def echo_worker(address, stop_at):
+    context = zmq.Context()
+    socket = context.socket(zmq.REP)
+    socket.setsockopt(zmq.RCVTIMEO, 500)
+    socket.connect(address)
+    while time.time() < stop_at:
+        try:
+            socket.send(socket.recv())
+        except zmq.Again:
+            pass
+    socket.close(linger=0)
+    context.term()
+
+
+def request_client(address, start_at, stop_at, window, size, results):
+    context = zmq.Context()
+    socket = context.socket(zmq.DEALER)
+    socket.connect(address)
+    payload = msgpack.packb({'service': 'echo', 'data': {'padding': 'x' * size}})
+
+    for _ in range(window):
+        socket.send_multipart([b'', payload])
+    replies = 0
+    poller = zmq.Poller()
+    poller.register(socket, zmq.POLLIN)
+    while time.time() < stop_at:
+        if not poller.poll(100):
+            continue
+        while socket.getsockopt(zmq.EVENTS) & zmq.POLLIN:
+            socket.recv_multipart()
+            if time.time() >= start_at:
+                replies += 1
+            socket.send_multipart([b'', payload])
+    results.put(replies)
+    socket.close(linger=0)
+    context.term()
+
+
+def bench_broker(env, args):
+    env = {
+        'BROKER_MODE': 'proxy',
+        'BROKER_FRONTEND_BIND': f"tcp://{HOST}:{BROKER_FRONTEND}",
+        'BROKER_BACKEND_BIND': f"tcp://{HOST}:{BROKER_BACKEND}",
+        **env
+    }
+    broker = start('broker', env)
+    try:
+        start_at = time.time() + 1.0  # aquecimento: conexões e janelas cheias
+        stop_at = start_at + args.duration
+        results = multiprocessing.Queue()
+        processes = [multiprocessing.Process(target=echo_worker, args=(f"tcp://{HOST}:{BROKER_BACKEND}", stop_at + 1))
+                     for _ in range(args.workers)]
+        processes += [multiprocessing.Process(target=request_client, args=(
+            f"tcp://{HOST}:{BROKER_FRONTEND}", start_at, stop_at, args.window, args.size, results))
+            for _ in range(args.clients)]
+        for process in processes:
+            process.start()
+        replies = sum(results.get() for _ in range(args.clients))
+        for process in processes:
+            process.join()
+        return {'req/s': replies / args.duration}
+    finally:
+        stop(broker)
+
+
+# ========== PROXY ==========
+
+def publisher(addresses, start_at, stop_at, topics, size, batch, results):
+    context = zmq.Context()
+    socket = context.socket(zmq.PUB)
+    for address in addresses:
+        socket.connect(address)
+    topic_names = [f"canal{i}".encode() for i in range(topics)]
+    payload = msgpack.packb({'message': 'x' * size})
+    if batch > 1:
+        # Como os servidores com PUBLISH_BATCH_WINDOW_MS: um quadro com 'batch' publicações
+        payload = msgpack.packb({'batch': [{'message': 'x' * size}] * batch})
+    time.sleep(max(0.0, start_at - time.time()))  # inscrições propagadas até o PUB
+
+    sent = 0
+    while time.time() < stop_at:
+        for _ in range(1000):
+            socket.send_multipart([topic_names[sent % topics], payload])
+            sent += 1
+    results.put(('sent', sent * batch))
+    socket.close(linger=0)
+    context.term()
+
+
+def subscriber(address, stop_at, batch, results):
+    context = zmq.Context()
+    socket = context.socket(zmq.SUB)
+    socket.setsockopt(zmq.SUBSCRIBE, b'')
+    socket.setsockopt(zmq.RCVHWM, 0)
+    socket.connect(address)
+    poller = zmq.Poller()
+    poller.register(socket, zmq.POLLIN)
+
+    received = 0
+    while time.time() < stop_at:
+        if not poller.poll(100):
+            continue
+        while socket.getsockopt(zmq.EVENTS) & zmq.POLLIN:
+            socket.recv_multipart()
+            received += 1
+    results.put(('received', received * batch))
+    socket.close(linger=0)
+    context.term()
+
+
+def bench_proxy(env, args, edges=0):
+    shards = int(env.get('PROXY_SHARDS', 1))
+    root_env = {
+        'PROXY_XSUB_BIND': f"tcp://{HOST}:{PROXY_XSUB}",
+        'PROXY_XPUB_BIND': f"tcp://{HOST}:{PROXY_XPUB}",
+        'PROXY_SHARD_STEP': str(SHARD_STEP),
+        **env
+    }
+    proxies = [start('proxy', root_env, wait=0.2)]
+    try:
+        xsub = port_addresses(PROXY_XSUB, shards)
+        xpub = port_addresses(PROXY_XPUB, shards)
+        if edges:
+            # Cada borda (um processo, sem fragmentos) assina um fragmento da raiz
+            edge_env = {key: value for key, value in env.items() if key != 'PROXY_SHARDS'}
+            edge_xpub = port_addresses(EDGE_XPUB, edges)
+            for i, address in enumerate(edge_xpub):
+                proxies.append(start('proxy', {**edge_env, 'PROXY_UPSTREAM': xpub[i % shards],
+                                               'PROXY_XPUB_BIND': address}, wait=0.2))
+            xpub = edge_xpub
+        time.sleep(0.8)
+        for proxy in proxies:
+            if proxy.poll() is not None:
+                raise RuntimeError(f"proxy não iniciou: {proxy.stderr.read().decode(errors='replace')}")
+        start_at = time.time() + 1.0
+        stop_at = start_at + args.duration
+        results = multiprocessing.Queue()
+        # Como os clientes reais: cada inscrito em um fragmento, publicadores em todos
+        processes = [multiprocessing.Process(target=subscriber, args=(xpub[i % len(xpub)], stop_at + 0.5, args.batch, results))
+                     for i in range(args.subscribers)]
+        processes += [multiprocessing.Process(target=publisher, args=(xsub, start_at, stop_at, args.topics, args.size, args.batch, results))
+                      for _ in range(args.publishers)]
+        for process in processes:
+            process.start()
+        totals = {'sent': 0, 'received': 0}
+        for _ in processes:
+            kind, count = results.get()
+            totals[kind] += count
+        for process in processes:
+            process.join()
+        # Publicado vale para todos os inscritos: entregue / (publicado * inscritos)
+        expected = totals['sent'] * args.subscribers
+        return {
+            'entregue/s': totals['received'] / args.duration,
+            'pub/s': totals['sent'] / args.duration,
+            'entregue %': 100.0 * totals['received'] / expected if expected else 0.0
+        }
+    finally:
+        for proxy in proxies:
+            stop(proxy)
+
+
+# ========== EXECUÇÃO ==========
+
+def run(name, scenarios, bench, args):
+    print(f"\n=== {name} ===")
+    baseline = None
+    for label, env, *options in scenarios:
+        try:
+            result = bench(env, args, *options)
+        except RuntimeError as e:
+            print(f"  {label:<28} erro: {e}")
+            continue
+        main_metric = next(iter(result.values()))
+        baseline = baseline or main_metric
+        values = '  '.join(f"{key} {value:>10.1f}" for key, value in result.items())
+        print(f"  {label:<28} {values}  ({main_metric / baseline:.2f}x)", flush=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Vazão do broker e do proxy por configuração")
+    parser.add_argument('target', nargs='?', choices=['broker', 'proxy', 'all'], default='all')
+    parser.add_argument('--duration', type=float, default=5.0, help="segundos medidos por cenário")
+    parser.add_argument('--size', type=int, default=100, help="bytes de carga por mensagem")
+    parser.add_argument('--clients', type=int, default=4)
+    parser.add_argument('--window', type=int, default=16, help="requisições pendentes por cliente")
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--publishers', type=int, default=2)
+    parser.add_argument('--subscribers', type=int, default=8)
+    parser.add_argument('--topics', type=int, default=10)
+    parser.add_argument('--batch', type=int, default=1, help="publicações por quadro no proxy (lotes dos servidores)")
+    parser.add_argument('--set', action='append', default=[], metavar='VAR=VALOR',
+                        help="roda só um cenário com estas variáveis de ambiente")
+    parser.add_argument('--edges', type=int, default=0, help="proxies de borda no cenário personalizado")
+    args = parser.parse_args()
+
+    custom = dict(item.split('=', 1) for item in args.set)
+    broker = [('personalizado', custom)] if custom else BROKER_SCENARIOS
+    proxy = [('personalizado', custom, args.edges)] if custom or args.edges else PROXY_SCENARIOS
+
+    print(f"📊 {args.duration:.0f}s por cenário, {args.size} bytes por mensagem")
+    if args.target in ('broker', 'all'):
+        print(f"Broker: {args.clients} clientes x {args.window} pendentes, {args.workers} workers")
+        run('BROKER', broker, bench_broker, args)
+    if args.target in ('proxy', 'all'):
+        print(f"Proxy: {args.publishers} publicadores, {args.subscribers} inscritos, {args.topics} tópicos, "
+              f"{args.batch} publicação(ões) por quadro")
+        run('PROXY', proxy, bench_proxy, args)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,5 +1,6 @@
 import zmq
 import msgpack
+import os
 import time
 import random
 import uuid
@@ -13,7 +14,10 @@ class Bot:
         self.req_socket.connect("tcp://broker:5555")
         
         self.sub_socket = self.context.socket(zmq.SUB)
-        self.sub_socket.connect("tcp://proxy:5558")
+        # Proxy fragmentado: PROXY_ADDRESSES lista os XPUB e cada bot usa um
+        proxies = [address.strip() for address in os.environ.get('PROXY_ADDRESSES', '').split(',')
+                   if address.strip()]
+        self.sub_socket.connect(random.choice(proxies or ['tcp://proxy:5558']))
         
         self.username = f"bot_py_{uuid.uuid4().hex[:6]}"
         self.logical_clock = 0
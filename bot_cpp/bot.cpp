@@ -8,6 +8,7 @@
 #include <sstream>
 #include <iomanip>
 #include <cstring>
+#include <cstdlib>
 
 std::string generate_uuid() {
     static std::random_device rd;
@@ -63,6 +64,23 @@ private:
         return std::string(static_cast<char*>(reply.data()), reply.size());
     }
 
+    // Proxy fragmentado: PROXY_ADDRESSES lista os XPUB e cada bot usa um
+    std::string choose_proxy() {
+        const char* env = std::getenv("PROXY_ADDRESSES");
+        std::vector<std::string> proxies;
+        std::stringstream ss(env ? env : "");
+        std::string address;
+        while (std::getline(ss, address, ',')) {
+            size_t first = address.find_first_not_of(" \t\r\n");
+            if (first == std::string::npos) continue;
+            size_t last = address.find_last_not_of(" \t\r\n");
+            proxies.push_back(address.substr(first, last - first + 1));
+        }
+        if (proxies.empty()) return "tcp://proxy:5558";
+        std::uniform_int_distribution<size_t> dis(0, proxies.size() - 1);
+        return proxies[dis(gen)];
+    }
+
 public:
     BotCpp() : context(1), 
                req_socket(context, zmq::socket_type::req),
@@ -73,7 +91,7 @@ public:
         gen = std::mt19937(rd());
         
         req_socket.connect("tcp://broker:5555");
-        sub_socket.connect("tcp://proxy:5558");
+        sub_socket.connect(choose_proxy());
         
         username = "bot_cpp_" + generate_uuid();
         
@@ -1,15 +1,430 @@
 import zmq
+import msgpack
+import os
+import time
+import hashlib
+from collections import deque
+from datetime import datetime
+
+from stats import Stats, StatsEndpoint
+from tuning import make_context, configure, bind
+
+# Serviços roteados pelo dono da partição e a chave de cada um
+# (o mesmo cálculo de server/partitions.py: os dois lados precisam concordar)
+ROUTED_SERVICES = {
+    'publish': ('#', 'channel'),
+    'get_publications': ('#', 'channel'),
+    'message': ('@', 'dst'),
+    'get_messages': ('@', 'username'),
+}
+
+
+def partition_of(key, partitions):
+    return int.from_bytes(hashlib.md5(str(key).encode()).digest()[:8], 'big') % partitions
+
+
+def request_key(service, data):
+    route = ROUTED_SERVICES.get(service)
+    if route is None or not isinstance(data, dict):
+        return None
+    prefix, field = route
+    value = data.get(field)
+    return None if value is None else prefix + str(value)
+
+
+def worker_identity(server_id):
+    """Identidade do socket de cada servidor no backend (ver Server.broker_identity)"""
+    return f"server-{server_id}".encode()
+
+
+class Worker:
+    """Servidor atrás do broker e as requisições que ele ainda não respondeu"""
+    
+    def __init__(self, server_id):
+        self.server_id = server_id
+        self.identity = worker_identity(server_id)
+        self.outstanding = {}  # envelope do cliente -> (horário de envio, de chegada ao broker, serviço)
+        self.last_used = 0.0
+        self.dead_until = 0.0
+    
+    def alive(self, now):
+        return now >= self.dead_until
+
+
+class SmartBroker:
+    """Broker que lê o envelope msgpack e escolhe o servidor de cada requisição
+    
+    - Requisições com canal/usuário vão para um dono da partição (mapa do
+      reference server); as outras para qualquer servidor
+    - Entre os candidatos ganha o com menos requisições pendentes e, no
+      empate, o usado há mais tempo (padrão LRU worker)
+    - Um servidor que desconectou (envio recusado) ou que deixa requisições
+      sem resposta por worker_timeout sai da escala por dead_backoff
+      segundos; a próxima resposta dele o traz de volta
+    - As requisições pendentes num servidor que sai da escala recebem um
+      erro na hora (um cliente REQ sem resposta não envia mais nada)
+    - Sem servidor disponível a requisição espera na fila por até
+      queue_timeout e depois recebe um erro
+    """
+    
+    def __init__(self, frontend_bind='tcp://*:5555', backend_bind='tcp://*:5556',
+                 reference='tcp://reference:5559', max_outstanding=32, worker_timeout=5.0,
+                 dead_backoff=5.0, queue_timeout=10.0, refresh_interval=3.0, stats_bind=None,
+                 stats_log_interval=60, context=None):
+        self.context = context or zmq.Context()
+        self.frontend = self.context.socket(zmq.ROUTER)
+        self.options = configure(self.frontend, 'BROKER', 'FRONTEND')
+        bind(self.frontend, frontend_bind)
+        self.backend = self.context.socket(zmq.ROUTER)
+        # Envio para um servidor desconectado falha na hora em vez de sumir
+        self.backend.setsockopt(zmq.ROUTER_MANDATORY, 1)
+        # Servidor reiniciado com a mesma identidade assume a conexão
+        self.backend.setsockopt(zmq.ROUTER_HANDOVER, 1)
+        self.options.update(configure(self.backend, 'BROKER', 'BACKEND'))
+        bind(self.backend, backend_bind)
+        self.frontend_bind = frontend_bind
+        self.backend_bind = backend_bind
+        
+        self.reference_address = reference
+        self.reference = None
+        self.reference_sent_at = None
+        self.refresh_interval = refresh_interval
+        self.last_refresh = 0.0
+        
+        self.max_outstanding = max_outstanding
+        self.worker_timeout = worker_timeout
+        self.dead_backoff = dead_backoff
+        self.queue_timeout = queue_timeout
+        
+        self.workers = {}   # identidade -> Worker
+        self.owners = []    # partição -> ids dos servidores donos
+        self.partitions = 0
+        self.queue = deque()  # (quadros, chave, serviço, chegada, prazo)
+        
+        # Estatísticas opcionais: requisições/respostas, serviços e latência fim a fim
+        self.endpoint = None
+        self.stats = None
+        if stats_bind:
+            self.stats = Stats('BROKER', ('requests', 'replies'))
+            self.endpoint = StatsEndpoint(self.context, stats_bind, self.stats, self.stats_extra,
+                                          stats_log_interval)
+    
+    # ========== ESCOLHA DO SERVIDOR ==========
+    
+    def route_key(self, body):
+        try:
+            request = msgpack.unpackb(body)
+        except Exception:
+            return None, None
+        if not isinstance(request, dict):
+            return None, None
+        service = request.get('service')
+        return service, request_key(service, request.get('data'))
+    
+    def candidates(self, key, now):
+        """Servidores vivos com vaga; os donos da chave primeiro, se houver algum"""
+        alive = [w for w in self.workers.values()
+                 if w.alive(now) and (not self.max_outstanding or len(w.outstanding) < self.max_outstanding)]
+        if key is not None and self.owners:
+            owners = self.owners[partition_of(key, self.partitions)]
+            preferred = [w for w in alive if w.server_id in owners]
+            if preferred:
+                return preferred
+            # Nenhum dono com vaga: se algum está vivo, espera por ele
+            if any(w.alive(now) for w in self.workers.values() if w.server_id in owners):
+                return []
+        return alive
+    
+    def dispatch(self, frames, key, service, now, arrived):
+        """Envia ao melhor candidato; retorna False se nenhum pode receber agora"""
+        for worker in sorted(self.candidates(key, now), key=lambda w: (len(w.outstanding), w.last_used)):
+            try:
+                self.backend.send_multipart([worker.identity] + frames)
+            except zmq.ZMQError as e:
+                if e.errno != zmq.EHOSTUNREACH:
+                    raise
+                self.mark_dead(worker, now, "desconectado")
+                continue
+            worker.outstanding[tuple(frames[:-1])] = (now, arrived, service)
+            worker.last_used = now
+            return True
+        return False
+    
+    def mark_dead(self, worker, now, reason):
+        if worker.alive(now):
+            print(f"[BROKER] Servidor {worker.server_id} fora da escala por {self.dead_backoff:.0f}s ({reason})",
+                  flush=True)
+        worker.dead_until = now + self.dead_backoff
+        # Requisições presas nele não são reenviadas (não são idempotentes):
+        # o cliente recebe um erro e uma resposta atrasada é descartada
+        for envelope, (_, _, service) in worker.outstanding.items():
+            self.reply_error(list(envelope), service, f'Servidor {worker.server_id} não respondeu')
+        worker.outstanding.clear()
+    
+    # ========== MENSAGENS ==========
+    
+    def handle_client(self, frames, now):
+        service, key = self.route_key(frames[-1])
+        if self.stats:
+            self.stats.message('requests', frames, service)
+        if not self.dispatch(frames, key, service, now, now):
+            self.queue.append((frames, key, service, now, now + self.queue_timeout))
+    
+    def handle_reply(self, frames, now):
+        identity, reply = frames[0], frames[1:]
+        worker = self.workers.get(identity)
+        if worker is None and identity.startswith(b'server-'):
+            # Servidor que o reference server ainda não listou
+            worker = self.add_worker(identity[len(b'server-'):].decode())
+        if worker is not None:
+            sent = worker.outstanding.pop(tuple(reply[:-1]), None)
+            if self.stats:
+                self.stats.message('replies', reply)
+                if sent is not None:
+                    self.stats.latency(now - sent[1])
+            if not worker.alive(now):
+                print(f"[BROKER] Servidor {worker.server_id} voltou a responder", flush=True)
+                worker.dead_until = 0.0
+            if sent is None:
+                # O cliente já recebeu um erro quando o servidor saiu da escala
+                return
+        self.frontend.send_multipart(reply)
+    
+    def drain_queue(self, now):
+        """Despacha o que já tem servidor; requisições vencidas recebem erro
+        
+        Cada cliente REQ tem no máximo uma requisição na fila, então uma
+        requisição esperando um dono ocupado não segura as outras.
+        """
+        waiting = deque()
+        while self.queue:
+            frames, key, service, arrived, deadline = item = self.queue.popleft()
+            if now >= deadline:
+                self.reply_error(frames[:-1], service)
+            elif not self.dispatch(frames, key, service, now, arrived):
+                waiting.append(item)
+        self.queue = waiting
+    
+    def reply_error(self, envelope, service, message='Nenhum servidor disponível'):
+        self.frontend.send_multipart(envelope + [msgpack.packb({
+            'service': service,
+            'data': {
+                'status': 'erro',
+                'message': message,
+                'timestamp': datetime.now().isoformat()
+            }
+        })])
+    
+    def check_workers(self, now):
+        """Servidores com requisição pendente há mais de worker_timeout saem da escala"""
+        for worker in self.workers.values():
+            if worker.alive(now) and worker.outstanding and \
+                    now - min(sent for sent, _, _ in worker.outstanding.values()) > self.worker_timeout:
+                self.mark_dead(worker, now, f"sem resposta há {self.worker_timeout:.0f}s")
+    
+    def stats_extra(self):
+        return {
+            'queued': len(self.queue),
+            'workers': {str(worker.server_id): {
+                'outstanding': len(worker.outstanding),
+                'alive': worker.alive(time.time())
+            } for worker in self.workers.values()}
+        }
+    
+    # ========== REFERENCE SERVER ==========
+    
+    def add_worker(self, server_id):
+        try:
+            server_id = int(server_id)
+        except ValueError:
+            pass
+        worker = Worker(server_id)
+        self.workers[worker.identity] = worker
+        print(f"[BROKER] Servidor {server_id} na escala ({len(self.workers)} servidores)", flush=True)
+        return worker
+    
+    def refresh(self, now):
+        """Pede a lista de servidores e o mapa de partições (sem bloquear o loop)"""
+        if self.reference_sent_at is not None:
+            if now - self.reference_sent_at > self.worker_timeout:
+                # O REQ fica inutilizável sem resposta: recria o socket (e tira o
+                # antigo do poller, senão o poll volta na hora para sempre)
+                self.poller.unregister(self.reference)
+                self.reference.close(linger=0)
+                self.reference = None
+                self.reference_sent_at = None
+            return
+        if now - self.last_refresh < self.refresh_interval:
+            return
+        if self.reference is None:
+            self.reference = self.context.socket(zmq.REQ)
+            self.reference.connect(self.reference_address)
+            self.poller.register(self.reference, zmq.POLLIN)
+        self.reference.send(msgpack.packb({'service': 'list_servers'}))
+        self.reference_sent_at = now
+        self.last_refresh = now
+    
+    def handle_reference(self, message):
+        self.reference_sent_at = None
+        response = msgpack.unpackb(message)
+        if response.get('status') != 'ok':
+            return
+        listed = {worker_identity(s['server_id']): s['server_id'] for s in response.get('servers', [])}
+        for identity, server_id in listed.items():
+            if identity not in self.workers:
+                self.add_worker(server_id)
+        for identity in [identity for identity in self.workers if identity not in listed]:
+            print(f"[BROKER] Servidor {self.workers[identity].server_id} saiu da escala (inativo no reference)",
+                  flush=True)
+            del self.workers[identity]
+        partition_map = response.get('partition_map') or {}
+        self.owners = partition_map.get('owners') or []
+        self.partitions = partition_map.get('partitions') or 0
+    
+    # ========== LOOP ==========
+    
+    def run(self):
+        self.poller = zmq.Poller()
+        self.poller.register(self.frontend, zmq.POLLIN)
+        self.poller.register(self.backend, zmq.POLLIN)
+        if self.endpoint:
+            self.endpoint.register(self.poller)
+        print(f"[BROKER] Iniciado em {self.frontend_bind} e {self.backend_bind} "
+              f"(roteamento por partição, menos pendentes)"
+              + (f", opções {self.options}" if self.options else ""), flush=True)
+        
+        while True:
+            now = time.time()
+            self.refresh(now)
+            events = dict(self.poller.poll(250))
+            now = time.time()
+            
+            if self.reference is not None and events.get(self.reference) == zmq.POLLIN:
+                self.handle_reference(self.reference.recv())
+            # Respostas primeiro: liberam vagas para a fila e para os clientes
+            if self.backend in events:
+                while self.backend.getsockopt(zmq.EVENTS) & zmq.POLLIN:
+                    self.handle_reply(self.backend.recv_multipart(), now)
+            self.check_workers(now)
+            if self.queue:
+                self.drain_queue(now)
+            if self.frontend in events:
+                while self.frontend.getsockopt(zmq.EVENTS) & zmq.POLLIN:
+                    self.handle_client(self.frontend.recv_multipart(), now)
+            if self.endpoint:
+                if self.endpoint.socket in events:
+                    self.endpoint.handle()
+                self.endpoint.timers(now)
+
+
+SERVICE_KEY = b'\xa7service'
+
+
+def service_of(body):
+    """Serviço lido do prefixo do corpo, sem decodificar a requisição inteira
+    
+    Os clientes empacotam {'service': ..., 'data': ...} com 'service' como
+    primeira chave: cabeçalho do mapa (fixmap ou map16), a chave e o valor
+    como fixstr ou str8. Outro formato não entra na tabela de tópicos.
+    """
+    if not body:
+        return None
+    start = 1 if 0x80 <= body[0] <= 0x8f else 3 if body[0] == 0xde else None
+    if start is None or body[start:start + len(SERVICE_KEY)] != SERVICE_KEY:
+        return None
+    start += len(SERVICE_KEY)
+    if start >= len(body):
+        return None
+    header = body[start]
+    if 0xa0 <= header <= 0xbf:
+        start, size = start + 1, header & 0x1f
+    elif header == 0xd9 and start + 1 < len(body):
+        start, size = start + 2, body[start + 1]
+    else:
+        return None
+    if start + size > len(body):
+        return None
+    try:
+        return body[start:start + size].decode()
+    except UnicodeDecodeError:
+        return None
+
+
+def run_instrumented(frontend, backend, endpoint):
+    """ROUTER/DEALER como o zmq.proxy, medindo requisições, respostas e latência
+    
+    A latência vai da chegada da requisição à resposta, pelo envelope do
+    cliente (um REQ tem no máximo uma requisição pendente). O serviço de
+    cada requisição sai do prefixo do corpo (service_of), sem msgpack.
+    """
+    stats = endpoint.stats
+    pending = {}
+    poller = zmq.Poller()
+    poller.register(frontend, zmq.POLLIN)
+    poller.register(backend, zmq.POLLIN)
+    endpoint.register(poller)
+    
+    while True:
+        events = dict(poller.poll(1000))
+        now = time.time()
+        
+        if frontend in events:
+            while frontend.getsockopt(zmq.EVENTS) & zmq.POLLIN:
+                frames = frontend.recv_multipart()
+                backend.send_multipart(frames)
+                stats.message('requests', frames, service_of(frames[-1]))
+                pending[tuple(frames[:-1])] = now
+        
+        if backend in events:
+            while backend.getsockopt(zmq.EVENTS) & zmq.POLLIN:
+                frames = backend.recv_multipart()
+                frontend.send_multipart(frames)
+                stats.message('replies', frames)
+                arrived = pending.pop(tuple(frames[:-1]), None)
+                if arrived is not None:
+                    stats.latency(now - arrived)
+        
+        if endpoint.socket in events:
+            endpoint.handle()
+        endpoint.timers(now)
+
 
 def main():
-    context = zmq.Context()
+    context = make_context('BROKER')
+    frontend_bind = os.environ.get('BROKER_FRONTEND_BIND', 'tcp://*:5555')
+    backend_bind = os.environ.get('BROKER_BACKEND_BIND', 'tcp://*:5556')
+    stats_bind = os.environ.get('BROKER_STATS_BIND')
+    if os.environ.get('BROKER_MODE', 'proxy') == 'smart':
+        SmartBroker(
+            frontend_bind=frontend_bind,
+            backend_bind=backend_bind,
+            reference=os.environ.get('REFERENCE_ADDRESS', 'tcp://reference:5559'),
+            max_outstanding=int(os.environ.get('BROKER_MAX_OUTSTANDING', 32)),
+            worker_timeout=float(os.environ.get('BROKER_WORKER_TIMEOUT', 5.0)),
+            queue_timeout=float(os.environ.get('BROKER_QUEUE_TIMEOUT', 10.0)),
+            stats_bind=stats_bind,
+            stats_log_interval=int(os.environ.get('STATS_LOG_INTERVAL', 60)),
+            context=context
+        ).run()
+        return
     
     frontend = context.socket(zmq.ROUTER)
-    frontend.bind("tcp://*:5555")
+    options = configure(frontend, 'BROKER', 'FRONTEND')
+    bind(frontend, frontend_bind)
     
     backend = context.socket(zmq.DEALER)
-    backend.bind("tcp://*:5556")
+    options.update(configure(backend, 'BROKER', 'BACKEND'))
+    bind(backend, backend_bind)
+    
+    print(f"[BROKER] Iniciado em {frontend_bind} e {backend_bind}"
+          + (f", opções {options}" if options else ""), flush=True)
     
-    print("[BROKER] Iniciado nas portas 5555 e 5556")
+    if stats_bind:
+        endpoint = StatsEndpoint(context, stats_bind, Stats('BROKER', ('requests', 'replies')),
+                                 log_interval=int(os.environ.get('STATS_LOG_INTERVAL', 60)))
+        print(f"[BROKER] Estatísticas em {stats_bind}", flush=True)
+        run_instrumented(frontend, backend, endpoint)
+        return
     
     zmq.proxy(frontend, backend)
 
@@ -0,0 +1,63 @@
+import os
+
+import zmq
+
+# Mesmo arquivo em broker/ e proxy/ (cada um é uma imagem separada)
+
+# Opções de socket lidas do ambiente: {PREFIXO}_{SOCKET}_{OPÇÃO} vale só para
+# um socket (ex.: PROXY_XPUB_SNDHWM) e {PREFIXO}_{OPÇÃO} para todos
+SOCKET_OPTIONS = {
+    'SNDHWM': zmq.SNDHWM,
+    'RCVHWM': zmq.RCVHWM,
+    'SNDBUF': zmq.SNDBUF,
+    'RCVBUF': zmq.RCVBUF,
+    'TCP_KEEPALIVE': zmq.TCP_KEEPALIVE,
+    'TCP_KEEPALIVE_IDLE': zmq.TCP_KEEPALIVE_IDLE,
+    'TCP_KEEPALIVE_INTVL': zmq.TCP_KEEPALIVE_INTVL,
+    'TCP_KEEPALIVE_CNT': zmq.TCP_KEEPALIVE_CNT,
+}
+
+
+def env_int(name, default=None):
+    value = os.environ.get(name)
+    return default if value in (None, '') else int(value)
+
+
+def make_context(prefix):
+    """Contexto com {prefix}_IO_THREADS threads de I/O (padrão 1, como o zmq.Context())"""
+    return zmq.Context(io_threads=env_int(f'{prefix}_IO_THREADS', 1))
+
+
+def configure(socket, prefix, name):
+    """Aplica as opções definidas no ambiente; as outras ficam no padrão do ZeroMQ
+    
+    Retorna as opções aplicadas (para o log de inicialização).
+    """
+    applied = {}
+    for option, code in SOCKET_OPTIONS.items():
+        value = env_int(f'{prefix}_{name}_{option}', env_int(f'{prefix}_{option}'))
+        if value is not None:
+            socket.setsockopt(code, value)
+            applied[option] = value
+    return applied
+
+
+def addresses(value):
+    """'tcp://*:5557,ipc:///tmp/x' -> lista de endereços"""
+    return [address.strip() for address in value.split(',') if address.strip()]
+
+
+def bind(socket, value):
+    for address in addresses(value):
+        socket.bind(address)
+
+
+def shifted(value, offset):
+    """Endereços com a porta TCP deslocada (instância 'offset' de um serviço fragmentado)"""
+    if not offset:
+        return value
+    result = []
+    for address in addresses(value):
+        base, _, port = address.rpartition(':')
+        result.append(f"{base}:{int(port) + offset}" if port.isdigit() else address)
+    return ','.join(result)
@@ -9,6 +9,13 @@ class Client {
         this.logicalClock = 0;
         this.username = null;
         this.subscribedChannels = [];
+        this.seenMessages = new Map(); // tópico -> chaves recentes (snapshots do cache do proxy)
+        // Histórico recente de cada tópico novo: socket ROUTER do proxy raiz
+        // (PROXY_CACHE), que responde só a quem pediu
+        this.snapshotAddress = process.env.PROXY_SNAPSHOT_ADDRESS || 'tcp://proxy:5563';
+        // Com SUBSCRIBE_BATCHES=1 o cliente assina os tópicos de lote
+        // ('batch:' + nome), publicados pelos servidores com PUBLISH_BATCH_WINDOW_MS
+        this.topicPrefix = process.env.SUBSCRIBE_BATCHES === '1' ? 'batch:' : '';
         
         this.rl = readline.createInterface({
             input: process.stdin,
@@ -21,7 +28,9 @@ class Client {
         await this.reqSocket.connect('tcp://broker:5555');
         
         this.subSocket = new zmq.Subscriber();
-        await this.subSocket.connect('tcp://proxy:5558');
+        // Proxy fragmentado: PROXY_ADDRESSES lista os XPUB e cada cliente usa um
+        const proxies = (process.env.PROXY_ADDRESSES || 'tcp://proxy:5558').split(',').map(a => a.trim()).filter(a => a);
+        await this.subSocket.connect(proxies[Math.floor(Math.random() * proxies.length)]);
         
         this.listenMessages();
     }
@@ -58,11 +67,71 @@ class Client {
         return parsed;
     }
     
+    alreadySeen(topic, data) {
+        const key = `${data.timestamp}|${data.clock}`;
+        let seen = this.seenMessages.get(topic);
+        if (!seen) {
+            seen = new Set();
+            this.seenMessages.set(topic, seen);
+        }
+        if (seen.has(key)) {
+            return true;
+        }
+        seen.add(key);
+        if (seen.size > 200) {
+            seen.delete(seen.values().next().value);
+        }
+        return false;
+    }
+    
+    showPublications(topicStr, items, tag) {
+        for (const data of items) {
+            // O snapshot e o ao vivo podem trazer a mesma publicação
+            if (this.alreadySeen(topicStr, data)) {
+                continue;
+            }
+            
+            if (topicStr === this.username) {
+                console.log(`\n[PRIVADA]${tag} ${data.src}: ${data.message}`);
+                this.updateClock(data.clock);
+            } else {
+                console.log(`\n[${topicStr}]${tag} ${data.user}: ${data.message}`);
+                this.updateClock(data.clock);
+            }
+        }
+    }
+    
+    async requestSnapshot(topicStr) {
+        // Pedido depois da inscrição: o que chegar ao vivo nesse meio-tempo
+        // é descartado pelo alreadySeen quando vier no snapshot (ou vice-versa)
+        const snapshot = new zmq.Dealer({ receiveTimeout: 2000, linger: 0 });
+        try {
+            snapshot.connect(this.snapshotAddress);
+            await snapshot.send(msgpack.encode({ topic: topicStr }));
+            const [reply] = await snapshot.receive();
+            const decoded = msgpack.decode(reply);
+            if (decoded.publications && decoded.publications.length > 0) {
+                this.showPublications(topicStr, decoded.publications, ' (anterior)');
+                this.rl.prompt();
+            }
+        } catch (e) {
+            // Proxy sem cache (ou fora do ar): segue só com o ao vivo
+        } finally {
+            snapshot.close();
+        }
+    }
+    
     async listenMessages() {
         for await (const [topic, msg] of this.subSocket) {
             try {
-                const data = msgpack.decode(msg);
-                const topicStr = topic.toString();
+                const decoded = msgpack.decode(msg);
+                let topicStr = topic.toString();
+                if (this.topicPrefix) {
+                    if (!topicStr.startsWith(this.topicPrefix)) {
+                        continue;
+                    }
+                    topicStr = topicStr.slice(this.topicPrefix.length);
+                }
                 
                 // ✅ Só mostrar mensagens de tópicos que estou inscrito
                 const isSubscribed = topicStr === this.username || 
@@ -72,13 +141,8 @@ class Client {
                     continue; // Ignorar mensagens de tópicos não inscritos
                 }
                 
-                if (topicStr === this.username) {
-                    console.log(`\n[PRIVADA] ${data.src}: ${data.message}`);
-                    this.updateClock(data.clock);
-                } else {
-                    console.log(`\n[${topicStr}] ${data.user}: ${data.message}`);
-                    this.updateClock(data.clock);
-                }
+                // Um quadro de lote traz várias publicações do mesmo tópico
+                this.showPublications(topicStr, decoded.batch || [decoded], '');
                 
                 this.rl.prompt();
             } catch (e) {}
@@ -90,7 +154,8 @@ class Client {
         
         if (response.data.status === 'sucesso') {
             this.username = username;
-            this.subSocket.subscribe(username);
+            this.subSocket.subscribe(this.topicPrefix + username);
+            this.requestSnapshot(username);
             console.log('✅ Login realizado!');
             return true;
         } else {
@@ -137,9 +202,10 @@ class Client {
             return;
         }
         
-        this.subSocket.subscribe(channelName);
+        this.subSocket.subscribe(this.topicPrefix + channelName);
         this.subscribedChannels.push(channelName);
         console.log(`✅ Inscrito em "${channelName}"`);
+        this.requestSnapshot(channelName);
     }
     
     async sendPrivateMessage(dst, message) {
@@ -0,0 +1,69 @@
+from collections import OrderedDict, deque
+
+import msgpack
+
+# Tópico dos lotes dos servidores (server/publishing.py, PUBLISH_BATCH_WINDOW_MS)
+BATCH_PREFIX = b'batch:'
+
+
+class TopicCache:
+    """Últimos 'depth' quadros de cada tópico, para quem acabou de se inscrever
+    
+    Os tópicos ficam em ordem de uso (publicação ou snapshot): passando de
+    max_topics, o menos usado sai inteiro. Guarda os quadros como vieram
+    do XSUB, então o caminho quente só faz um append; lotes só são
+    desempacotados quando alguém pede o snapshot.
+    """
+    
+    def __init__(self, depth, max_topics=1000, prefixes=(b'',)):
+        self.depth = depth
+        self.max_topics = max_topics
+        # Tópicos guardados (e assinados no XSUB): com servidores em modo de
+        # lotes, só 'batch:' evita receber e guardar cada publicação duas vezes
+        self.prefixes = tuple(prefixes)
+        self.topics = OrderedDict()  # tópico -> deque de quadros
+        self.evicted = 0
+    
+    def add(self, frames):
+        topic = frames[0]
+        if not topic.startswith(self.prefixes):
+            return
+        messages = self.topics.get(topic)
+        if messages is None:
+            messages = self.topics[topic] = deque(maxlen=self.depth)
+            if len(self.topics) > self.max_topics:
+                self.topics.popitem(last=False)
+                self.evicted += 1
+        else:
+            self.topics.move_to_end(topic)
+        messages.append(frames)
+    
+    def recent(self, topic):
+        """Últimas 'depth' publicações do tópico, avulsas ou de lotes (dicts)"""
+        publications = []
+        for key in (topic, BATCH_PREFIX + topic):
+            messages = self.topics.get(key)
+            if not messages:
+                continue
+            self.topics.move_to_end(key)
+            for frames in messages:
+                try:
+                    data = msgpack.unpackb(frames[-1])
+                except Exception:
+                    continue
+                if isinstance(data, dict) and 'batch' in data:
+                    publications.extend(data['batch'])
+                elif isinstance(data, dict):
+                    publications.append(data)
+        publications.sort(key=lambda data: (str(data.get('timestamp', '')), data.get('clock') or 0))
+        return publications[-self.depth:]
+    
+    def snapshot(self):
+        return {
+            'topics': len(self.topics),
+            'messages': sum(len(messages) for messages in self.topics.values()),
+            'depth': self.depth,
+            'max_topics': self.max_topics,
+            'evicted': self.evicted
+        }
+
@@ -1,18 +1,210 @@
 import zmq
+import msgpack
+import os
+import time
+import threading
+from datetime import datetime
 
-def main():
-    context = zmq.Context()
+from cache import TopicCache
+from stats import Stats, StatsEndpoint
+from tuning import make_context, configure, addresses, bind, shifted, env_int
+
+
+def publish_latency(payload):
+    """Atraso entre o timestamp do servidor e a passagem pelo proxy (s), ou None
+    
+    Num lote ({'batch': [...]}) vale a publicação mais antiga, que inclui a
+    espera na janela do lote.
+    """
+    try:
+        data = msgpack.unpackb(payload)
+        if 'batch' in data:
+            data = data['batch'][0]
+        timestamp = data.get('timestamp')
+        return (datetime.now() - datetime.fromisoformat(timestamp)).total_seconds()
+    except Exception:
+        return None
+
+
+def handle_snapshot(snapshots, cache, stats=None):
+    """Responde a um pedido de snapshot só para quem pediu (padrão Clone)
+    
+    Pedido (DEALER): {'topic': nome}. Resposta: {'topic', 'publications',
+    'replay': True} com as últimas publicações do tópico no cache.
+    """
+    frames = snapshots.recv_multipart()
+    identity, payload = frames[0], frames[-1]
+    try:
+        topic = str(msgpack.unpackb(payload).get('topic'))
+    except Exception:
+        return
+    reply = [identity, msgpack.packb({
+        'topic': topic,
+        'publications': cache.recent(topic.encode()),
+        'replay': True
+    })]
+    snapshots.send_multipart(reply)
+    if stats is not None:
+        stats.message('replay', reply[1:], topic.encode())
+
+
+def run_forwarding(xsub, xpub, endpoint=None, latency_sample=0, cache=None, snapshots=None):
+    """Encaminhamento XSUB <-> XPUB com estatísticas e/ou cache
     
+    Estatísticas (endpoint): mensagens e bytes, tópicos mais ativos e, em 1
+    de cada latency_sample publicações, o atraso desde o timestamp do
+    servidor; inscrições (XPUB verboso) contadas por tópico.
+    Cache: cada publicação entra no cache do tópico; quem acabou de se
+    inscrever pede as guardadas no socket ROUTER de snapshots.
+    """
+    stats = endpoint.stats if endpoint else None
+    poller = zmq.Poller()
+    poller.register(xsub, zmq.POLLIN)
+    poller.register(xpub, zmq.POLLIN)
+    if endpoint:
+        endpoint.register(poller)
+    if snapshots is not None:
+        poller.register(snapshots, zmq.POLLIN)
+    sampled = 0
+    
+    while True:
+        events = dict(poller.poll(1000))
+        
+        if xsub in events:
+            while xsub.getsockopt(zmq.EVENTS) & zmq.POLLIN:
+                frames = xsub.recv_multipart()
+                xpub.send_multipart(frames)
+                if cache is not None and len(frames) > 1:
+                    cache.add(frames)
+                if stats is None:
+                    continue
+                stats.message('pub', frames, frames[0])
+                sampled += 1
+                if latency_sample and sampled >= latency_sample and len(frames) > 1:
+                    sampled = 0
+                    delay = publish_latency(frames[-1])
+                    if delay is not None:
+                        stats.latency(delay)
+        
+        if xpub in events:
+            while xpub.getsockopt(zmq.EVENTS) & zmq.POLLIN:
+                frames = xpub.recv_multipart()
+                xsub.send_multipart(frames)
+                if stats is not None:
+                    stats.message('sub', frames)
+                    stats.subscription(frames[0])
+        
+        if snapshots is not None and snapshots in events:
+            while snapshots.getsockopt(zmq.EVENTS) & zmq.POLLIN:
+                handle_snapshot(snapshots, cache, stats)
+        
+        if endpoint is None:
+            continue
+        if endpoint.socket in events:
+            endpoint.handle()
+        endpoint.timers(time.time())
+
+
+def run_shard(context, name, xsub_bind, xpub_bind, stats_bind=None, upstream=None, cache=None,
+              snapshot_bind=None):
+    """Um par XSUB/XPUB; com estatísticas ou cache usa o próprio loop em vez do zmq.proxy
+    
+    Com upstream (modo relay) o XSUB conecta no XPUB de outro proxy em vez
+    de (ou além de) receber os servidores. O XPUB local não é verboso, então
+    só a primeira inscrição e a última desinscrição de cada tópico sobem:
+    o proxy de cima vê um inscrito por borda e cada borda recebe só os
+    tópicos que os seus clientes pediram.
+    """
     xsub = context.socket(zmq.XSUB)
-    xsub.bind("tcp://*:5557")
+    options = configure(xsub, 'PROXY', 'XSUB')
+    if xsub_bind:
+        bind(xsub, xsub_bind)
+    if upstream:
+        xsub.connect(upstream)
     
     xpub = context.socket(zmq.XPUB)
-    xpub.bind("tcp://*:5558")
+    if stats_bind:
+        # Repassa toda (des)inscrição, não só a primeira de cada tópico: conta
+        # inscritos (numa borda, o proxy de cima passa a ver cada cliente)
+        xpub.setsockopt(zmq.XPUB_VERBOSER, 1)
+    options.update(configure(xpub, 'PROXY', 'XPUB'))
+    bind(xpub, xpub_bind)
+    
+    source = f"{xsub_bind} (XSUB)" if xsub_bind else ""
+    if upstream:
+        source = f"{source} + relay de {upstream}" if source else f"relay de {upstream}"
+    print(f"[{name}] Iniciado em {source} e {xpub_bind} (XPUB)"
+          + (f", opções {options}" if options else ""), flush=True)
     
-    print("[PROXY] Iniciado nas portas 5557 e 5558")
+    endpoint = None
+    if stats_bind:
+        directions = ('pub', 'sub', 'replay') if cache is not None else ('pub', 'sub')
+        endpoint = StatsEndpoint(context, stats_bind, Stats(name, directions),
+                                 extra=(lambda: {'cache': cache.snapshot()}) if cache is not None else None,
+                                 log_interval=int(os.environ.get('STATS_LOG_INTERVAL', 60)))
+        print(f"[{name}] Estatísticas em {stats_bind}", flush=True)
+    snapshots = None
+    if cache is not None:
+        snapshots = context.socket(zmq.ROUTER)
+        bind(snapshots, snapshot_bind)
+        # Os publicadores só enviam os tópicos pedidos pelo XSUB: para ter o
+        # que entregar a quem entra num canal sem inscritos, assina todos os
+        # tópicos com os prefixos do cache
+        for prefix in cache.prefixes:
+            xsub.send(b'\x01' + prefix)
+        print(f"[{name}] Cache: {cache.depth} publicações por tópico, até {cache.max_topics} tópicos, "
+              f"snapshots em {snapshot_bind}", flush=True)
+    if endpoint or cache is not None:
+        run_forwarding(xsub, xpub, endpoint, int(os.environ.get('PROXY_LATENCY_SAMPLE', 16)), cache,
+                       snapshots)
+        return
     
     zmq.proxy(xsub, xpub)
 
+
+def main():
+    context = make_context('PROXY')
+    # Relay: PROXY_UPSTREAM lista XPUBs de proxies acima (raiz ou outra borda);
+    # aí o XSUB só é aberto para servidores se PROXY_XSUB_BIND for definido
+    upstream = addresses(os.environ.get('PROXY_UPSTREAM', ''))
+    xsub_bind = os.environ.get('PROXY_XSUB_BIND', '' if upstream else 'tcp://*:5557')
+    xpub_bind = os.environ.get('PROXY_XPUB_BIND', 'tcp://*:5558')
+    stats_bind = os.environ.get('PROXY_STATS_BIND')
+    # Cache para quem entra: PROXY_CACHE publicações por tópico (0 desliga)
+    depth = env_int('PROXY_CACHE', 0)
+    max_topics = env_int('PROXY_CACHE_TOPICS', 1000)
+    cache_prefixes = [prefix.strip().encode() for prefix in os.environ.get('PROXY_CACHE_SUBSCRIBE', '').split(',')]
+    # Clientes pedem o snapshot aqui (os de uma borda também, direto na raiz)
+    snapshot_bind = os.environ.get('PROXY_SNAPSHOT_BIND', 'tcp://*:5563')
+    
+    # Fragmentos: N pares independentes, o i-ésimo com as portas deslocadas
+    # de i * PROXY_SHARD_STEP. Os servidores publicam em todos (o XSUB só
+    # pede os tópicos que os seus inscritos querem) e cada cliente se
+    # conecta a um, então o fan-out se divide entre as threads. Fragmentos
+    # de uma borda se distribuem entre os proxies de cima: cada um conecta em
+    # um só, senão receberia a mesma publicação de todos
+    shards = env_int('PROXY_SHARDS', 1)
+    step = env_int('PROXY_SHARD_STEP', 10)
+    if shards == 1:
+        run_shard(context, 'PROXY', xsub_bind, xpub_bind, stats_bind, upstream[0] if upstream else None,
+                  TopicCache(depth, max_topics, cache_prefixes) if depth else None, snapshot_bind)
+        return
+    
+    threads = []
+    for shard in range(shards):
+        offset = shard * step
+        thread = threading.Thread(target=run_shard, daemon=True, args=(
+            context, f'PROXY-{shard}', shifted(xsub_bind, offset), shifted(xpub_bind, offset),
+            shifted(stats_bind, offset) if stats_bind else None,
+            upstream[shard % len(upstream)] if upstream else None,
+            TopicCache(depth, max_topics, cache_prefixes) if depth else None,
+            shifted(snapshot_bind, offset)))
+        thread.start()
+        threads.append(thread)
+    for thread in threads:
+        thread.join()
+
+
 if __name__ == "__main__":
     try:
         main()
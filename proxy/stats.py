@@ -0,0 +1,185 @@
+import json
+import sys
+import time
+from collections import deque
+
+import msgpack
+import zmq
+
+# Mesmo arquivo em broker/ e proxy/ (cada um é uma imagem separada)
+
+LATENCY_BUCKETS = 32  # bucket i: latência < 2^i µs
+
+
+class Stats:
+    """Contadores de um dispositivo de encaminhamento
+    
+    Tudo é atualizado pela thread do loop de encaminhamento (sem locks): por
+    mensagem são só somas em inteiros e uma entrada de dict por tópico. As
+    taxas saem de amostras dos contadores tiradas uma vez por segundo
+    (tick) e as latências vão para um histograma em potências de 2.
+    """
+    
+    def __init__(self, name, directions, window=10, top=10, max_topics=10000):
+        self.name = name
+        self.started = time.time()
+        self.counters = {direction: [0, 0] for direction in directions}  # [mensagens, bytes]
+        self.samples = deque(maxlen=window + 1)
+        self.top = top
+        self.max_topics = max_topics
+        self.topics = {}
+        self.subscriptions = {}
+        self.histogram = [0] * LATENCY_BUCKETS
+        self.latency_count = 0
+        self.latency_max = 0.0
+        self.tick(self.started)
+    
+    def message(self, direction, frames, topic=None):
+        counter = self.counters[direction]
+        counter[0] += 1
+        counter[1] += sum(len(frame) for frame in frames)
+        if topic is not None:
+            self.topics[topic] = self.topics.get(topic, 0) + 1
+            if len(self.topics) > self.max_topics:
+                self._prune_topics()
+    
+    def _prune_topics(self):
+        """Mantém só os tópicos mais ativos (memória limitada com muitos tópicos)"""
+        kept = sorted(self.topics.items(), key=lambda item: item[1], reverse=True)[:self.max_topics // 10]
+        self.topics = dict(kept)
+    
+    def latency(self, seconds):
+        micros = max(0, int(seconds * 1e6))
+        self.histogram[min(micros.bit_length(), LATENCY_BUCKETS - 1)] += 1
+        self.latency_count += 1
+        self.latency_max = max(self.latency_max, seconds)
+    
+    def subscription(self, message):
+        """Mensagem de (des)inscrição recebida pelo XPUB: b'\\x01tópico' ou b'\\x00tópico'"""
+        if not message or message[0] not in (0, 1):
+            return
+        topic = message[1:]
+        count = self.subscriptions.get(topic, 0) + (1 if message[0] == 1 else -1)
+        if count > 0:
+            self.subscriptions[topic] = count
+        else:
+            self.subscriptions.pop(topic, None)
+    
+    def tick(self, now):
+        self.samples.append((now, {direction: tuple(counter) for direction, counter in self.counters.items()}))
+    
+    def percentile(self, fraction):
+        """Limite superior (s) do bucket que contém o percentil pedido"""
+        target = fraction * self.latency_count
+        seen = 0
+        for bucket, count in enumerate(self.histogram):
+            seen += count
+            if count and seen >= target:
+                return (1 << bucket) / 1e6
+        return 0.0
+    
+    def snapshot(self, extra=None):
+        first_at, first = self.samples[0]
+        last_at, last = self.samples[-1]
+        elapsed = max(last_at - first_at, 1e-9)
+        
+        directions = {}
+        for direction, (messages, size) in self.counters.items():
+            directions[direction] = {
+                'messages': messages,
+                'bytes': size,
+                'messages_per_s': round((last[direction][0] - first[direction][0]) / elapsed, 1),
+                'bytes_per_s': round((last[direction][1] - first[direction][1]) / elapsed, 1)
+            }
+        
+        def top(counts):
+            ranked = sorted(counts.items(), key=lambda item: item[1], reverse=True)[:self.top]
+            return [[topic.decode(errors='replace') if isinstance(topic, bytes) else topic, count]
+                    for topic, count in ranked]
+        
+        result = {
+            'name': self.name,
+            'uptime': round(time.time() - self.started, 1),
+            'window': round(elapsed, 1),
+            'directions': directions,
+            'top_topics': top(self.topics),
+            'latency': {
+                'count': self.latency_count,
+                'p50': self.percentile(0.5),
+                'p90': self.percentile(0.9),
+                'p99': self.percentile(0.99),
+                'max': round(self.latency_max, 6),
+                'histogram': {f"<{1 << bucket}us": count for bucket, count in enumerate(self.histogram) if count}
+            }
+        }
+        if self.subscriptions:
+            result['subscriptions'] = {
+                'topics': len(self.subscriptions),
+                'total': sum(self.subscriptions.values()),
+                'top': top(self.subscriptions)
+            }
+        if extra:
+            result.update(extra)
+        return result
+    
+    def summary(self):
+        """Uma linha para o log periódico"""
+        snapshot = self.snapshot()
+        rates = ', '.join(f"{direction} {values['messages_per_s']:.0f} msg/s {values['bytes_per_s'] / 1024:.1f} KB/s"
+                          for direction, values in snapshot['directions'].items())
+        latency = snapshot['latency']
+        return f"{rates}, latência p50 {latency['p50'] * 1000:.2f} ms p99 {latency['p99'] * 1000:.2f} ms"
+
+
+class StatsEndpoint:
+    """Socket REP local que responde com o snapshot das estatísticas (msgpack)
+    
+    Atendido pelo próprio loop de encaminhamento: quem chama register()
+    põe o socket no poller e chama handle() quando ele tiver dados.
+    'extra' (opcional) devolve campos específicos do dispositivo.
+    """
+    
+    def __init__(self, context, address, stats, extra=None, log_interval=60):
+        self.stats = stats
+        self.extra = extra
+        self.socket = context.socket(zmq.REP)
+        self.socket.bind(address)
+        self.log_interval = log_interval
+        self.next_tick = time.time() + 1
+        self.next_log = time.time() + log_interval
+    
+    def register(self, poller):
+        poller.register(self.socket, zmq.POLLIN)
+    
+    def handle(self):
+        self.socket.recv()
+        self.socket.send(msgpack.packb(self.stats.snapshot(self.extra() if self.extra else None)))
+    
+    def timers(self, now):
+        """Amostra das taxas a cada segundo e linha de log a cada log_interval"""
+        if now >= self.next_tick:
+            self.stats.tick(now)
+            self.next_tick = now + 1
+        if self.log_interval and now >= self.next_log:
+            print(f"[{self.stats.name}] {self.stats.summary()}", flush=True)
+            self.next_log = now + self.log_interval
+
+
+def query(address, timeout=2000):
+    """Lê o snapshot de um endpoint de estatísticas"""
+    context = zmq.Context.instance()
+    socket = context.socket(zmq.REQ)
+    socket.setsockopt(zmq.RCVTIMEO, timeout)
+    socket.setsockopt(zmq.LINGER, 0)
+    socket.connect(address)
+    socket.send(b'')
+    try:
+        return msgpack.unpackb(socket.recv())
+    finally:
+        socket.close()
+
+
+if __name__ == "__main__":
+    # python stats.py tcp://127.0.0.1:5562
+    print(json.dumps(query(sys.argv[1] if len(sys.argv) > 1 else 'tcp://127.0.0.1:5562'), indent=2,
+                     ensure_ascii=False))
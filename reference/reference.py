@@ -3,6 +3,44 @@ import msgpack
 import time
 from datetime import datetime, timedelta
 import threading
+import hashlib
+import bisect
+import os
+
+# Particionamento do histórico: número fixo de partições, distribuídas entre
+# os servidores por hashing consistente (cada servidor com VNODES pontos no anel)
+PARTITIONS = 64
+VNODES = 32
+
+
+def ring_hash(value):
+    return int.from_bytes(hashlib.md5(str(value).encode()).digest()[:8], 'big')
+
+
+def build_partition_owners(server_ids, replication_factor, partitions=PARTITIONS, vnodes=VNODES):
+    """Donos de cada partição: os primeiros servidores distintos no anel
+
+    A partição p fica no ponto ring_hash('partition-p') e é atribuída aos
+    replication_factor servidores seguintes no sentido horário. Quando um
+    servidor entra ou sai, só as partições vizinhas aos pontos dele mudam
+    de dono.
+    """
+    ring = sorted((ring_hash(f"server-{sid}#{v}"), sid) for sid in server_ids for v in range(vnodes))
+    if not ring:
+        return []
+    tokens = [token for token, _ in ring]
+    replicas = min(replication_factor, len(set(server_ids)))
+    owners = []
+    for partition in range(partitions):
+        position = bisect.bisect(tokens, ring_hash(f"partition-{partition}"))
+        chosen = []
+        while len(chosen) < replicas:
+            sid = ring[position % len(ring)][1]
+            if sid not in chosen:
+                chosen.append(sid)
+            position += 1
+        owners.append(chosen)
+    return owners
 
 class ReferenceServer:
     def __init__(self, port=5559):
@@ -17,6 +55,15 @@ class ReferenceServer:
         self.servers = {}
         self.last_heartbeat = {}
         
+        # Mapa de partições, recalculado quando o conjunto de servidores muda
+        self.replication_factor = int(os.environ.get('REPLICATION_FACTOR', 2))
+        self.partition_map = {
+            'version': 0,
+            'partitions': PARTITIONS,
+            'replication_factor': self.replication_factor,
+            'owners': []
+        }
+        
         # Thread para limpar servidores inativos
         threading.Thread(target=self.cleanup_inactive_servers, daemon=True).start()
         
@@ -51,6 +98,21 @@ class ReferenceServer:
                     print(f"[REFERENCE] Removendo servidor inativo: {server_id}")
                     del self.servers[server_id]
                     del self.last_heartbeat[server_id]
+            
+            if inactive:
+                self.rebuild_partition_map()
+    
+    def rebuild_partition_map(self):
+        """Recalcula os donos das partições para os servidores ativos"""
+        self.partition_map = {
+            'version': self.partition_map['version'] + 1,
+            'partitions': PARTITIONS,
+            'replication_factor': self.replication_factor,
+            'owners': build_partition_owners(sorted(self.servers), self.replication_factor)
+        }
+        print(f"[REFERENCE] Mapa de partições v{self.partition_map['version']}: "
+              f"{PARTITIONS} partições, fator de replicação {self.replication_factor}, "
+              f"{len(self.servers)} servidores")
     
     def handle_request(self, data):
         """Processa requisições e atualiza relógio lógico"""
@@ -69,6 +131,8 @@ class ReferenceServer:
             response = self.handle_heartbeat(data)
         elif service == 'rank':
             response = self.handle_rank(data)
+        elif service == 'partition_map':
+            response = {'status': 'ok', 'partition_map': self.partition_map}
         else:
             response = {'status': 'error', 'message': 'Serviço desconhecido'}
         
@@ -82,6 +146,7 @@ class ReferenceServer:
         server_id = data.get('server_id')
         address = data.get('address')
         port = data.get('port')
+        joined = server_id not in self.servers
         
         self.servers[server_id] = {
             'server_id': server_id,
@@ -96,11 +161,15 @@ class ReferenceServer:
         print(f"[REFERENCE] Servidor registrado: {server_id} ({address}:{port})")
         print(f"[REFERENCE] Total de servidores: {len(self.servers)}")
         
+        if joined:
+            self.rebuild_partition_map()
+        
         return {
             'status': 'ok',
             'message': 'Servidor registrado com sucesso',
             'server_id': server_id,
-            'total_servers': len(self.servers)
+            'total_servers': len(self.servers),
+            'partition_map': self.partition_map
         }
     
     def handle_list_servers(self, data):
@@ -108,7 +177,8 @@ class ReferenceServer:
         return {
             'status': 'ok',
             'servers': list(self.servers.values()),
-            'total': len(self.servers)
+            'total': len(self.servers),
+            'partition_map': self.partition_map
         }
     
     def handle_heartbeat(self, data):
@@ -116,6 +186,12 @@ class ReferenceServer:
         server_id = data.get('server_id')
         is_coordinator = data.get('is_coordinator', False)
         
+        if server_id not in self.servers and data.get('address') is not None:
+            # Servidor removido por inatividade que voltou (pausa, rede):
+            # o heartbeat traz o endereço e ele volta à lista e ao mapa
+            print(f"[REFERENCE] Servidor {server_id} voltou a enviar heartbeat")
+            self.handle_register(data)
+        
         if server_id in self.servers:
             self.last_heartbeat[server_id] = time.time()
             self.servers[server_id]['is_coordinator'] = is_coordinator
@@ -129,7 +205,8 @@ class ReferenceServer:
             return {
                 'status': 'ok',
                 'message': 'Heartbeat recebido',
-                'servers': list(self.servers.values())
+                'servers': list(self.servers.values()),
+                'partition_map': self.partition_map
             }
         
         return {
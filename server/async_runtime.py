@@ -0,0 +1,368 @@
+import asyncio
+import time
+
+import msgpack
+import zmq
+import zmq.asyncio
+
+from peers import PeerError
+
+
+class AsyncSyncService:
+    """Versão asyncio do SyncService: rodadas coalescidas como tarefas
+
+    Pedidos feitos enquanto uma rodada está pendente compartilham o mesmo
+    future. Os handlers continuam síncronos: quem precisa esperar a rodada
+    (mensagem para usuário desconhecido, publicação em canal desconhecido)
+    espera antes, em AsyncRuntime.dispatch, e sync_once aqui não bloqueia.
+    """
+
+    def __init__(self, runtime, interval=30, initial_delay=15, min_gap=1.0):
+        self.runtime = runtime
+        self.interval = interval
+        self.initial_delay = initial_delay
+        self.min_gap = min_gap
+        self.pending = None
+        self.wakeup = None
+
+    def request(self):
+        """Agenda a próxima rodada (pode ser chamado de qualquer thread)"""
+        loop = self.runtime.loop
+        if loop is not None:
+            loop.call_soon_threadsafe(self._next_round)
+
+    def sync_once(self, timeout):
+        self.request()
+        return False
+
+    def _next_round(self):
+        if self.pending is None:
+            self.pending = self.runtime.loop.create_future()
+            self.wakeup.set()
+        return self.pending
+
+    async def wait_round(self, timeout):
+        """Espera a próxima rodada terminar por no máximo 'timeout' segundos"""
+        try:
+            await asyncio.wait_for(asyncio.shield(self._next_round()), timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+
+    async def run(self):
+        self.wakeup = asyncio.Event()
+        await asyncio.sleep(self.initial_delay)  # Espera inicial para os servidores se conectarem
+
+        while True:
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), self.interval)
+            except asyncio.TimeoutError:
+                pass
+            self.wakeup.clear()
+
+            current = self.pending
+            self.pending = None
+            try:
+                await self.runtime.sync_from_other_servers()
+            except Exception as e:
+                print(f"[SERVER-{self.runtime.server.server_id}] Erro na sincronização periódica: {e}", flush=True)
+            finally:
+                if current is not None and not current.done():
+                    current.set_result(True)
+
+            # Evita rodadas seguidas quando há muitos pedidos
+            await asyncio.sleep(self.min_gap)
+
+
+class AsyncRuntime:
+    """Executa o servidor em um único event loop (zmq.asyncio)
+
+    Heartbeat, replicação, monitor do coordenador, sincronização periódica
+    e o atendimento das requisições viram tarefas do mesmo loop. Chamadas
+    a vários servidores (eleição, Berkeley, sincronização) são feitas em
+    paralelo com asyncio.gather e cada uma tem seu timeout.
+    """
+
+    def __init__(self, server):
+        self.server = server
+        self.loop = None
+        self.ctx = None
+        self.pending_spawns = []
+        self.sync = AsyncSyncService(self)
+
+    def spawn(self, coroutine_fn):
+        """Agenda uma corrotina no loop (pode ser chamado de qualquer thread)"""
+        if self.loop is None:
+            self.pending_spawns.append(coroutine_fn)
+        else:
+            self.loop.call_soon_threadsafe(lambda: self.loop.create_task(coroutine_fn()))
+
+    def run(self):
+        asyncio.run(self.main())
+
+    async def main(self):
+        server = self.server
+        self.loop = asyncio.get_running_loop()
+        self.ctx = zmq.asyncio.Context.shadow(server.context.underlying)
+
+        # Os sockets criados no __init__ passam a ser usados pelo loop
+        self.sub = zmq.asyncio.Socket.from_socket(server.sub_socket)
+        self.ref = zmq.asyncio.Socket.from_socket(server.ref_socket)
+
+        self.frontend = self.ctx.socket(zmq.ROUTER)
+        self.frontend.setsockopt(zmq.ROUTING_ID, server.broker_identity())
+        self.frontend.connect("tcp://broker:5556")  # ✅ Conecta ao broker
+        
+        self.peer_socket = self.ctx.socket(zmq.ROUTER)
+        self.peer_socket.bind(f"tcp://*:{server.port}")
+
+        for coroutine_fn in self.pending_spawns:
+            self.loop.create_task(coroutine_fn())
+        self.pending_spawns = []
+
+        print(f"[SERVER-{server.server_id}] Aguardando requisições (runtime asyncio)...", flush=True)
+
+        await asyncio.gather(
+            self.serve_requests(self.frontend),
+            self.serve_requests(self.peer_socket),
+            self.send_heartbeat(),
+            self.receive_replications(),
+            self.monitor_coordinator(),
+            self.sync.run(),
+            self.periodic_compaction()
+        )
+
+    # ========== REQUISIÇÕES ==========
+
+    async def serve_requests(self, sock):
+        """Atende um ROUTER (broker ou outros servidores), uma tarefa por requisição"""
+        while True:
+            frames = await sock.recv_multipart()
+            self.loop.create_task(self.dispatch(sock, frames))
+
+    async def dispatch(self, sock, frames):
+        """Processa uma requisição; o envelope do ROUTER volta na resposta"""
+        server = self.server
+        envelope, body = frames[:-1], frames[-1]
+        try:
+            data = msgpack.unpackb(body)
+            target = server.forward_target(data)
+            if target is not None:
+                # Outro servidor é dono da partição: encaminha sem bloquear o loop
+                response = await self.call(target, server.forward_payload(data), server.forward_timeout)
+                if response is not None:
+                    await sock.send_multipart(envelope + [msgpack.packb(response)])
+                    return
+                server.forward_failed(target)
+                print(f"[SERVER-{server.server_id}] Encaminhamento para {target['server_id']} falhou, "
+                      f"atendendo localmente")
+            if server.waits_for_history(data.get('service')):
+                await self.history_loaded()
+            if self.needs_sync(data):
+                await self.sync.wait_round(server.sync_wait_timeout)
+            response = server.handle_request(data, forward=False)
+        except Exception as e:
+            print(f"[SERVER-{server.server_id}] Erro: {e}")
+            response = {
+                'status': 'error',
+                'message': str(e),
+                'lamport_clock': server.increment_clock()
+            }
+        await sock.send_multipart(envelope + [msgpack.packb(response)])
+
+    async def history_loaded(self):
+        """Espera o carregamento do histórico sem bloquear o loop"""
+        if not self.server.history_ready.is_set():
+            await self.loop.run_in_executor(None, self.server.history_ready.wait)
+
+    def needs_sync(self, data):
+        """Mensagem ou publicação para um destino ainda desconhecido"""
+        service = data.get('service')
+        service_data = data.get('data') or {}
+        if service == 'message':
+            return service_data.get('dst') not in self.server.users
+        if service == 'publish':
+            return service_data.get('channel') not in self.server.channels
+        return False
+
+    # ========== CHAMADAS A OUTROS SERVIDORES ==========
+
+    async def call(self, peer, payload, timeout):
+        """Requisição a outro servidor pelo PeerPool; retorna None em caso de timeout/erro"""
+        try:
+            return await asyncio.wrap_future(self.server.request_peer(peer, payload, timeout))
+        except PeerError:
+            return None
+
+    async def synchronize_clocks_berkeley(self):
+        """Berkeley com coleta e envio de ajustes em paralelo"""
+        server = self.server
+        if not server.is_coordinator:
+            return
+
+        print(f"[SERVER-{server.server_id}] Iniciando sincronização de relógios (Berkeley)...")
+
+        peers = server.other_servers()
+
+        async def collect(peer):
+            sent_at = time.time()
+            response = await self.call(peer, {
+                'service': 'clock',
+                'lamport_clock': server.increment_clock()
+            }, 2.0)
+            if response is None:
+                print(f"[SERVER-{server.server_id}] Erro ao coletar tempo de {peer['server_id']}: timeout")
+                return None
+            return peer['server_id'], server.clock_reading(sent_at, time.time(), response)
+
+        readings = {server.server_id: (0.0, 0.0)}
+        for result in await asyncio.gather(*(collect(peer) for peer in peers)):
+            if result is not None:
+                readings[result[0]] = result[1]
+
+        adjustments = server.apply_berkeley_round(readings)
+
+        await asyncio.gather(*(
+            self.call(peer, {
+                'service': 'adjust_clock',
+                'adjustment': adjustments[peer['server_id']],
+                'lamport_clock': server.increment_clock()
+            }, 2.0)
+            for peer in peers if peer['server_id'] in adjustments
+        ))
+
+        print(f"[SERVER-{server.server_id}] Sincronização concluída. Offset: {server.clock_offset:.6f}s")
+
+    async def start_election(self):
+        """Bully com as mensagens ELECTION enviadas em paralelo"""
+        server = self.server
+        with server.election_lock:
+            if server.election_in_progress:
+                return
+            server.election_in_progress = True
+
+        print(f"[SERVER-{server.server_id}] 🗳️  INICIANDO ELEIÇÃO (Bully)...")
+
+        higher_servers = [s for s in server.other_servers() if s['server_id'] > server.server_id]
+
+        if not higher_servers:
+            print(f"[SERVER-{server.server_id}] Nenhum servidor com ID maior encontrado")
+            await self.become_coordinator()
+            return
+
+        responses = await asyncio.gather(*(
+            self.call(peer, {
+                'service': 'election',
+                'type': 'ELECTION',
+                'from': server.server_id,
+                'lamport_clock': server.increment_clock()
+            }, 1.5)
+            for peer in higher_servers
+        ))
+
+        if any(response is not None for response in responses):
+            print(f"[SERVER-{server.server_id}] Servidores superiores responderam, aguardando novo coordenador...")
+            await asyncio.sleep(3)
+
+            if server.coordinator_id is None or server.coordinator_id <= server.server_id:
+                await self.start_election()
+        else:
+            await self.become_coordinator()
+
+    async def become_coordinator(self):
+        server = self.server
+        print(f"[SERVER-{server.server_id}] 👑 ELEIÇÃO VENCIDA! Me tornei o COORDENADOR!")
+        server.is_coordinator = True
+        server.coordinator_id = server.server_id
+        server.election_in_progress = False
+        print(f"[SERVER-{server.server_id}] 📢 Anunciando coordenação para outros servidores...")
+
+        await asyncio.gather(*(
+            self.call(peer, {
+                'service': 'election',
+                'type': 'COORDINATOR',
+                'coordinator_id': server.server_id,
+                'lamport_clock': server.increment_clock()
+            }, 1.0)
+            for peer in server.other_servers()
+        ))
+
+    async def sync_from_other_servers(self):
+        """Sincroniza com todos os servidores ao mesmo tempo"""
+        server = self.server
+        peers = server.other_servers()
+        if not peers or not server.history_ready.is_set():
+            return
+
+        results = await asyncio.gather(*(self.sync_with_peer(peer) for peer in peers))
+        synced = sum(results)
+        if synced > 0:
+            print(f"[SERVER-{server.server_id}] Sincronizados: {synced} eventos")
+
+    async def sync_with_peer(self, peer):
+        """Executa Server.sync_protocol sobre chamadas assíncronas"""
+        server = self.server
+        protocol = server.sync_protocol(peer['server_id'])
+        try:
+            service, data = next(protocol)
+            while True:
+                response = await self.call(peer, server.peer_payload(service, data), 2.0)
+                if response is None:
+                    protocol.close()
+                    return 0
+                page = response.get('data', {})
+                server.update_clock(page.get('clock', 0))
+                service, data = protocol.send(page)
+        except StopIteration as stop:
+            return stop.value or 0
+
+    # ========== TAREFAS PERIÓDICAS ==========
+
+    async def send_heartbeat(self):
+        server = self.server
+        while True:
+            await asyncio.sleep(3)
+            try:
+                await self.ref.send(msgpack.packb(server.heartbeat_request()))
+                response = msgpack.unpackb(await asyncio.wait_for(self.ref.recv(), 5.0))
+                server.process_heartbeat(response)
+            except asyncio.TimeoutError:
+                # O REQ fica inutilizável após um timeout: recria o socket
+                print(f"[SERVER-{server.server_id}] Erro no heartbeat: timeout")
+                self.ref.close(linger=0)
+                self.ref = self.ctx.socket(zmq.REQ)
+                self.ref.connect("tcp://reference:5559")
+            except Exception as e:
+                print(f"[SERVER-{server.server_id}] Erro no heartbeat: {e}")
+
+    async def receive_replications(self):
+        server = self.server
+        await self.history_loaded()
+        while True:
+            try:
+                server.update_replication_subscriptions(self.sub)
+                if await self.sub.poll(1000):
+                    server.handle_replication_frames(await self.sub.recv_multipart())
+            except Exception as e:
+                print(f"[SERVER-{server.server_id}] Erro ao receber replicação: {e}")
+
+    async def monitor_coordinator(self):
+        while True:
+            await asyncio.sleep(5)
+            if self.server.coordinator_needs_election():
+                await self.start_election()
+
+    async def periodic_compaction(self):
+        """Snapshots e selagem rodam em uma thread do executor para não bloquear o loop"""
+        server = self.server
+        last_report = time.time()
+        while True:
+            await asyncio.sleep(10)
+            try:
+                await self.loop.run_in_executor(None, server.compact_storage)
+            except Exception as e:
+                print(f"[SERVER-{server.server_id}] Erro ao compactar log: {e}")
+
+            if time.time() - last_report >= server.dedup_report_interval:
+                server.report_dedup()
+                last_report = time.time()
@@ -0,0 +1,103 @@
+import hashlib
+import math
+import threading
+import time
+from collections import deque
+
+
+class BloomFilter:
+    """Filtro de Bloom de tamanho fixo (k posições por double hashing)"""
+
+    def __init__(self, capacity, error_rate):
+        self.capacity = capacity
+        self.size = max(8, int(-capacity * math.log(error_rate) / (math.log(2) ** 2)))
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+        self.bits_set = 0
+        self.count = 0
+        self.created_at = time.time()
+
+    def _positions(self, key):
+        digest = hashlib.blake2b(str(key).encode(), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'big')
+        h2 = int.from_bytes(digest[8:], 'big') | 1
+        return [(h1 + i * h2) % self.size for i in range(self.hashes)]
+
+    def add(self, key):
+        for position in self._positions(key):
+            byte, bit = divmod(position, 8)
+            if not self.bits[byte] & (1 << bit):
+                self.bits[byte] |= 1 << bit
+                self.bits_set += 1
+        self.count += 1
+
+    def __contains__(self, key):
+        for position in self._positions(key):
+            byte, bit = divmod(position, 8)
+            if not self.bits[byte] & (1 << bit):
+                return False
+        return True
+
+    def false_positive_rate(self):
+        """Estimativa atual: (fração de bits ligados) ^ k"""
+        return (self.bits_set / self.size) ** self.hashes
+
+
+class RotatingBloomFilter:
+    """Conjunto aproximado de ids com memória constante
+
+    Mantém 'generations' filtros de Bloom. Os ids entram no mais novo; quando
+    ele enche (capacity) ou fica mais velho que 'window' segundos, um filtro
+    novo entra e o mais antigo sai. Um id é considerado visto se estiver em
+    qualquer geração, então ele é lembrado por pelo menos uma geração inteira.
+    Não há falsos negativos dentro da janela; falsos positivos ocorrem com
+    a taxa informada por false_positive_rate().
+    """
+
+    def __init__(self, capacity=100000, error_rate=0.001, generations=2, window=24 * 3600):
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.window = window
+        self.generations = deque(maxlen=generations)
+        self.generations.append(BloomFilter(capacity, error_rate))
+        self.rotations = 0
+        self.lock = threading.Lock()
+
+    def add(self, key):
+        with self.lock:
+            current = self.generations[-1]
+            if current.count >= self.capacity or time.time() - current.created_at > self.window:
+                current = BloomFilter(self.capacity, self.error_rate)
+                self.generations.append(current)
+                self.rotations += 1
+            current.add(key)
+
+    def __contains__(self, key):
+        with self.lock:
+            return any(key in generation for generation in self.generations)
+
+    def clear(self):
+        with self.lock:
+            self.generations.clear()
+            self.generations.append(BloomFilter(self.capacity, self.error_rate))
+
+    def false_positive_rate(self):
+        """Probabilidade de um id nunca visto ser dado como visto"""
+        with self.lock:
+            miss = 1.0
+            for generation in self.generations:
+                miss *= 1 - generation.false_positive_rate()
+            return 1 - miss
+
+    def stats(self):
+        with self.lock:
+            items = sum(generation.count for generation in self.generations)
+            size = sum(len(generation.bits) for generation in self.generations)
+            generations = len(self.generations)
+        return {
+            'items': items,
+            'generations': generations,
+            'rotations': self.rotations,
+            'bytes': size,
+            'false_positive_rate': self.false_positive_rate()
+        }
@@ -0,0 +1,510 @@
+import bisect
+import heapq
+import itertools
+import os
+import threading
+from array import array
+
+from records import EventRecord, StoredRef, pack_id, unpack_id, id_key, time_key, unpack_time
+from retention import record_size
+from segments import (write_segment, open_segments, rewrite_segment, remove_segment, index_segment,
+                      write_dead)
+
+
+def sort_key(record):
+    """Chave de ordenação de um registro: (relógio de Lamport, id)"""
+    return (record.lamport or 0,) + id_key(record.id if record.id is not None else '')
+
+
+def parse_cursor(cursor):
+    """Converte um cursor ('lamport:id' ou só o lamport) em chave de ordenação"""
+    if cursor is None:
+        return None
+    if isinstance(cursor, int):
+        return (cursor,)
+    lamport, _, event_id = str(cursor).partition(':')
+    if not event_id:
+        return (int(lamport),)
+    return (int(lamport),) + id_key(pack_id(event_id))
+
+
+def format_cursor(key):
+    return f"{key[0]}:{unpack_id(key[2])}"
+
+
+def parse_time_cursor(cursor):
+    """'timestamp ISO' ou 'timestamp@lamport:id' (next_cursor de uma página por tempo)
+
+    Retorna (chave, exclusivo): um timestamp sozinho é um limite comum; o
+    cursor composto aponta para um evento e a página continua depois dele.
+    """
+    if isinstance(cursor, int):
+        return (cursor,), False
+    moment, _, event = str(cursor).partition('@')
+    if not event:
+        return (time_key(moment),), False
+    return (time_key(moment),) + parse_cursor(event), True
+
+
+def format_time_cursor(key):
+    return f"{unpack_time(key[0])}@{format_cursor(key[1:])}"
+
+
+class SortedIndex:
+    """Offsets de eventos ordenados por Lamport e por timestamp
+
+    Cada ordem são duas colunas array('q'): o primeiro campo da chave
+    (Lamport ou timestamp em µs) e o offset. O resto da chave - (lamport,
+    id) - só é lido do registro (record_at) quando o primeiro campo empata,
+    na inserção fora de ordem e na busca de um cursor.
+
+    O índice de um segmento frio usa as colunas gravadas no disco (via
+    mmap, só leitura) e pula os offsets em 'dead', descartados depois que o
+    segmento foi gravado.
+    """
+
+    def __init__(self, record_at, columns=None, dead=None):
+        self.record_at = record_at
+        if columns is None:
+            columns = [array('q') for _ in range(4)]
+        self.clocks, self.clock_offsets, self.times, self.time_offsets = columns
+        self.dead = dead
+
+    def columns(self):
+        return self.clocks, self.clock_offsets, self.times, self.time_offsets
+
+    def _clock_key(self, offset):
+        return sort_key(self.record_at(offset))
+
+    def _time_key(self, offset):
+        record = self.record_at(offset)
+        return (record.timestamp_key,) + sort_key(record)
+
+    def _order(self, use_time):
+        if use_time:
+            return self.times, self.time_offsets, self._time_key
+        return self.clocks, self.clock_offsets, self._clock_key
+
+    def add(self, record, offset):
+        self._insert(False, sort_key(record), offset)
+        # O desempate por (lamport, id) dá um cursor único entre eventos do mesmo instante
+        self._insert(True, (record.timestamp_key,) + sort_key(record), offset)
+
+    def _insert(self, use_time, key, offset):
+        column, offsets, full_key = self._order(use_time)
+        # Caso comum: eventos chegam em ordem crescente, a inserção vira append
+        if not column or column[-1] < key[0] or (column[-1] == key[0] and full_key(offsets[-1]) <= key):
+            column.append(key[0])
+            offsets.append(offset)
+            return
+        position = self._position(use_time, key, True)
+        column.insert(position, key[0])
+        offsets.insert(position, offset)
+
+    def _position(self, use_time, key, right=False):
+        """Posição de uma chave (completa ou só o começo) numa das ordens
+
+        right: depois de todas as entradas que começam com 'key'.
+        """
+        column, offsets, full_key = self._order(use_time)
+        lo = bisect.bisect_left(column, key[0])
+        hi = bisect.bisect_right(column, key[0], lo)
+        if len(key) == 1 or lo == hi:
+            return hi if right else lo
+        ties = [full_key(offsets[i]) for i in range(lo, hi)]
+        return lo + bisect.bisect_left(ties, key + (float('inf'),) if right else key)
+
+    def range(self, use_time, low=None, exclusive=False, high=None):
+        """Faixa [início, fim) de uma ordem entre dois cursores"""
+        start = 0 if low is None else self._position(use_time, low, exclusive)
+        end = len(self.clocks) if high is None else self._position(use_time, high)
+        return start, end
+
+    def entries(self, use_time, start, end, reverse=False):
+        """Entradas (IndexEntry) de uma faixa, em ordem crescente ou decrescente"""
+        column, offsets, full_key = self._order(use_time)
+        positions = range(end - 1, start - 1, -1) if reverse else range(start, end)
+        dead = self.dead
+        for i in positions:
+            if not dead or offsets[i] not in dead:
+                yield IndexEntry(column[i], offsets[i], full_key)
+
+    def discard(self, offsets):
+        """Remove os offsets dados (conjunto) das duas ordens"""
+        self.keep(lambda offset: offset not in offsets)
+
+    def keep(self, keep):
+        """Mantém só os offsets para os quais keep(offset) é verdadeiro"""
+        for use_time in (False, True):
+            column, offsets, _ = self._order(use_time)
+            positions = [i for i, offset in enumerate(offsets) if keep(offset)]
+            column = array('q', (column[i] for i in positions))
+            offsets = array('q', (offsets[i] for i in positions))
+            if use_time:
+                self.times, self.time_offsets = column, offsets
+            else:
+                self.clocks, self.clock_offsets = column, offsets
+
+    def __len__(self):
+        if self.dead:
+            return sum(offset not in self.dead for offset in self.clock_offsets)
+        return len(self.clocks)
+
+
+class IndexEntry:
+    """Entrada de uma ordem: compara pelo primeiro campo e só no empate lê o registro"""
+
+    __slots__ = ('first', 'offset', 'full_key')
+
+    def __init__(self, first, offset, full_key):
+        self.first = first
+        self.offset = offset
+        self.full_key = full_key
+
+    def key(self):
+        return self.full_key(self.offset)
+
+    def __lt__(self, other):
+        if self.first != other.first:
+            return self.first < other.first
+        return self.key() < other.key()
+
+
+class IndexView:
+    """Um índice lógico sobre uma ou mais ordens (SortedIndex) intercaladas"""
+
+    def __init__(self, runs):
+        self.runs = runs
+
+    def __len__(self):
+        return sum(len(run) for run in self.runs)
+
+    def _merged(self, use_time, bounds=None, reverse=False):
+        streams = []
+        for run in self.runs:
+            start, end = run.range(use_time, *(bounds or ()))
+            streams.append(run.entries(use_time, start, end, reverse))
+        return heapq.merge(*streams, reverse=reverse)
+
+    def clock_order(self, reverse=False):
+        """Offsets em ordem de (lamport, id)"""
+        return (entry.offset for entry in self._merged(False, reverse=reverse))
+
+    def time_order(self):
+        """(timestamp em µs, offset) em ordem de tempo"""
+        return ((entry.first, entry.offset) for entry in self._merged(True))
+
+    def page(self, limit=None, before=None, after=None, since=None, until=None):
+        """Retorna (offsets, has_more, próximo cursor) em O(log n + k) por ordem
+
+        Com 'after' (ou 'since') a página avança a partir do cursor; caso
+        contrário devolve os eventos mais recentes anteriores a 'before'
+        (ou 'until'). Cursores de Lamport têm precedência sobre o tempo.
+        since/until vêm de parse_time_cursor: um cursor composto (next_cursor
+        de uma página por tempo) é exclusivo nas duas direções.
+        """
+        since, since_exclusive = since if since is not None else (None, False)
+        until = until[0] if until is not None else None
+        use_time = (since is not None or until is not None) and before is None and after is None
+
+        if use_time:
+            forward = since is not None
+            bounds = (since, since_exclusive, until)
+        else:
+            forward = after is not None
+            bounds = (after, True, before)
+
+        merged = self._merged(use_time, bounds, reverse=not forward)
+        selected = list(merged if limit is None else itertools.islice(merged, limit + 1))
+        has_more = limit is not None and len(selected) > limit
+        if has_more:
+            selected = selected[:limit]
+        if not forward:
+            selected.reverse()
+
+        offsets = [entry.offset for entry in selected]
+
+        next_cursor = None
+        if has_more and selected:
+            edge = (selected[-1] if forward else selected[0]).key()
+            # Intervalos de tempo continuam por 'timestamp@lamport:id' (since/until)
+            next_cursor = format_time_cursor(edge) if use_time else format_cursor(edge)
+        return offsets, has_more, next_cursor
+
+
+class HistoryStore:
+    """Histórico de eventos (mensagens ou publicações) com índices secundários
+
+    Os eventos ficam em uma lista append-only e cada valor dos campos em
+    key_fields (canal, remetente, destinatário) aponta para um índice
+    ordenado dos seus offsets. Assim uma consulta custa O(log n + k) e não
+    O(histórico). Internamente os eventos são EventRecord; as consultas
+    devolvem dicts no formato de rede.
+
+    Com 'directory', o histórico tem duas camadas: os hot_limit eventos mais
+    recentes ficam em memória e os mais antigos são selados em segmentos
+    imutáveis (ColdSegment) lidos via mmap. Só a camada quente é indexada
+    em memória; cada segmento grava os próprios índices (global e por
+    chave) e as consultas intercalam as ordens das duas camadas.
+
+    Eventos descartados pela retenção saem dos índices; na camada quente
+    viram None e nos segmentos frios quadros vazios, regravados quando a
+    fração descartada passa de rewrite_ratio. Abaixo disso os offsets
+    descartados vão para o .dead do segmento antes de remove() retornar.
+    """
+
+    def __init__(self, key_fields, directory=None, hot_limit=50000, rewrite_ratio=0.25):
+        self.key_fields = key_fields
+        self.directory = directory
+        self.hot_limit = hot_limit
+        self.rewrite_ratio = rewrite_ratio
+        self.base = 0        # offset do primeiro evento em memória
+        self.events = []     # camada quente
+        self.segments = []   # camada fria, em ordem de offset
+        self.segment_starts = []
+        self.index = {}
+        self.order = SortedIndex(self._get)  # índice global, usado pela sincronização
+        self.lock = threading.Lock()
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+    def __len__(self):
+        return self.base + len(self.events)
+
+    def __iter__(self):
+        return iter(self.all())
+
+    def keys_of(self, event):
+        """Chaves de índice de um evento (sem repetição)"""
+        keys = []
+        for field in self.key_fields:
+            key = event.get(field)
+            if key is not None and key not in keys:
+                keys.append(key)
+        return keys
+
+    def append(self, event):
+        record = EventRecord.from_event(event)
+        with self.lock:
+            offset = self.base + len(self.events)
+            self.events.append(record)
+            self._index(record, offset)
+            return offset
+
+    def _index(self, record, offset):
+        self.order.add(record, offset)
+        for key in self.keys_of(record):
+            if key not in self.index:
+                self.index[key] = SortedIndex(self._get)
+            self.index[key].add(record, offset)
+
+    def get(self, offset):
+        """Registro de um offset, da memória ou do segmento frio"""
+        with self.lock:
+            return self._get(offset)
+
+    def _get(self, offset):
+        if offset >= self.base:
+            return self.events[offset - self.base]
+        return self._segment_of(offset).get(offset)
+
+    def _segment_of(self, offset):
+        return self.segments[bisect.bisect_right(self.segment_starts, offset) - 1]
+
+    def keys(self):
+        with self.lock:
+            keys = set(self.index)
+            for segment in self.segments:
+                keys.update(segment.keys())
+            return list(keys)
+
+    def _view(self, key=None):
+        """Índice de uma chave (ou global, key=None) nas duas camadas"""
+        runs = []
+        for segment in self.segments:
+            columns = segment.index_columns(key)
+            if columns is not None:
+                runs.append(SortedIndex(segment.read, columns, segment.dead))
+        hot = self.order if key is None else self.index.get(key)
+        if hot is not None:
+            runs.append(hot)
+        return IndexView(runs)
+
+    def _segment_indexes(self, first, records):
+        """Colunas dos índices (global e por chave) de um segmento a gravar"""
+        record_at = lambda offset: records[offset - first]
+        indexes = {None: SortedIndex(record_at)}
+        for offset, record in enumerate(records, first):
+            if record is None:
+                continue
+            indexes[None].add(record, offset)
+            for key in self.keys_of(record):
+                if key not in indexes:
+                    indexes[key] = SortedIndex(record_at)
+                indexes[key].add(record, offset)
+        return {key: index.columns() for key, index in indexes.items()}
+
+    def expired(self, policy, key=None, now=None):
+        """Offsets que a política de retenção descarta (de uma chave ou de tudo)"""
+        if not policy:
+            return set()
+        with self.lock:
+            return policy.expired(self._view(key), lambda offset: record_size(self._get(offset)), now)
+
+    def remove(self, offsets):
+        """Descarta eventos (retenção); retorna os registros removidos
+
+        Os índices e a camada quente mudam na hora. Nos segmentos frios os
+        offsets são anotados e gravados no .dead do segmento, ou o segmento é
+        regravado sem eles (fora do lock) quando acumula descartes
+        suficientes. A camada quente fica durável com o próximo snapshot.
+        """
+        offsets = set(offsets)
+        removed = []
+        touched = set()
+        with self.lock:
+            for offset in sorted(offsets):
+                record = self._get(offset)
+                if record is None:
+                    continue
+                removed.append(record)
+                if offset >= self.base:
+                    self.events[offset - self.base] = None
+                else:
+                    segment = self._segment_of(offset)
+                    segment.dead.add(offset)
+                    touched.add(segment)
+            dead = {segment: set(segment.dead) for segment in touched}
+
+            # Os índices dos segmentos frios não mudam: o 'dead' de cada um filtra
+            self.order.discard(offsets)
+            for key in {key for record in removed for key in self.keys_of(record)}:
+                if key not in self.index:
+                    continue
+                self.index[key].discard(offsets)
+                if not self.index[key]:
+                    del self.index[key]
+
+        for segment in sorted(touched, key=lambda segment: segment.first):
+            live = segment.live()
+            if live and len(segment.dead) < self.rewrite_ratio * (live + len(segment.dead)):
+                write_dead(segment, dead[segment])
+                continue
+            replacement = rewrite_segment(segment, self._segment_indexes)
+            with self.lock:
+                position = self.segments.index(segment)
+                self.segments[position] = replacement
+            remove_segment(segment)
+        return removed
+
+    def ref(self, offset):
+        return StoredRef(self, offset)
+
+    def reset(self, events, sealed=0):
+        """Substitui todo o histórico e reconstrói os índices da camada quente
+
+        Os segmentos frios são reabertos do disco com os índices deles (sem
+        ler os registros) e 'events' é a camada quente do snapshot (dicts ou
+        linhas compactas), que começava no offset 'sealed'. Eventos que
+        foram selados depois do snapshot já estão nos segmentos e são
+        pulados.
+        """
+        with self.lock:
+            for segment in self.segments:
+                segment.close()
+            self.segments = open_segments(self.directory) if self.directory else []
+            # Segmentos gravados antes dos índices em disco: indexados uma vez
+            self.segments = [segment if segment.indexed else
+                             index_segment(segment, self._segment_indexes(segment.first, self._records(segment)))
+                             for segment in self.segments]
+            self.segment_starts = [segment.first for segment in self.segments]
+            self.base = self.segments[-1].end if self.segments else 0
+            self.events = []
+            self.index = {}
+            self.order = SortedIndex(self._get)
+
+        skip = max(0, self.base - sealed)
+        for event in events[skip:]:
+            if event is None:  # descartado pela retenção
+                with self.lock:
+                    self.events.append(None)
+            else:
+                self.append(event)
+
+    @staticmethod
+    def _records(segment):
+        records = [None] * segment.count
+        for offset, record in segment.scan():
+            records[offset - segment.first] = record
+        return records
+
+    def seal(self):
+        """Sela os eventos quentes além de hot_limit em um novo segmento
+
+        Chamado só pela thread de compactação. A gravação acontece fora do
+        lock; consultas continuam lendo esses eventos da memória até a troca.
+        Para o número de segmentos (e de ordens intercaladas por consulta)
+        não crescer a cada compactação, só sela a partir de hot_limit / 10
+        eventos excedentes.
+        """
+        if not self.directory:
+            return 0
+        with self.lock:
+            count = len(self.events) - self.hot_limit
+            if count <= 0 or count < self.hot_limit // 10:
+                return 0
+            first = self.base
+            records = self.events[:count]
+
+        segment = write_segment(self.directory, first, records, indexes=self._segment_indexes(first, records))
+
+        with self.lock:
+            self.segments.append(segment)
+            self.segment_starts.append(segment.first)
+            self.events = self.events[count:]
+            self.base += count
+            # Os eventos selados saem dos índices em memória (o segmento tem os dele)
+            base = self.base
+            self.order.keep(lambda offset: offset >= base)
+            for key in list(self.index):
+                self.index[key].keep(lambda offset: offset >= base)
+                if not self.index[key]:
+                    del self.index[key]
+        return count
+
+    def find(self, key):
+        """Eventos de uma chave, em ordem de Lamport"""
+        return self.query(key)[0]
+
+    def query(self, key=None, limit=None, before=None, after=None, since=None, until=None):
+        """Página de eventos de uma chave (ou de todo o histórico se key=None)
+
+        Retorna (eventos, has_more, next_cursor).
+        """
+        with self.lock:
+            offsets, has_more, next_cursor = self._view(key).page(
+                limit, parse_cursor(before), parse_cursor(after),
+                None if since is None else parse_time_cursor(since),
+                None if until is None else parse_time_cursor(until))
+            records = [self._get(offset) for offset in offsets]
+        return [record.to_event() for record in records], has_more, next_cursor
+
+    def all(self):
+        """Todos os eventos no formato de rede"""
+        return [record.to_event() for _, record in self.scan()]
+
+    def hot_state(self):
+        """(offset inicial, registros quentes) para snapshots"""
+        with self.lock:
+            return self.base, list(self.events)
+
+    def scan(self, start=0):
+        """(offset, registro) de todo o histórico, frio e quente, a partir de 'start'"""
+        with self.lock:
+            segments, base, records = list(self.segments), self.base, list(self.events)
+        for segment in segments:
+            if segment.end > start:
+                yield from ((offset, record) for offset, record in segment.scan() if offset >= start)
+        for i, record in enumerate(records[max(0, start - base):], max(start, base)):
+            if record is not None:
+                yield i, record
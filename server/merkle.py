@@ -0,0 +1,118 @@
+import bisect
+import hashlib
+import threading
+
+from records import pack_id, unpack_id, to_wire
+
+# 256 folhas (primeiro byte do hash do id) agrupadas em 16 subárvores
+LEAVES = 256
+FANOUT = 16
+
+
+def id_hash(event_id):
+    return hashlib.sha256(str(event_id).encode()).digest()
+
+
+def xor_bytes(a, b):
+    return (int.from_bytes(a, 'big') ^ int.from_bytes(b, 'big')).to_bytes(32, 'big')
+
+
+class MerkleTree:
+    """Árvore de Merkle de dois níveis sobre os ids dos eventos
+
+    Cada folha é o XOR dos hashes dos ids que caem nela, então inserir ou
+    remover um evento custa O(1). Os nós internos (16 subárvores e a raiz)
+    são recalculados sob demanda a partir das folhas. Cada folha guarda
+    também seus eventos, para que só os buckets divergentes sejam enviados.
+    """
+
+    def __init__(self):
+        self.leaves = [bytes(32)] * LEAVES
+        self.buckets = [{} for _ in range(LEAVES)]  # id compacto -> evento
+        self.lock = threading.Lock()
+
+    def add(self, event, stored=None):
+        """Inclui o evento; 'stored' (se dado) é o que fica guardado no bucket"""
+        event_id = event.get('id')
+        digest = id_hash(event_id)
+        bucket = digest[0]
+        key = pack_id(event_id)
+        with self.lock:
+            if key in self.buckets[bucket]:
+                return
+            self.buckets[bucket][key] = event if stored is None else stored
+            self.leaves[bucket] = xor_bytes(self.leaves[bucket], digest)
+
+    def remove(self, event_id):
+        digest = id_hash(event_id)
+        bucket = digest[0]
+        with self.lock:
+            if self.buckets[bucket].pop(pack_id(event_id), None) is None:
+                return
+            self.leaves[bucket] = xor_bytes(self.leaves[bucket], digest)
+
+    def __contains__(self, event_id):
+        bucket = id_hash(event_id)[0]
+        with self.lock:
+            return pack_id(event_id) in self.buckets[bucket]
+
+    def clear(self):
+        with self.lock:
+            self.leaves = [bytes(32)] * LEAVES
+            self.buckets = [{} for _ in range(LEAVES)]
+
+    def subtrees(self):
+        """Hashes das 16 subárvores (cada uma cobre 16 folhas)"""
+        with self.lock:
+            leaves = list(self.leaves)
+        return [
+            hashlib.sha256(b''.join(leaves[i:i + FANOUT])).digest()
+            for i in range(0, LEAVES, FANOUT)
+        ]
+
+    def digest(self):
+        """Raiz e subárvores - algumas centenas de bytes"""
+        subtrees = self.subtrees()
+        return {
+            'root': hashlib.sha256(b''.join(subtrees)).digest(),
+            'subtrees': subtrees
+        }
+
+    def leaf_hashes(self, subtree):
+        with self.lock:
+            return self.leaves[subtree * FANOUT:(subtree + 1) * FANOUT]
+
+    def ids_in(self, bucket, after=None):
+        """Ids do bucket em ordem (texto), só os depois do cursor 'after'"""
+        with self.lock:
+            keys = list(self.buckets[bucket])
+        ids = sorted(str(unpack_id(key)) for key in keys)
+        if after is not None:
+            ids = ids[bisect.bisect_right(ids, str(after)):]
+        return ids
+
+    def ids_after(self, buckets, after=None, limit=None):
+        """[bucket, id] dos buckets dados, em ordem, depois do cursor [bucket, id]
+
+        Para depois de limit + 1 entradas (o suficiente para saber se há mais).
+        """
+        entries = []
+        for bucket in sorted(set(buckets)):
+            if after is not None and bucket < after[0]:
+                continue
+            ids = self.ids_in(bucket, after[1] if after is not None and bucket == after[0] else None)
+            entries.extend([bucket, event_id] for event_id in ids)
+            if limit is not None and len(entries) > limit:
+                break
+        return entries
+
+    def events_for(self, event_ids):
+        """Eventos com os ids pedidos (formato de rede); o bucket vem do hash do id"""
+        with self.lock:
+            found = [self.buckets[id_hash(event_id)[0]].get(pack_id(event_id)) for event_id in event_ids]
+        return [to_wire(event) for event in found if event is not None]
+
+
+def differing(local, remote):
+    """Índices onde duas listas de hashes diferem"""
+    return [i for i, (a, b) in enumerate(zip(local, remote)) if a != b]
@@ -0,0 +1,92 @@
+import hashlib
+
+# Serviços roteados pelo dono da partição e a chave de cada um
+ROUTED_SERVICES = {
+    'publish': ('#', 'channel'),
+    'get_publications': ('#', 'channel'),
+    'message': ('@', 'dst'),
+    'get_messages': ('@', 'username'),
+}
+
+
+def partition_of(key, partitions):
+    """Partição de uma chave ('#canal' ou '@usuário'), igual em todos os nós"""
+    return int.from_bytes(hashlib.md5(str(key).encode()).digest()[:8], 'big') % partitions
+
+
+def event_keys(event):
+    """Chaves de partição de um evento do histórico
+
+    Publicações pertencem ao canal; mensagens privadas às caixas de entrada
+    dos dois usuários, para que get_messages responda só com dados locais.
+    """
+    if event.get('type') == 'publication':
+        return ['#' + str(event.get('channel'))]
+    if event.get('type') == 'message':
+        return ['@' + str(event.get('to')), '@' + str(event.get('from'))]
+    return []
+
+
+def request_key(service, data):
+    """Chave de partição de uma requisição de cliente, ou None se não é roteada"""
+    route = ROUTED_SERVICES.get(service)
+    if route is None:
+        return None
+    prefix, field = route
+    value = (data or {}).get(field)
+    return None if value is None else prefix + str(value)
+
+
+class PartitionMap:
+    """Mapa de partições publicado pelo reference server
+
+    'owners' tem, para cada partição, os servidores que a guardam (o
+    primeiro é o preferido para atender requisições). Sem mapa todo
+    servidor é dono de tudo, como na replicação completa.
+    """
+
+    def __init__(self, data=None):
+        data = data or {}
+        self.version = data.get('version', 0)
+        self.partitions = data.get('partitions', 0)
+        self.replication_factor = data.get('replication_factor', 0)
+        self.owners = [list(owners) for owners in data.get('owners') or []]
+
+    def __bool__(self):
+        return bool(self.owners)
+
+    def owners_of(self, key):
+        if not self.owners:
+            return []
+        return self.owners[partition_of(key, self.partitions)]
+
+    def owns(self, server_id, key):
+        return not self.owners or server_id in self.owners_of(key)
+
+    def owns_event(self, server_id, event):
+        """O servidor guarda o evento se é dono de alguma das suas chaves"""
+        keys = event_keys(event)
+        return not keys or any(self.owns(server_id, key) for key in keys)
+
+    def owned(self, server_id):
+        """Partições do servidor (todas, sem mapa)"""
+        if not self.owners:
+            return None
+        return {p for p, owners in enumerate(self.owners) if server_id in owners}
+
+    def partial(self, server_id):
+        """Indica se o servidor guarda só parte do histórico"""
+        return bool(self.owners) and any(server_id not in owners for owners in self.owners)
+
+    def covers(self, server_id, other_id):
+        """other_id guarda tudo o que server_id guarda"""
+        mine, theirs = self.owned(server_id), self.owned(other_id)
+        return mine is None or mine <= theirs
+
+    def to_dict(self):
+        return {
+            'version': self.version,
+            'partitions': self.partitions,
+            'replication_factor': self.replication_factor,
+            'owners': self.owners
+        }
@@ -0,0 +1,192 @@
+import heapq
+import itertools
+import threading
+import time
+from concurrent.futures import Future
+
+import msgpack
+import zmq
+
+
+class PeerError(Exception):
+    """Falha em uma requisição a outro servidor (timeout ou servidor em backoff)"""
+
+
+class PeerConnection:
+    """Conexão DEALER persistente com um servidor"""
+
+    def __init__(self, server_id, endpoint):
+        self.server_id = server_id
+        self.endpoint = endpoint
+        self.socket = None
+        self.failures = 0
+        self.retry_at = 0.0
+
+
+class PeerPool:
+    """Conexões persistentes com os outros servidores, indexadas por server_id
+
+    Cada servidor tem um socket DEALER ligado ao ROUTER dele (porta do
+    servidor). As requisições levam um id de 8 bytes que volta na resposta,
+    então várias requisições concorrentes compartilham a mesma conexão.
+    Todos os sockets ficam em uma única thread de I/O; os chamadores recebem
+    um Future, que funciona tanto nas threads quanto no runtime asyncio.
+
+    Quando um servidor não responde a tempo a conexão é descartada e novas
+    requisições a ele falham na hora até o fim do backoff (exponencial).
+    """
+
+    def __init__(self, context, name, backoff_min=0.5, backoff_max=10.0):
+        self.context = context
+        self.name = name
+        self.backoff_min = backoff_min
+        self.backoff_max = backoff_max
+        self.ids = itertools.count(1)
+        self.pending = {}   # request_id -> (future, server_id)
+        self.lock = threading.Lock()
+        self.peers = {}     # server_id -> PeerConnection (só a thread de I/O usa)
+        self.sockets = {}   # socket -> PeerConnection
+        self.deadlines = []  # heap de (prazo, request_id)
+
+        # Fila de requisições: os chamadores enviam pelo PUSH, a thread de I/O lê pelo PULL
+        self.control_endpoint = f"inproc://peer-pool-{id(self)}"
+        self.control = self.context.socket(zmq.PULL)
+        self.control.bind(self.control_endpoint)
+        self.submit_socket = self.context.socket(zmq.PUSH)
+        self.submit_socket.connect(self.control_endpoint)
+        self.submit_lock = threading.Lock()
+
+        self.poller = zmq.Poller()
+        self.poller.register(self.control, zmq.POLLIN)
+        threading.Thread(target=self._loop, daemon=True).start()
+
+    def request(self, server_id, endpoint, payload, timeout):
+        """Envia uma requisição e retorna um Future com a resposta já desempacotada"""
+        future = Future()
+        request_id = next(self.ids)
+        with self.lock:
+            self.pending[request_id] = (future, server_id)
+
+        frames = [
+            msgpack.packb([server_id, endpoint, request_id, timeout]),
+            msgpack.packb(payload)
+        ]
+        with self.submit_lock:
+            self.submit_socket.send_multipart(frames)
+        return future
+
+    def call(self, server_id, endpoint, payload, timeout):
+        """Versão bloqueante de request(); levanta PeerError em caso de falha"""
+        return self.request(server_id, endpoint, payload, timeout).result()
+
+    # ========== THREAD DE I/O ==========
+
+    def _loop(self):
+        while True:
+            try:
+                for sock, _ in self.poller.poll(self._poll_timeout()):
+                    if sock is self.control:
+                        self._drain_control()
+                    else:
+                        self._drain_replies(sock)
+                self._expire()
+            except Exception as e:
+                print(f"[{self.name}] Erro no pool de conexões: {e}", flush=True)
+
+    def _poll_timeout(self):
+        if not self.deadlines:
+            return None
+        return max(0, int((self.deadlines[0][0] - time.time()) * 1000) + 1)
+
+    def _drain_control(self):
+        while True:
+            try:
+                header, payload = self.control.recv_multipart(zmq.NOBLOCK)
+            except zmq.Again:
+                return
+            server_id, endpoint, request_id, timeout = msgpack.unpackb(header)
+            heapq.heappush(self.deadlines, (time.time() + timeout, request_id))
+            self._send(server_id, endpoint, request_id, payload)
+
+    def _send(self, server_id, endpoint, request_id, payload):
+        peer = self.peers.get(server_id)
+        if peer is None or peer.endpoint != endpoint:
+            if peer is not None:
+                self._disconnect(peer)
+            peer = self.peers[server_id] = PeerConnection(server_id, endpoint)
+
+        if time.time() < peer.retry_at:
+            self._resolve(request_id, error=PeerError(f"servidor {server_id} indisponível (backoff)"))
+            return
+
+        if peer.socket is None:
+            self._connect(peer)
+
+        try:
+            peer.socket.send_multipart([request_id.to_bytes(8, 'big'), payload], zmq.NOBLOCK)
+        except zmq.Again:
+            self._resolve(request_id, error=PeerError(f"fila cheia para o servidor {server_id}"))
+
+    def _drain_replies(self, sock):
+        peer = self.sockets.get(sock)
+        while peer is not None and peer.socket is sock:
+            try:
+                frames = sock.recv_multipart(zmq.NOBLOCK)
+            except zmq.Again:
+                return
+            if len(frames) != 2:
+                continue
+            peer.failures = 0
+            peer.retry_at = 0.0
+            # Respostas tardias (requisição já expirada) são descartadas
+            self._resolve(int.from_bytes(frames[0], 'big'), result=msgpack.unpackb(frames[1]))
+
+    def _expire(self):
+        now = time.time()
+        while self.deadlines and self.deadlines[0][0] <= now:
+            _, request_id = heapq.heappop(self.deadlines)
+            with self.lock:
+                entry = self.pending.get(request_id)
+            if entry is None:
+                continue
+            server_id = entry[1]
+            self._resolve(request_id, error=PeerError(f"servidor {server_id} não respondeu"))
+            peer = self.peers.get(server_id)
+            if peer is not None and peer.retry_at <= now:
+                self._mark_failed(peer)
+
+    def _mark_failed(self, peer):
+        """Descarta a conexão e agenda a reconexão com backoff exponencial"""
+        peer.failures += 1
+        backoff = min(self.backoff_max, self.backoff_min * 2 ** (peer.failures - 1))
+        peer.retry_at = time.time() + backoff
+        self._disconnect(peer)
+
+    def _resolve(self, request_id, result=None, error=None):
+        with self.lock:
+            entry = self.pending.pop(request_id, None)
+        if entry is None:
+            return
+        future = entry[0]
+        if error is not None:
+            future.set_exception(error)
+        else:
+            future.set_result(result)
+
+    def _connect(self, peer):
+        sock = self.context.socket(zmq.DEALER)
+        sock.setsockopt(zmq.LINGER, 0)
+        sock.setsockopt(zmq.RECONNECT_IVL, int(self.backoff_min * 1000))
+        sock.setsockopt(zmq.RECONNECT_IVL_MAX, int(self.backoff_max * 1000))
+        sock.connect(peer.endpoint)
+        peer.socket = sock
+        self.sockets[sock] = peer
+        self.poller.register(sock, zmq.POLLIN)
+
+    def _disconnect(self, peer):
+        if peer.socket is None:
+            return
+        self.poller.unregister(peer.socket)
+        self.sockets.pop(peer.socket, None)
+        peer.socket.close()
+        peer.socket = None
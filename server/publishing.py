@@ -0,0 +1,133 @@
+import threading
+import time
+
+import msgpack
+import zmq
+
+# Lotes saem no tópico BATCH_PREFIX + canal/usuário: quem se inscreve nesse
+# tópico sinaliza que sabe desempacotar {'batch': [...]}; os outros
+# continuam recebendo uma mensagem por publicação no tópico normal
+BATCH_PREFIX = 'batch:'
+
+
+def pack_publications(packed):
+    """{'batch': [...]} a partir de publicações já empacotadas"""
+    packer = msgpack.Packer()
+    return (packer.pack_map_header(1) + packer.pack('batch') +
+            packer.pack_array_header(len(packed)) + b''.join(packed))
+
+
+class PublishBatcher:
+    """Agrupa as publicações de cada tópico antes de enviar ao proxy
+
+    Cada tópico acumula publicações por até max_delay segundos (ou até
+    max_events / max_bytes) e sai em um único quadro no tópico de lote.
+
+    O socket é um XPUB e só a thread do batcher o usa: ela acompanha as
+    inscrições repassadas pelos proxies e envia cada forma só se alguém a
+    assina. A cópia avulsa (tópico normal, para clientes sem suporte a
+    lotes) sai na hora se houver inscrito nela; o lote, ao fim da janela,
+    se houver inscrito no tópico de lote.
+
+    As inscrições são por tópico: um proxy com clientes dos dois modos no
+    mesmo canal recebe as duas formas (limitação descrita no README).
+    """
+
+    def __init__(self, name, socket, max_delay=0.005, max_events=256, max_bytes=64 * 1024,
+                 report_interval=60):
+        self.name = name
+        self.socket = socket
+        self.max_delay = max_delay
+        self.max_events = max_events
+        self.max_bytes = max_bytes
+        self.subscriptions = set()  # prefixos assinados (XPUB não verboso: um por tópico)
+        self.immediate = []
+        self.pending = {}  # tópico -> [primeira em, publicações empacotadas, bytes]
+        self.cond = threading.Condition()
+        # Resumo periódico em vez de uma linha por lote
+        self.report_interval = report_interval
+        self.next_report = time.time() + report_interval
+        self.counters = {'batches': 0, 'batched': 0, 'plain': 0, 'skipped': 0}
+
+    def start(self):
+        threading.Thread(target=self._loop, daemon=True).start()
+
+    def publish(self, topic, data):
+        packed = msgpack.packb(data)
+        with self.cond:
+            self.immediate.append((topic, packed))
+            entry = self.pending.get(topic)
+            if entry is None:
+                entry = self.pending[topic] = [time.time(), [], 0]
+            entry[1].append(packed)
+            entry[2] += len(packed)
+            self.cond.notify()
+
+    def _full(self, entry):
+        return len(entry[1]) >= self.max_events or entry[2] >= self.max_bytes
+
+    def _take(self):
+        """Cópias avulsas e lotes vencidos ou cheios (vazio depois de 1 s parado)"""
+        with self.cond:
+            while True:
+                now = time.time()
+                ready = [topic for topic, entry in self.pending.items()
+                         if self._full(entry) or now >= entry[0] + self.max_delay]
+                if self.immediate or ready:
+                    immediate, self.immediate = self.immediate, []
+                    return immediate, [(topic, self.pending.pop(topic)[1]) for topic in ready]
+                timeout = 1.0
+                if self.pending:
+                    timeout = min(entry[0] for entry in self.pending.values()) + self.max_delay - now
+                if not self.cond.wait(timeout) and not self.pending:
+                    return [], []
+
+    def _read_subscriptions(self):
+        while True:
+            try:
+                message = self.socket.recv(zmq.NOBLOCK)
+            except zmq.Again:
+                return
+            if message[:1] == b'\x01':
+                self.subscriptions.add(message[1:])
+            elif message[:1] == b'\x00':
+                self.subscriptions.discard(message[1:])
+
+    def _subscribed(self, topic):
+        """Algum inscrito recebe o tópico (inscrições são prefixos)"""
+        return any(topic[:size] in self.subscriptions for size in range(len(topic) + 1))
+
+    def _loop(self):
+        while True:
+            immediate, batches = self._take()
+            self._read_subscriptions()
+            try:
+                for topic, packed in immediate:
+                    topic = topic.encode()
+                    if self._subscribed(topic):
+                        self.socket.send_multipart([topic, packed])
+                        self.counters['plain'] += 1
+                for topic, packed in batches:
+                    topic = (BATCH_PREFIX + topic).encode()
+                    if self._subscribed(topic):
+                        self.socket.send_multipart([topic, pack_publications(packed)])
+                        self.counters['batches'] += 1
+                        self.counters['batched'] += len(packed)
+                    else:
+                        self.counters['skipped'] += len(packed)
+            except Exception as e:
+                print(f"[{self.name}] Erro ao publicar no proxy: {e}")
+            self._report()
+
+    def _report(self):
+        now = time.time()
+        if now < self.next_report:
+            return
+        self.next_report = now + self.report_interval
+        counters = self.counters
+        if any(counters.values()):
+            average = counters['batched'] / counters['batches'] if counters['batches'] else 0
+            print(f"[{self.name}] Publicações: {counters['batches']} lotes ({average:.1f} por lote), "
+                  f"{counters['plain']} avulsas, {counters['skipped']} sem inscrito no tópico de lote "
+                  f"nos últimos {self.report_interval} s")
+        self.counters = dict.fromkeys(counters, 0)
@@ -0,0 +1,201 @@
+import sys
+import uuid
+from datetime import datetime, timedelta
+
+EPOCH = datetime(1970, 1, 1)
+MICROSECOND = timedelta(microseconds=1)
+
+
+def pack_id(value):
+    """UUID em texto -> 16 bytes; outros ids ficam como estão"""
+    if isinstance(value, str) and len(value) == 36:
+        try:
+            packed = uuid.UUID(value)
+        except ValueError:
+            return value
+        if str(packed) == value:
+            return packed.bytes
+    return value
+
+
+def unpack_id(value):
+    if isinstance(value, bytes):
+        return str(uuid.UUID(bytes=value))
+    return value
+
+
+def id_key(value):
+    """Chave de ordenação de um id compacto (bytes e str nunca são comparados)"""
+    return (isinstance(value, str), value)
+
+
+def time_key(value):
+    """Timestamp ISO (ou já compacto) -> microssegundos desde a época"""
+    if isinstance(value, int):
+        return value
+    if not isinstance(value, str):
+        raise ValueError(f"timestamp inválido: {value!r}")
+    moment = datetime.fromisoformat(value)
+    if moment.tzinfo is not None:
+        moment = moment.astimezone().replace(tzinfo=None)
+    return (moment - EPOCH) // MICROSECOND
+
+
+def pack_time(value):
+    """Timestamp ISO local -> int; formatos que não voltam iguais ficam em texto"""
+    if not isinstance(value, str):
+        return value
+    try:
+        packed = time_key(value)
+    except ValueError:
+        return value
+    return packed if unpack_time(packed) == value else value
+
+
+def unpack_time(value):
+    if isinstance(value, int):
+        return (EPOCH + value * MICROSECOND).isoformat()
+    return value
+
+
+def intern(value):
+    return sys.intern(value) if isinstance(value, str) else value
+
+
+class EventRecord:
+    """Mensagem ou publicação em memória, sem dict por evento
+
+    Nomes de usuário e canal são internados, o timestamp vira um int
+    (microssegundos) e o id UUID ocupa 16 bytes. O formato de rede (dict)
+    só é montado nas bordas, por to_event(). get() e [] aceitam as chaves
+    do dict para que índices e estruturas de sincronização tratem registros
+    e eventos da mesma forma.
+    """
+
+    __slots__ = ('id', 'type', 'sender', 'target', 'content', 'ts', 'lamport', 'origin', 'seq', 'extra')
+
+    CORE = ('id', 'type', 'from', 'to', 'channel', 'content', 'timestamp', 'lamport_clock', 'origin', 'seq')
+
+    def __init__(self, event):
+        self.id = pack_id(event.get('id'))
+        self.type = intern(event.get('type'))
+        self.sender = intern(event.get('from'))
+        self.target = intern(event.get(self.target_field()))
+        self.content = event.get('content')
+        self.ts = pack_time(event.get('timestamp'))
+        self.lamport = event.get('lamport_clock')
+        self.origin = event.get('origin')
+        self.seq = event.get('seq')
+
+        other = 'to' if self.target_field() == 'channel' else 'channel'
+        extra = {k: v for k, v in event.items() if k not in self.CORE or k == other}
+        self.extra = extra or None
+
+    @classmethod
+    def from_event(cls, event):
+        """Registro a partir de um dict de rede ou de uma linha (to_row)"""
+        if isinstance(event, cls):
+            return event
+        return cls.from_row(event) if isinstance(event, list) else cls(event)
+
+    def to_row(self):
+        """Linha compacta (lista) usada nos segmentos frios e nos snapshots"""
+        return [self.id, self.type, self.sender, self.target, self.content,
+                self.ts, self.lamport, self.origin, self.seq, self.extra]
+
+    @classmethod
+    def from_row(cls, row):
+        record = cls.__new__(cls)
+        (record.id, record.type, record.sender, record.target, record.content,
+         record.ts, record.lamport, record.origin, record.seq, record.extra) = row
+        record.type = intern(record.type)
+        record.sender = intern(record.sender)
+        record.target = intern(record.target)
+        return record
+
+    def target_field(self):
+        return 'channel' if self.type == 'publication' else 'to'
+
+    @property
+    def timestamp_key(self):
+        try:
+            return time_key(self.ts)
+        except ValueError:
+            return 0
+
+    def to_event(self):
+        event = {
+            'id': unpack_id(self.id),
+            'type': self.type,
+            'from': self.sender,
+            self.target_field(): self.target,
+            'content': self.content,
+            'timestamp': unpack_time(self.ts),
+            'lamport_clock': self.lamport
+        }
+        if self.origin is not None:
+            event['origin'] = self.origin
+        if self.seq is not None:
+            event['seq'] = self.seq
+        if self.extra:
+            event.update(self.extra)
+        return event
+
+    def get(self, key, default=None):
+        if key == 'id':
+            value = unpack_id(self.id)
+        elif key == 'type':
+            value = self.type
+        elif key == 'from':
+            value = self.sender
+        elif key == self.target_field():
+            value = self.target
+        elif key == 'content':
+            value = self.content
+        elif key == 'timestamp':
+            value = unpack_time(self.ts)
+        elif key == 'lamport_clock':
+            value = self.lamport
+        elif key == 'origin':
+            value = self.origin
+        elif key == 'seq':
+            value = self.seq
+        else:
+            value = (self.extra or {}).get(key)
+        return default if value is None else value
+
+    def __getitem__(self, key):
+        value = self.get(key)
+        if value is None:
+            raise KeyError(key)
+        return value
+
+
+class StoredRef:
+    """Referência a um evento do histórico (quente ou frio) por offset
+
+    O log de eventos e a árvore de Merkle guardam a referência e não o
+    registro, para que eventos selados em disco saiam da memória.
+    """
+
+    __slots__ = ('store', 'offset')
+
+    def __init__(self, store, offset):
+        self.store = store
+        self.offset = offset
+
+    def resolve(self):
+        return self.store.get(self.offset)
+
+    def get(self, key, default=None):
+        return self.resolve().get(key, default)
+
+    def __getitem__(self, key):
+        return self.resolve()[key]
+
+
+def to_wire(event):
+    """Evento no formato de rede (dict), seja ele registro, referência ou dict"""
+    if isinstance(event, StoredRef):
+        event = event.resolve()
+    return event.to_event() if isinstance(event, EventRecord) else event
@@ -0,0 +1,152 @@
+import threading
+import time
+from collections import deque
+
+import msgpack
+
+# Tópicos do PUB de replicação: eventos sem partição (logins, canais) vão
+# para todos; mensagens e publicações, para o tópico de cada partição delas.
+# Quem não é dono de uma partição recebe só (origem, seq) em SEQ_TOPIC, para
+# o vetor de versões não ficar com lacunas
+ALL_TOPIC = b'all'
+SEQ_TOPIC = b'seq'
+PARTITION_PREFIX = b'p:'
+
+
+def partition_topic(partition):
+    """Tópico da partição ('p:N:', para que p:1 não seja prefixo de p:10)"""
+    return PARTITION_PREFIX + str(partition).encode() + b':'
+
+
+def pack_batch(packed_events):
+    """Junta eventos já empacotados em um único array msgpack"""
+    return msgpack.Packer().pack_array_header(len(packed_events)) + b''.join(packed_events)
+
+
+def unpack_batch(message):
+    """Eventos de um quadro de replicação (lote ou evento avulso do formato antigo)"""
+    data = msgpack.unpackb(message)
+    return data if isinstance(data, list) else [data]
+
+
+class ReplicationBatcher:
+    """Agrupa eventos replicados em quadros maiores antes de publicar
+
+    Os handlers só enfileiram o evento; uma thread própria envia o lote
+    quando ele atinge max_events ou max_bytes, ou quando o evento mais
+    antigo já esperou max_delay segundos. Como só essa thread usa o socket
+    PUB, ele não é compartilhado entre os workers.
+
+    routes(evento) dá as partições do evento (None: vai para todos). O lote
+    sai em um quadro por tópico, precedido do resumo (origem, seq,
+    partições) dos eventos particionados; send recebe [tópico, quadro].
+    """
+
+    def __init__(self, name, send, routes=None, max_events=256, max_bytes=64 * 1024, max_delay=0.005):
+        self.name = name
+        self.send = send
+        self.routes = routes or (lambda event: None)
+        self.max_events = max_events
+        self.max_bytes = max_bytes
+        self.max_delay = max_delay
+        self.pending = []
+        self.pending_bytes = 0
+        self.first_at = 0.0
+        self.cond = threading.Condition()
+
+    def start(self):
+        threading.Thread(target=self._loop, daemon=True).start()
+
+    def add(self, event):
+        packed = msgpack.packb(event)
+        # Partições calculadas na hora, com o mapa atual
+        partitions = self.routes(event)
+        summary = None
+        if partitions is not None and event.get('seq') is not None:
+            summary = [event.get('origin'), event['seq'], partitions]
+        with self.cond:
+            if not self.pending:
+                self.first_at = time.time()
+            self.pending.append((packed, partitions, summary))
+            self.pending_bytes += len(packed)
+            if len(self.pending) == 1 or self._full():
+                self.cond.notify()
+
+    def _frames(self, batch):
+        """Quadros [tópico, lote] de um lote, o resumo de seqs primeiro"""
+        topics = {}
+        summaries = []
+        for packed, partitions, summary in batch:
+            if partitions is None:
+                topics.setdefault(ALL_TOPIC, []).append(packed)
+            else:
+                for partition in partitions:
+                    topics.setdefault(partition_topic(partition), []).append(packed)
+            if summary is not None:
+                summaries.append(summary)
+        frames = []
+        if summaries:
+            frames.append([SEQ_TOPIC, msgpack.packb(summaries)])
+        frames.extend([topic, pack_batch(packed)] for topic, packed in topics.items())
+        return frames
+
+    def _full(self):
+        return len(self.pending) >= self.max_events or self.pending_bytes >= self.max_bytes
+
+    def _loop(self):
+        while True:
+            with self.cond:
+                while not self.pending:
+                    self.cond.wait()
+                deadline = self.first_at + self.max_delay
+                while not self._full() and time.time() < deadline:
+                    self.cond.wait(deadline - time.time())
+                batch = self.pending[:self.max_events]
+                self.pending = self.pending[self.max_events:]
+                self.pending_bytes = sum(len(entry[0]) for entry in self.pending)
+                self.first_at = time.time()
+
+            try:
+                for frames in self._frames(batch):
+                    self.send(frames)
+                print(f"[{self.name}] Dados replicados: {len(batch)} evento(s)")
+            except Exception as e:
+                print(f"[{self.name}] Erro ao replicar: {e}")
+
+
+class ReplayRing:
+    """Últimos eventos publicados por este servidor, indexados por seq
+
+    Limitado a 'capacity' eventos: quem perdeu parte do stream de
+    replicação pede só o intervalo que falta. Se o intervalo já saiu do
+    anel a resposta vem marcada como truncada e o receptor recorre à
+    sincronização incremental.
+    """
+
+    def __init__(self, capacity=10000):
+        self.capacity = capacity
+        self.events = {}        # seq -> evento
+        self.order = deque()    # seqs na ordem de publicação
+        self.floor = None       # menor seq disponível (antes dela: outro processo ou já descartada)
+        self.lock = threading.Lock()
+
+    def add(self, event):
+        seq = event['seq']
+        with self.lock:
+            if seq in self.events:
+                return
+            self.events[seq] = event
+            self.order.append(seq)
+            if self.floor is None:
+                self.floor = seq
+            while len(self.order) > self.capacity:
+                evicted = self.order.popleft()
+                del self.events[evicted]
+                self.floor = max(self.floor, evicted + 1)
+
+    def range(self, first, last, limit):
+        """Eventos com first <= seq <= last (até 'limit'). Retorna (eventos, truncado)"""
+        last = min(last, first + limit - 1)
+        with self.lock:
+            events = [self.events[seq] for seq in range(first, last + 1) if seq in self.events]
+            return events, self.floor is None or first < self.floor
@@ -0,0 +1,112 @@
+import itertools
+from datetime import datetime, timedelta
+
+from records import time_key
+
+# Sufixos aceitos nos limites: idade em segundos, tamanho em bytes
+AGE_UNITS = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400}
+SIZE_UNITS = {'b': 1, 'k': 1024, 'm': 1024 ** 2, 'g': 1024 ** 3}
+
+
+def parse_amount(text, units):
+    text = str(text).strip().lower()
+    if text and text[-1] in units:
+        return int(float(text[:-1]) * units[text[-1]])
+    return int(text)
+
+
+def record_size(record):
+    """Bytes de conteúdo de um evento (o que max_bytes limita)"""
+    content = record.get('content')
+    if isinstance(content, str):
+        return len(content.encode())
+    return len(content) if isinstance(content, bytes) else 0
+
+
+class RetentionPolicy:
+    """Limites de retenção de um canal ou das mensagens privadas
+
+    max_age (segundos) vale pelo timestamp do evento; max_count e max_bytes
+    mantêm os eventos mais recentes pela ordem de Lamport. A política é
+    uma função só dos eventos, então réplicas com o mesmo histórico
+    descartam exatamente os mesmos eventos.
+    """
+
+    FIELDS = ('max_age', 'max_count', 'max_bytes')
+
+    def __init__(self, max_age=None, max_count=None, max_bytes=None):
+        for name, value in zip(self.FIELDS, (max_age, max_count, max_bytes)):
+            if value is not None and (not isinstance(value, (int, float)) or value <= 0):
+                raise ValueError(f"{name} inválido: {value!r}")
+        self.max_age = max_age
+        self.max_count = None if max_count is None else int(max_count)
+        self.max_bytes = None if max_bytes is None else int(max_bytes)
+
+    @classmethod
+    def from_dict(cls, data):
+        if not data:
+            return cls()
+        if not isinstance(data, dict) or set(data) - set(cls.FIELDS):
+            raise ValueError(f"política de retenção inválida: {data!r}")
+        return cls(**data)
+
+    @classmethod
+    def parse(cls, text):
+        """'max_age=7d,max_count=10000,max_bytes=50m' (formato das variáveis de ambiente)"""
+        limits = {}
+        for item in filter(None, (part.strip() for part in (text or '').split(','))):
+            name, _, value = item.partition('=')
+            name = name.strip()
+            if name == 'max_age':
+                limits[name] = parse_amount(value, AGE_UNITS)
+            elif name == 'max_bytes':
+                limits[name] = parse_amount(value, SIZE_UNITS)
+            elif name == 'max_count':
+                limits[name] = int(value)
+            else:
+                raise ValueError(f"limite de retenção desconhecido: {name!r}")
+        return cls(**limits)
+
+    def __bool__(self):
+        return any(getattr(self, name) is not None for name in self.FIELDS)
+
+    def to_dict(self):
+        return {name: getattr(self, name) for name in self.FIELDS if getattr(self, name) is not None}
+
+    def cutoff(self, now=None):
+        """Timestamp (µs, como SortedIndex.times) abaixo do qual o evento expirou
+
+        Os timestamps dos eventos são horários locais (datetime.now()), então
+        o corte também é.
+        """
+        if self.max_age is None:
+            return None
+        return time_key(((now or datetime.now()) - timedelta(seconds=self.max_age)).isoformat())
+
+    def expired(self, index, size_of, now=None):
+        """Offsets de um índice (history.IndexView) que a política manda descartar
+
+        size_of(offset) só é chamado com max_bytes, do evento mais novo para
+        o mais antigo, até o limite ser atingido.
+        """
+        dead = set()
+        cutoff = self.cutoff(now)
+        if cutoff is not None:
+            for moment, offset in index.time_order():
+                if moment >= cutoff:
+                    break
+                dead.add(offset)
+
+        count = len(index)
+        keep = count
+        if self.max_count is not None:
+            keep = min(keep, self.max_count)
+        if self.max_bytes is not None:
+            total = 0
+            for position, offset in enumerate(itertools.islice(index.clock_order(reverse=True), keep)):
+                total += size_of(offset)
+                if total > self.max_bytes:
+                    keep = position
+                    break
+        dead.update(itertools.islice(index.clock_order(), count - keep))
+        return dead
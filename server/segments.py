@@ -0,0 +1,273 @@
+import mmap
+import os
+import struct
+from array import array
+
+import msgpack
+
+from records import EventRecord
+
+FRAME = struct.Struct('>I')  # tamanho do registro
+SPARSE_EVERY = 64  # uma entrada do índice esparso a cada 64 registros
+
+
+class ColdSegment:
+    """Segmento selado (imutável) do histórico, lido via mmap
+
+    O arquivo .seg é uma sequência de [tamanho][linha msgpack] e o .idx
+    guarda a posição de um registro a cada SPARSE_EVERY. Ler um evento custa
+    no máximo SPARSE_EVERY saltos de cabeçalho e a decodificação de uma
+    única linha; o arquivo nunca é desserializado inteiro.
+
+    O .keys tem os índices do segmento (global e por chave), cada um em
+    quatro colunas int64 (Lamport, offset, timestamp, offset) lidas via
+    mmap; o .idx guarda só onde começa o índice de cada chave.
+
+    Eventos descartados pela retenção viram quadros vazios quando o
+    segmento é regravado (nova geração), e os offsets não mudam. Até lá os
+    offsets descartados ficam no .dead (int64), lido na abertura. Um
+    segmento sem nenhum evento vivo não tem quadros.
+    """
+
+    def __init__(self, path, meta):
+        self.path = path
+        self.first = meta['first']
+        self.count = meta['count']
+        self.positions = meta['positions']
+        self.generation = meta.get('generation', 0)
+        self.dead = set()  # descartados, ainda não regravados (persistidos no .dead)
+        dead_path = self.paths()[3]
+        if os.path.exists(dead_path):
+            with open(dead_path, 'rb') as f:
+                offsets = array('q')
+                offsets.frombytes(f.read())
+            self.dead.update(offsets)
+        self.file = open(path, 'rb')
+        self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ) if self.positions else None
+
+        # Índices em disco: chave (None = todos os eventos) -> (posição, quantidade)
+        self.indexed = 'keys' in meta
+        self.directory = {key: (position, count) for key, position, count in meta.get('keys') or []}
+        self.keys_file = self.keys_map = None
+        self.columns = memoryview(b'').cast('q')
+        keys_path = self.paths()[2]
+        if self.indexed and os.path.getsize(keys_path):
+            self.keys_file = open(keys_path, 'rb')
+            self.keys_map = mmap.mmap(self.keys_file.fileno(), 0, access=mmap.ACCESS_READ)
+            self.columns = memoryview(self.keys_map).cast('q')
+
+    @property
+    def end(self):
+        return self.first + self.count
+
+    def _frame_at(self, position):
+        (length,) = FRAME.unpack_from(self.map, position)
+        start = position + FRAME.size
+        return start, start + length
+
+    def _record(self, start, end):
+        return EventRecord.from_row(msgpack.unpackb(self.map[start:end])) if end > start else None
+
+    def get(self, offset):
+        """Registro do offset, ou None se ele foi descartado"""
+        if offset in self.dead:
+            return None
+        return self.read(offset)
+
+    def read(self, offset):
+        """Registro do offset, mesmo se descartado depois da gravação (desempate dos índices)"""
+        if not self.positions:
+            return None
+        index = offset - self.first
+        position = self.positions[index // SPARSE_EVERY]
+        for _ in range(index % SPARSE_EVERY):
+            position = self._frame_at(position)[1]
+        return self._record(*self._frame_at(position))
+
+    def rows(self):
+        """(offset, registro ou None) de todo o segmento, em ordem"""
+        if not self.positions:
+            return
+        position = 0
+        for offset in range(self.first, self.end):
+            start, end = self._frame_at(position)
+            yield offset, self._record(start, end)
+            position = end
+
+    def scan(self):
+        """(offset, registro) dos eventos vivos do segmento, em ordem"""
+        for offset, record in self.rows():
+            if record is not None and offset not in self.dead:
+                yield offset, record
+
+    def live(self):
+        """Quantos eventos do arquivo ainda não foram descartados (só lê os cabeçalhos)"""
+        count = 0
+        position = 0
+        for _ in range(self.count if self.positions else 0):
+            start, position = self._frame_at(position)
+            count += position > start
+        return count - len(self.dead)
+
+    def index_columns(self, key=None):
+        """Colunas do índice de uma chave (None: todos os eventos), ou None se ela não aparece aqui"""
+        entry = self.directory.get(key)
+        if entry is None:
+            return None
+        position, count = entry
+        return [self.columns[position + i * count:position + (i + 1) * count] for i in range(4)]
+
+    def keys(self):
+        return [key for key in self.directory if key is not None]
+
+    def paths(self):
+        return segment_paths(os.path.dirname(self.path), self.first, self.generation)
+
+    def close(self):
+        if self.map is not None:
+            self.map.close()
+        self.file.close()
+        if self.keys_map is not None:
+            self.columns.release()
+            try:
+                self.keys_map.close()
+            except BufferError:
+                pass  # Uma consulta ainda lê o índice; o mmap sai com a última referência
+            self.keys_file.close()
+
+
+def segment_paths(directory, first, generation=0):
+    """Arquivos de um segmento: 000000000000.seg, regravações 000000000000.1.seg ..."""
+    base = os.path.join(directory, f'{first:012d}' + (f'.{generation}' if generation else ''))
+    return base + '.seg', base + '.idx', base + '.keys', base + '.dead'
+
+
+def write_files(files):
+    """Grava (caminho, conteúdo) em .tmp, sincroniza e renomeia, na ordem dada"""
+    for path, payload in files:
+        with open(path + '.tmp', 'wb') as f:
+            f.write(payload)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(path + '.tmp', path)
+
+
+def pack_indexes(indexes):
+    """(diretório [chave, posição, quantidade], bytes do .keys) dos índices do segmento
+
+    'indexes' mapeia chave -> colunas array('q') (Lamport, offset, timestamp, offset).
+    """
+    directory = []
+    payload = []
+    position = 0
+    for key, columns in (indexes or {}).items():
+        count = len(columns[0])
+        directory.append([key, position, count])
+        payload.extend(column.tobytes() for column in columns)
+        position += 4 * count
+    return directory, b''.join(payload)
+
+
+def write_segment(directory, first, records, generation=0, indexes=None):
+    """Grava um segmento novo (dados, índices e .idx) e o abre via mmap
+
+    Os arquivos são gravados em .tmp, sincronizados e renomeados; o .idx
+    só aparece depois do .seg e do .keys completos, então um segmento sem
+    .idx é resto de uma gravação interrompida. None em 'records' é um
+    evento descartado (quadro vazio).
+    """
+    seg_path, idx_path, keys_path, _ = segment_paths(directory, first, generation)
+    positions = []
+    position = 0
+    frames = []
+    if any(record is not None for record in records):
+        for i, record in enumerate(records):
+            if i % SPARSE_EVERY == 0:
+                positions.append(position)
+            row = b'' if record is None else msgpack.packb(record.to_row())
+            frames.append(FRAME.pack(len(row)))
+            frames.append(row)
+            position += FRAME.size + len(row)
+
+    keys, keys_payload = pack_indexes(indexes)
+    meta = {'first': first, 'count': len(records), 'positions': positions, 'generation': generation,
+            'keys': keys}
+    write_files(((seg_path, b''.join(frames)), (keys_path, keys_payload), (idx_path, msgpack.packb(meta))))
+
+    return ColdSegment(seg_path, meta)
+
+
+def write_dead(segment, offsets):
+    """Grava os offsets descartados do segmento (todos, não só os novos)"""
+    write_files(((segment.paths()[3], array('q', sorted(offsets)).tobytes()),))
+
+
+def index_segment(segment, indexes):
+    """Grava os índices de um segmento antigo (sem .keys) e o reabre"""
+    _, idx_path, keys_path, _ = segment.paths()
+    keys, keys_payload = pack_indexes(indexes)
+    meta = {'first': segment.first, 'count': segment.count, 'positions': segment.positions,
+            'generation': segment.generation, 'keys': keys}
+    write_files(((keys_path, keys_payload), (idx_path, msgpack.packb(meta))))
+    segment.close()
+    return ColdSegment(segment.path, meta)
+
+
+def rewrite_segment(segment, indexes_of):
+    """Nova geração do segmento sem os eventos em segment.dead
+
+    indexes_of(first, records) dá os índices da nova geração. A geração
+    antiga continua válida até a nova estar completa em disco; quem chama
+    troca os segmentos e apaga os arquivos antigos.
+    """
+    records = [None if offset in segment.dead else record for offset, record in segment.rows()]
+    if not segment.positions:
+        records = [None] * segment.count
+    return write_segment(os.path.dirname(segment.path), segment.first, records, segment.generation + 1,
+                         indexes_of(segment.first, records))
+
+
+def remove_segment(segment):
+    """Apaga os arquivos de uma geração substituída
+
+    O mmap não é fechado aqui: uma varredura em andamento (scan) ainda pode
+    estar lendo o segmento, e ele é liberado quando a última referência sai.
+    """
+    remove_files(segment.paths())
+
+
+def remove_files(paths):
+    for path in paths:
+        if os.path.exists(path):
+            os.remove(path)
+
+
+def open_segments(directory):
+    """Abre os segmentos completos do diretório, em ordem de offset
+
+    De cada segmento fica só a geração mais nova com índice; gerações
+    antigas e gravações interrompidas são apagadas.
+    """
+    complete = {}
+    for name in os.listdir(directory):
+        if not name.endswith('.seg'):
+            continue
+        seg_path = os.path.join(directory, name)
+        first, _, generation = name[:-4].partition('.')
+        if not os.path.exists(seg_path[:-4] + '.idx'):
+            remove_files(segment_paths(directory, int(first), int(generation or 0)))
+            continue
+        complete.setdefault(int(first), []).append((int(generation or 0), seg_path))
+
+    segments = []
+    for first in sorted(complete):
+        generations = sorted(complete[first])
+        for generation, _ in generations[:-1]:
+            remove_files(segment_paths(directory, first, generation))
+        seg_path = generations[-1][1]
+        with open(seg_path[:-4] + '.idx', 'rb') as f:
+            meta = msgpack.unpackb(f.read())
+        if meta['count'] == 0:
+            continue
+        segments.append(ColdSegment(seg_path, meta))
+    return segments
@@ -6,15 +6,56 @@ import os
 from datetime import datetime, timedelta
 import uuid
 import threading
+import statistics
+from concurrent.futures import as_completed, ThreadPoolExecutor
+
+from wal import WriteAheadLog
+from history import HistoryStore
+from versions import VersionVector, EventLog
+from merkle import MerkleTree, FANOUT, differing
+from sync_service import SyncService
+from peers import PeerPool, PeerError
+from replication import (ReplicationBatcher, ReplayRing, unpack_batch, ALL_TOPIC, SEQ_TOPIC,
+                         PARTITION_PREFIX, partition_topic)
+from dedup import RotatingBloomFilter
+from records import time_key
+from retention import RetentionPolicy
+from partitions import PartitionMap, request_key, partition_of, event_keys
+from publishing import PublishBatcher
+
+# Serviços que dependem do histórico e esperam o carregamento em segundo plano
+HISTORY_SERVICES = {
+    'message', 'get_messages', 'publish', 'get_publications', 'sync_messages', 'sync_publications',
+    'sync_delta', 'merkle_digest', 'merkle_leaves', 'merkle_ids', 'merkle_fetch', 'partition_fetch'
+}
+
+
+# Coleção (seção do snapshot) alterada por cada tipo de evento
+EVENT_COLLECTIONS = {
+    'login': 'users',
+    'channel': 'channels',
+    'message': 'messages',
+    'publication': 'publications'
+}
+
+
+def is_history_record(record):
+    """Registro do log que altera o histórico de mensagens ou publicações"""
+    kinds = ('message', 'publication')
+    return (record.get('kind') in kinds + ('seen', 'adopt')
+            or record.get('data', {}).get('type') in kinds)
 
 class Server:
-    def __init__(self, server_id, port=5555, reference_port=5559, replication_port=5560):
+    def __init__(self, server_id, port=5555, reference_port=5559, replication_port=5560, workers=1,
+                 runtime='threads'):
         print(f"[INIT] Iniciando servidor {server_id}...", flush=True)
         self.context = zmq.Context()
         self.server_id = server_id
         self.port = port
         self.reference_port = reference_port
         self.replication_port = replication_port
+        self.workers = workers
+        self.runtime = runtime
         print(f"[INIT] Contexto ZMQ criado", flush=True)
         
         # Relógio lógico de Lamport
@@ -24,6 +65,8 @@ class Server:
         # Relógio físico para Berkeley
         self.physical_clock = time.time()
         self.clock_offset = 0.0
+        self.berkeley_max_rtt = 0.5   # Leituras mais lentas não entram na média
+        self.berkeley_max_skew = 1.0  # Distância máxima da mediana (segundos)
         
         # Controle de sincronização
         self.message_count = 0
@@ -35,12 +78,61 @@ class Server:
         self.election_in_progress = False
         self.election_lock = threading.Lock()
         
-        # Dados
+        # Dados (histórico antigo selado em segmentos mapeados em data/history/)
+        self.data_dir = os.environ.get('DATA_DIR', '/app/data')
         self.users = {}
         self.channels = {}
-        self.messages = []
-        self.publications = []
-        self.processed_ids = set()
+        self.messages = HistoryStore(('from', 'to'),  # índice usuário -> offsets
+                                     os.path.join(self.data_dir, 'history', 'messages'))
+        self.publications = HistoryStore(('channel',),  # índice canal -> offsets
+                                         os.path.join(self.data_dir, 'history', 'publications'))
+        self.max_page_size = 1000  # Limite de eventos por página nas consultas
+        # Ids de eventos sem origem/seq (formato antigo); os demais são
+        # deduplicados pelo vetor de versões. Memória constante.
+        self.seen_ids = RotatingBloomFilter()
+        self.dedup_report_interval = 600
+        # Retenção: padrão dos canais (cada canal pode definir a sua na criação)
+        # e das mensagens privadas. Aplicada pela compactação periódica
+        self.channel_retention = RetentionPolicy.parse(os.environ.get('RETENTION_CHANNELS'))
+        self.message_retention = RetentionPolicy.parse(os.environ.get('RETENTION_MESSAGES'))
+        # O histórico pode carregar em segundo plano depois do boot; até lá
+        # os serviços que dependem dele esperam por este evento
+        self.history_ready = threading.Event()
+        
+        # Particionamento: cada servidor guarda só os canais e caixas de
+        # entrada das partições que o reference server atribuiu a ele
+        self.partitions = PartitionMap()
+        self.rebalance_grace = 30  # Partições perdidas ainda ficam um tempo (novos donos copiando)
+        self.rebalance_at = None
+        self.pending_fetch = set()  # Partições ganhas ainda não copiadas dos outros servidores
+        # Encaminhamento ao dono: espera curta (o worker fica parado enquanto
+        # isso) e, depois de uma falha, o dono fica de fora por um tempo
+        self.forward_timeout = float(os.environ.get('FORWARD_TIMEOUT_MS', 500)) / 1000
+        self.forward_cooldown = 5
+        self.forward_failures = {}  # server_id -> até quando não encaminhar para ele
+        
+        # Protege users, channels, seen_ids e os índices quando há
+        # vários workers atendendo requisições ao mesmo tempo
+        self.data_lock = threading.RLock()
+        
+        # Sincronização incremental: (origem, seq) de cada evento replicável
+        self.versions = VersionVector()
+        self.event_log = EventLog()
+        self.merkle = MerkleTree()  # Digest para detectar divergência entre réplicas
+        self.local_seq = 0
+        self.seq_lock = threading.Lock()
+        self.sync_page_size = 500
+        
+        # Sincronização em segundo plano (fora do caminho das requisições)
+        self.sync_service = SyncService(f"SERVER-{server_id}", self.sync_from_other_servers)
+        self.sync_wait_timeout = 1.5  # Espera máxima por uma rodada "sync-once"
+        
+        # Runtime asyncio opcional: substitui as threads por tarefas em um event loop
+        self.async_runtime = None
+        if runtime == 'asyncio':
+            from async_runtime import AsyncRuntime
+            self.async_runtime = AsyncRuntime(self)
+            self.sync_service = self.async_runtime.sync
         
         # Dados dos servidores
         self.servers = {}
@@ -48,10 +140,14 @@ class Server:
         self.connected_servers = set()  # Track connected servers to avoid duplicates
         self.is_syncing = False  # Flag para evitar sincronização recursiva
         
-        # Sockets
-        self.socket = self.context.socket(zmq.REP)
-        self.socket.connect("tcp://broker:5556")  # ✅ Conecta ao broker
+        # Persistência: log append-only + snapshots. A escrita acontece em uma
+        # thread própria; WAL_DURABILITY escolhe quando há fsync
+        self.wal = WriteAheadLog(os.path.join(self.data_dir, 'wal'),
+                                 durability=os.environ.get('WAL_DURABILITY', 'interval'))
+        # Coleções alteradas desde o último snapshot (as outras reaproveitam a seção anterior)
+        self.dirty = set(EVENT_COLLECTIONS.values())
         
+        # Sockets (o socket do broker é criado em run())
         # Socket para Reference Server
         self.ref_socket = self.context.socket(zmq.REQ)
         self.ref_socket.connect(f"tcp://reference:5559")
@@ -59,35 +155,80 @@ class Server:
         # Socket PUB para replicação entre servidores
         self.pub_socket = self.context.socket(zmq.PUB)
         self.pub_socket.bind(f"tcp://*:{self.replication_port}")
+        # Eventos replicados saem em lotes (por tamanho ou a cada 5 ms), um
+        # quadro por partição: cada servidor só assina as próprias
+        self.replication = ReplicationBatcher(f"SERVER-{server_id}", self.pub_socket.send_multipart,
+                                              self.replication_routes)
+        self.replication.start()
+        
+        # Replicação confiável: replay dos eventos recentes e reparo de lacunas
+        self.replay_ring = ReplayRing(10000)
+        self.gap_grace = 0.2  # Lotes de workers diferentes podem chegar fora de ordem
+        self.repairs = set()  # Origens com replay pendente
+        # As respostas de replay são aplicadas aqui, e não no callback do
+        # Future (thread de I/O do PeerPool): aplicar e gravar no log não
+        # atrasa as outras requisições entre servidores
+        self.repair_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix=f"repair-{server_id}")
         
         # ✅ Socket PUB para publicar mensagens aos clientes via proxy
-        self.proxy_pub_socket = self.context.socket(zmq.PUB)
-        self.proxy_pub_socket.connect("tcp://proxy:5557")
+        # (com o proxy fragmentado, conecta em todos os XSUB: cada um só
+        # recebe os tópicos pedidos pelos seus inscritos)
+        self.proxy_addresses = [address.strip() for address in
+                                os.environ.get('PROXY_XSUB_ADDRESSES', 'tcp://proxy:5557').split(',')
+                                if address.strip()]
+        # Lotes por tópico (opcional): PUBLISH_BATCH_WINDOW_MS > 0 agrupa as
+        # publicações de cada canal/usuário nessa janela em um único quadro.
+        # Aí o socket é um XPUB, para o batcher saber qual forma tem inscritos
+        batch_window = float(os.environ.get('PUBLISH_BATCH_WINDOW_MS', 0))
+        self.proxy_pub_socket = self.context.socket(zmq.XPUB if batch_window > 0 else zmq.PUB)
+        # Sockets ZeroMQ não são thread-safe: sem lotes, workers REP e
+        # serve_peers publicam aqui, então os dois quadros saem sob este lock
+        self.proxy_lock = threading.Lock()
+        for address in self.proxy_addresses:
+            self.proxy_pub_socket.connect(address)
         time.sleep(0.5)  # Aguardar conexão estabilizar
-        
-        # Socket SUB para receber replicações
+        self.publish_batcher = None
+        if batch_window > 0:
+            # Com lotes, só a thread do batcher usa o socket
+            self.publish_batcher = PublishBatcher(f"SERVER-{server_id}", self.proxy_pub_socket,
+                                                  max_delay=batch_window / 1000)
+            self.publish_batcher.start()
+        
+        # Socket SUB para receber replicações (as inscrições seguem o mapa de
+        # partições e são feitas pela própria thread/tarefa que lê o socket)
         self.sub_socket = self.context.socket(zmq.SUB)
-        self.sub_socket.setsockopt_string(zmq.SUBSCRIBE, "")
+        self.replication_subscriptions = set()
         
-        # Socket REQ para comunicação entre servidores (eleição e sincronização)
-        self.server_req_socket = self.context.socket(zmq.REQ)
-        self.server_req_socket.setsockopt(zmq.RCVTIMEO, 1000)
+        # Conexões persistentes com os outros servidores (eleição, relógios e sincronização)
+        self.peers = PeerPool(self.context, f"SERVER-{server_id}")
         
         print(f"[INIT] Carregando dados...", flush=True)
         self.load_data()
         print(f"[INIT] Registrando com reference server...", flush=True)
         self.register_with_reference()
         
-        # Iniciar threads
-        print(f"[INIT] Iniciando threads...", flush=True)
-        threading.Thread(target=self.send_heartbeat, daemon=True).start()
-        threading.Thread(target=self.receive_replications, daemon=True).start()
-        threading.Thread(target=self.monitor_coordinator, daemon=True).start()
-        threading.Thread(target=self.periodic_sync, daemon=True).start()
+        # Iniciar threads (no runtime asyncio elas viram tarefas em run())
+        if self.async_runtime is None:
+            print(f"[INIT] Iniciando threads...", flush=True)
+            threading.Thread(target=self.serve_peers, daemon=True).start()
+            threading.Thread(target=self.send_heartbeat, daemon=True).start()
+            threading.Thread(target=self.receive_replications, daemon=True).start()
+            threading.Thread(target=self.monitor_coordinator, daemon=True).start()
+            self.sync_service.start()
+            threading.Thread(target=self.periodic_compaction, daemon=True).start()
         
         print(f"[SERVER-{self.server_id}] Servidor iniciado", flush=True)
         print(f"[SERVER-{self.server_id}] Conectado ao broker:5556", flush=True)
-        print(f"[SERVER-{self.server_id}] Conectado ao proxy:5557")
+        print(f"[SERVER-{self.server_id}] Conectado ao proxy: {', '.join(self.proxy_addresses)}")
+    
+    def publish_to_clients(self, topic, pub_data):
+        """Envia uma publicação ao proxy (direto ou pelo batcher de lotes)"""
+        if self.publish_batcher:
+            self.publish_batcher.publish(topic, pub_data)
+            return
+        frames = [topic.encode(), msgpack.packb(pub_data)]
+        with self.proxy_lock:
+            self.proxy_pub_socket.send_multipart(frames)
     
     def increment_clock(self):
         """Incrementa o relógio lógico antes de enviar mensagens"""
@@ -107,90 +248,134 @@ class Server:
     
     def check_sync_needed(self):
         """Verifica se precisa sincronizar após 10 mensagens"""
-        self.message_count += 1
-        if self.message_count >= self.sync_interval:
+        with self.clock_lock:
+            self.message_count += 1
+            if self.message_count < self.sync_interval:
+                return False
             self.message_count = 0
-            if self.is_coordinator:
-                threading.Thread(target=self.synchronize_clocks_berkeley, daemon=True).start()
-            return True
-        return False
+        
+        if self.is_coordinator:
+            self.schedule_clock_sync()
+        return True
+    
+    def schedule_clock_sync(self):
+        """Dispara uma rodada de Berkeley sem bloquear quem chamou"""
+        if self.async_runtime:
+            self.async_runtime.spawn(self.async_runtime.synchronize_clocks_berkeley)
+        else:
+            threading.Thread(target=self.synchronize_clocks_berkeley, daemon=True).start()
+    
+    def schedule_election(self):
+        """Dispara uma eleição sem bloquear quem chamou"""
+        if self.async_runtime:
+            self.async_runtime.spawn(self.async_runtime.start_election)
+        else:
+            threading.Thread(target=self.start_election, daemon=True).start()
+    
+    def other_servers(self):
+        return [s for s in list(self.servers.values()) if s['server_id'] != self.server_id]
+    
+    def peer_endpoint(self, server):
+        # Use container name instead of stored address
+        return f"tcp://server{server['server_id']}:{server['port']}"
+    
+    def request_peer(self, server, payload, timeout):
+        """Requisição a outro servidor pela conexão persistente; retorna um Future"""
+        return self.peers.request(server['server_id'], self.peer_endpoint(server), payload, timeout)
+    
+    def call_peer(self, server, payload, timeout):
+        """Versão bloqueante de request_peer; levanta PeerError se falhar"""
+        return self.request_peer(server, payload, timeout).result()
     
     def synchronize_clocks_berkeley(self):
-        """Algoritmo de Berkeley - coordenador sincroniza todos os servidores"""
+        """Algoritmo de Berkeley - coordenador sincroniza todos os servidores
+        
+        Os tempos são coletados e os ajustes enviados em paralelo, então a
+        rodada dura o tempo do servidor vivo mais lento (ou o timeout), não
+        a soma de todos.
+        """
         if not self.is_coordinator:
             return
         
         print(f"[SERVER-{self.server_id}] Iniciando sincronização de relógios (Berkeley)...")
         
-        server_times = {}
-        my_time = self.get_physical_time()
-        server_times[self.server_id] = my_time
+        active_servers = self.other_servers()
+        
+        sent_at = {}
+        futures = {}
+        for server in active_servers:
+            request = {
+                'service': 'clock',
+                'lamport_clock': self.increment_clock()
+            }
+            sent_at[server['server_id']] = time.time()
+            futures[self.request_peer(server, request, 2.0)] = server['server_id']
         
-        active_servers = [s for s in self.servers.values() 
-                         if s['server_id'] != self.server_id]
+        readings = {self.server_id: (0.0, 0.0)}
+        for future in as_completed(futures):
+            sid = futures[future]
+            try:
+                readings[sid] = self.clock_reading(sent_at[sid], time.time(), future.result())
+            except Exception as e:
+                print(f"[SERVER-{self.server_id}] Erro ao coletar tempo de {sid}: {e}")
         
+        adjustments = self.apply_berkeley_round(readings)
+        
+        futures = {}
         for server in active_servers:
+            sid = server['server_id']
+            if sid in adjustments:
+                request = {
+                    'service': 'adjust_clock',
+                    'adjustment': adjustments[sid],
+                    'lamport_clock': self.increment_clock()
+                }
+                futures[self.request_peer(server, request, 2.0)] = sid
+        
+        for future in as_completed(futures):
             try:
-                sock = self.context.socket(zmq.REQ)
-                sock.setsockopt(zmq.RCVTIMEO, 2000)
-                # Use container name instead of stored address
-                sock.connect(f"tcp://server{server['server_id']}:{server['port']}")
-                
-                clock = self.increment_clock()
-                request = msgpack.packb({
-                    'service': 'clock',
-                    'lamport_clock': clock
-                })
-                
-                t1 = time.time()
-                sock.send(request)
-                response = msgpack.unpackb(sock.recv())
-                t2 = time.time()
-                
-                rtt = t2 - t1
-                server_time = response['time'] + (rtt / 2)
-                server_times[server['server_id']] = server_time
-                
-                sock.close()
-                
+                future.result()
             except Exception as e:
-                print(f"[SERVER-{self.server_id}] Erro ao coletar tempo de {server['server_id']}: {e}")
+                print(f"[SERVER-{self.server_id}] Erro ao enviar ajuste para {futures[future]}: {e}")
         
-        if len(server_times) > 0:
-            avg_time = sum(server_times.values()) / len(server_times)
-            
-            adjustments = {}
-            for sid, stime in server_times.items():
-                adjustments[sid] = avg_time - stime
-            
-            print(f"[SERVER-{self.server_id}] Ajustes calculados: {adjustments}")
-            
-            self.clock_offset += adjustments[self.server_id]
-            
-            for server in active_servers:
-                sid = server['server_id']
-                if sid in adjustments:
-                    try:
-                        sock = self.context.socket(zmq.REQ)
-                        sock.setsockopt(zmq.RCVTIMEO, 2000)
-                        # Use container name instead of stored address
-                        sock.connect(f"tcp://server{sid}:{server['port']}")
-                        
-                        clock = self.increment_clock()
-                        request = msgpack.packb({
-                            'service': 'adjust_clock',
-                            'adjustment': adjustments[sid],
-                            'lamport_clock': clock
-                        })
-                        
-                        sock.send(request)
-                        sock.recv()
-                        sock.close()
-                        
-                    except Exception as e:
-                        print(f"[SERVER-{self.server_id}] Erro ao enviar ajuste para {sid}: {e}")
-            
-            print(f"[SERVER-{self.server_id}] Sincronização concluída. Offset: {self.clock_offset:.6f}s")
+        print(f"[SERVER-{self.server_id}] Sincronização concluída. Offset: {self.clock_offset:.6f}s")
+    
+    def clock_reading(self, sent_at, received_at, response):
+        """Diferença estimada entre o relógio remoto e o local (Cristian: RTT/2)
+        
+        Retorna (offset, rtt). Com a coleta em paralelo cada leitura chega
+        em um instante diferente, por isso o tempo remoto é comparado com o
+        relógio local no momento em que a resposta chegou.
+        """
+        rtt = received_at - sent_at
+        remote_time = response['time'] + (rtt / 2)
+        return remote_time - (received_at + self.clock_offset), rtt
+    
+    def apply_berkeley_round(self, readings):
+        """Calcula os ajustes de cada servidor e aplica o do coordenador
+        
+        readings: server_id -> (offset, rtt). Média tolerante a falhas: só
+        entram na média as leituras com RTT até berkeley_max_rtt e a até
+        berkeley_max_skew da mediana. Os servidores descartados também
+        recebem ajuste, para voltarem ao relógio do grupo.
+        """
+        median = statistics.median(offset for offset, _ in readings.values())
+        trusted = [offset for offset, rtt in readings.values()
+                   if rtt <= self.berkeley_max_rtt and abs(offset - median) <= self.berkeley_max_skew]
+        avg_offset = sum(trusted) / len(trusted) if trusted else median
+        
+        outliers = len(readings) - len(trusted)
+        if outliers:
+            print(f"[SERVER-{self.server_id}] {outliers} leitura(s) descartada(s) da média")
+        
+        adjustments = {}
+        for sid, (offset, _) in readings.items():
+            adjustments[sid] = avg_offset - offset
+        
+        print(f"[SERVER-{self.server_id}] Ajustes calculados: {adjustments}")
+        
+        self.clock_offset += adjustments[self.server_id]
+        return adjustments
     
     def start_election(self):
         """Inicia o algoritmo de eleição Bully"""
@@ -212,23 +397,16 @@ class Server:
         responses = []
         for server in higher_servers:
             try:
-                sock = self.context.socket(zmq.REQ)
-                sock.setsockopt(zmq.RCVTIMEO, 1500)
-                # Use container name instead of stored address
-                sock.connect(f"tcp://server{server['server_id']}:{server['port']}")
-                
                 clock = self.increment_clock()
-                request = msgpack.packb({
+                request = {
                     'service': 'election',
                     'type': 'ELECTION',
                     'from': self.server_id,
                     'lamport_clock': clock
-                })
+                }
                 
-                sock.send(request)
-                response = msgpack.unpackb(sock.recv())
+                response = self.call_peer(server, request, 1.5)
                 responses.append(response)
-                sock.close()
                 print(f"[SERVER-{self.server_id}] ✅ Servidor {server['server_id']} respondeu à eleição")
                 
             except Exception as e:
@@ -254,22 +432,15 @@ class Server:
         for server in self.servers.values():
             if server['server_id'] != self.server_id:
                 try:
-                    sock = self.context.socket(zmq.REQ)
-                    sock.setsockopt(zmq.RCVTIMEO, 1000)
-                    # Use container name instead of stored address
-                    sock.connect(f"tcp://server{server['server_id']}:{server['port']}")
-                    
                     clock = self.increment_clock()
-                    request = msgpack.packb({
+                    request = {
                         'service': 'election',
                         'type': 'COORDINATOR',
                         'coordinator_id': self.server_id,
                         'lamport_clock': clock
-                    })
+                    }
                     
-                    sock.send(request)
-                    sock.recv()
-                    sock.close()
+                    self.call_peer(server, request, 1.0)
                     print(f"[SERVER-{self.server_id}] ✅ Coordenação anunciada para servidor {server['server_id']}")
                     
                 except Exception as e:
@@ -280,29 +451,45 @@ class Server:
         while True:
             time.sleep(5)
             
-            if self.coordinator_id is None:
+            if self.coordinator_needs_election():
                 self.start_election()
-                continue
-            
-            if self.coordinator_id == self.server_id:
-                continue
-            
-            coord = next((s for s in self.servers.values() 
-                         if s['server_id'] == self.coordinator_id), None)
-            
-            if coord:
-                last_seen = self.last_heartbeat.get(coord['server_id'], 0)
-                if time.time() - last_seen > 10:
-                    print(f"[SERVER-{self.server_id}] ⚠️  COORDENADOR {self.coordinator_id} INATIVO! Iniciando eleição...")
-                    self.coordinator_id = None
-                    self.start_election()
-            else:
-                print(f"[SERVER-{self.server_id}] ⚠️  Coordenador {self.coordinator_id} desconhecido! Iniciando eleição...")
+    
+    def coordinator_needs_election(self):
+        """Verifica se o coordenador sumiu (e o esquece nesse caso)"""
+        if self.coordinator_id is None:
+            return True
+        
+        if self.coordinator_id == self.server_id:
+            return False
+        
+        coord = next((s for s in self.servers.values() 
+                     if s['server_id'] == self.coordinator_id), None)
+        
+        if coord:
+            last_seen = self.last_heartbeat.get(coord['server_id'], 0)
+            if time.time() - last_seen > 10:
+                print(f"[SERVER-{self.server_id}] ⚠️  COORDENADOR {self.coordinator_id} INATIVO! Iniciando eleição...")
                 self.coordinator_id = None
-                self.start_election()
+                return True
+        else:
+            print(f"[SERVER-{self.server_id}] ⚠️  Coordenador {self.coordinator_id} desconhecido! Iniciando eleição...")
+            self.coordinator_id = None
+            return True
+        
+        return False
     
-    def handle_request(self, data):
+    def handle_request(self, data, forward=True):
         """Processa requisições e atualiza relógio lógico"""
+        if forward:
+            target = self.forward_target(data)
+            if target is not None:
+                try:
+                    return self.call_peer(target, self.forward_payload(data), self.forward_timeout)
+                except PeerError as e:
+                    self.forward_failed(target)
+                    print(f"[SERVER-{self.server_id}] Encaminhamento para {target['server_id']} falhou ({e}), "
+                          f"atendendo localmente")
+        
         received_clock = data.get('lamport_clock', 0)
         if received_clock == 0:
             received_clock = data.get('data', {}).get('clock', 0)
@@ -311,6 +498,9 @@ class Server:
         
         service = data.get('service')
         
+        if self.waits_for_history(service):
+            self.history_ready.wait()
+        
         # Serviços de sincronização e eleição
         if service == 'clock':
             return self.handle_clock_request(data)
@@ -345,6 +535,20 @@ class Server:
             response = self.handle_sync_messages(service_data)
         elif service == 'sync_publications':
             response = self.handle_sync_publications(service_data)
+        elif service == 'sync_delta':
+            response = self.handle_sync_delta(service_data)
+        elif service == 'merkle_digest':
+            response = self.handle_merkle_digest(service_data)
+        elif service == 'merkle_leaves':
+            response = self.handle_merkle_leaves(service_data)
+        elif service == 'merkle_ids':
+            response = self.handle_merkle_ids(service_data)
+        elif service == 'merkle_fetch':
+            response = self.handle_merkle_fetch(service_data)
+        elif service == 'replay':
+            response = self.handle_replay(service_data)
+        elif service == 'partition_fetch':
+            response = self.handle_partition_fetch(service_data)
         else:
             response = {
                 'service': service,
@@ -365,6 +569,44 @@ class Server:
         
         return response
     
+    def forward_target(self, data):
+        """Servidor dono da partição da requisição, se não for este
+        
+        Requisições já encaminhadas são sempre atendidas aqui (sem ciclos
+        quando dois servidores têm mapas de versões diferentes). Retorna
+        None sem mapa, quando este servidor é dono ou nenhum dono responde
+        ao reference server (ou todos falharam há menos de forward_cooldown).
+        """
+        if data.get('forwarded') is not None:
+            return None
+        key = request_key(data.get('service'), data.get('data'))
+        if key is None:
+            return None
+        owners = self.partitions.owners_of(key)
+        if not owners or self.server_id in owners:
+            return None
+        now = time.time()
+        for owner in owners:
+            server = self.servers.get(owner)
+            if server is None or now < self.forward_failures.get(owner, 0):
+                continue
+            if now - self.last_heartbeat.get(owner, 0) < 10:
+                return server
+        return None
+    
+    def forward_failed(self, server):
+        """Dono que não respondeu: as próximas requisições não esperam por ele"""
+        self.forward_failures[server['server_id']] = time.time() + self.forward_cooldown
+    
+    def forward_payload(self, data):
+        payload = dict(data)
+        payload['forwarded'] = self.server_id
+        return payload
+    
+    def waits_for_history(self, service):
+        """Indica se o serviço precisa esperar o histórico terminar de carregar"""
+        return service in HISTORY_SERVICES and not self.history_ready.is_set()
+    
     def handle_clock_request(self, data):
         """Responde com o tempo físico atual (Berkeley)"""
         current_clock = self.update_clock(data.get('lamport_clock', 0))
@@ -401,7 +643,7 @@ class Server:
             print(f"[SERVER-{self.server_id}] 📨 Recebi pedido de eleição do servidor {from_server}")
             print(f"[SERVER-{self.server_id}] 🔄 Iniciando minha própria eleição...")
             
-            threading.Thread(target=self.start_election, daemon=True).start()
+            self.schedule_election()
             
             response_clock = self.increment_clock()
             return {
@@ -452,6 +694,7 @@ class Server:
             
             if response.get('status') == 'ok':
                 print(f"[SERVER-{self.server_id}] Registrado no Reference Server")
+                self.update_partitions(response.get('partition_map'))
                 self.update_server_list()
             
         except Exception as e:
@@ -474,6 +717,7 @@ class Server:
             
             if response.get('status') == 'ok':
                 self.servers = {s['server_id']: s for s in response.get('servers', [])}
+                self.update_partitions(response.get('partition_map'))
                 
                 # Connect to servers we haven't connected to yet
                 for server in self.servers.values():
@@ -489,7 +733,7 @@ class Server:
                                 print(f"[SERVER-{self.server_id}] Erro ao conectar ao servidor {server_id}: {e}")
                 
                 if self.coordinator_id is None and len(self.servers) > 0:
-                    threading.Thread(target=self.start_election, daemon=True).start()
+                    self.schedule_election()
                     
         except Exception as e:
             print(f"[SERVER-{self.server_id}] Erro ao atualizar lista: {e}")
@@ -500,235 +744,633 @@ class Server:
             try:
                 time.sleep(3)
                 
-                clock = self.increment_clock()
-                
-                request = msgpack.packb({
-                    'service': 'heartbeat',
-                    'server_id': self.server_id,
-                    'is_coordinator': self.is_coordinator,
-                    'lamport_clock': clock
-                })
-                
-                self.ref_socket.send(request)
+                self.ref_socket.send(msgpack.packb(self.heartbeat_request()))
                 response = msgpack.unpackb(self.ref_socket.recv())
                 
-                self.update_clock(response.get('lamport_clock', 0))
-                
-                if response.get('status') == 'ok':
-                    servers_data = response.get('servers', [])
-                    for server in servers_data:
-                        sid = server['server_id']
-                        self.last_heartbeat[sid] = time.time()
-                        
-                        # Conectar a novos servidores
-                        if sid != self.server_id and sid not in self.connected_servers:
-                            try:
-                                address = f"tcp://server{sid}:{self.replication_port}"
-                                self.sub_socket.connect(address)
-                                self.connected_servers.add(sid)
-                                print(f"[SERVER-{self.server_id}] Conectado ao servidor {sid} para replicação")
-                            except Exception as e:
-                                print(f"[SERVER-{self.server_id}] Erro ao conectar ao servidor {sid}: {e}")
-                        
-                        # Atualizar dict de servidores
-                        if sid not in self.servers:
-                            self.servers[sid] = server
-                        
-                        if server.get('is_coordinator'):
-                            if self.coordinator_id != sid:
-                                print(f"[SERVER-{self.server_id}] Coordenador atualizado: {sid}")
-                                self.coordinator_id = sid
-                                self.is_coordinator = (sid == self.server_id)
+                self.process_heartbeat(response)
                 
             except Exception as e:
                 print(f"[SERVER-{self.server_id}] Erro no heartbeat: {e}")
     
+    def heartbeat_request(self):
+        return {
+            'service': 'heartbeat',
+            'server_id': self.server_id,
+            'address': 'server',
+            'port': self.port,
+            'is_coordinator': self.is_coordinator,
+            'lamport_clock': self.increment_clock()
+        }
+    
+    def process_heartbeat(self, response):
+        """Atualiza servidores, conexões de replicação e coordenador"""
+        self.update_clock(response.get('lamport_clock', 0))
+        
+        if response.get('status') == 'ok':
+            self.update_partitions(response.get('partition_map'))
+            servers_data = response.get('servers', [])
+            for server in servers_data:
+                sid = server['server_id']
+                self.last_heartbeat[sid] = time.time()
+                
+                # Conectar a novos servidores
+                if sid != self.server_id and sid not in self.connected_servers:
+                    try:
+                        address = f"tcp://server{sid}:{self.replication_port}"
+                        self.sub_socket.connect(address)
+                        self.connected_servers.add(sid)
+                        print(f"[SERVER-{self.server_id}] Conectado ao servidor {sid} para replicação")
+                    except Exception as e:
+                        print(f"[SERVER-{self.server_id}] Erro ao conectar ao servidor {sid}: {e}")
+                
+                # Atualizar dict de servidores
+                if sid not in self.servers:
+                    self.servers[sid] = server
+                
+                if server.get('is_coordinator'):
+                    if self.coordinator_id != sid:
+                        print(f"[SERVER-{self.server_id}] Coordenador atualizado: {sid}")
+                        self.coordinator_id = sid
+                        self.is_coordinator = (sid == self.server_id)
+    
+    def update_partitions(self, data):
+        """Adota o mapa de partições do reference server, se mudou
+        
+        Partições ganhas são copiadas dos outros servidores na próxima
+        compactação; as perdidas são descartadas depois de rebalance_grace.
+        """
+        if not data:
+            return
+        new = PartitionMap(data)
+        with self.data_lock:
+            old = self.partitions
+            if new.owners == old.owners:
+                self.partitions = new
+                return
+            self.partitions = new
+            before, after = old.owned(self.server_id), new.owned(self.server_id)
+            if before is not None and after is not None:
+                self.pending_fetch |= after - before
+            elif after is None:
+                self.pending_fetch = set()
+            self.rebalance_at = time.time() + self.rebalance_grace
+        owned = 'todas' if after is None else len(after)
+        print(f"[SERVER-{self.server_id}] Mapa de partições v{new.version}: {owned} de {new.partitions} "
+              f"partições aqui (fator de replicação {new.replication_factor})")
+    
     def receive_replications(self):
         """Recebe replicações de outros servidores - ✅ COMPLETO"""
         while True:
             try:
-                message = self.sub_socket.recv()
-                data = msgpack.unpackb(message)
-                
-                self.update_clock(data.get('lamport_clock', 0))
-                
-                msg_id = data.get('id')
-                if msg_id in self.processed_ids:
-                    continue
-                
-                self.processed_ids.add(msg_id)
-                
-                msg_type = data.get('type')
-                
-                if msg_type == 'message':
-                    self.messages.append(data)
-                    print(f"[SERVER-{self.server_id}] Mensagem replicada: {data.get('from')} -> {data.get('to')}")
-                    
-                elif msg_type == 'publication':
-                    self.publications.append(data)
-                    print(f"[SERVER-{self.server_id}] Publicação replicada em #{data.get('channel')}")
-                
-                # ✅ Replicação de login (SEMPRE atualiza para garantir sincronização)
-                elif msg_type == 'login':
-                    username = data.get('username')
-                    self.users[username] = {
-                        'username': username,
-                        'logged_at': data.get('logged_at')
-                    }
-                    print(f"[SERVER-{self.server_id}] Login replicado: {username}")
-                
-                # ✅ Replicação de canal (SEMPRE atualiza para garantir sincronização)
-                elif msg_type == 'channel':
-                    channel_name = data.get('channel_name')
-                    self.channels[channel_name] = {
-                        'name': channel_name,
-                        'created_at': data.get('created_at')
-                    }
-                    print(f"[SERVER-{self.server_id}] Canal replicado: {channel_name}")
-                
-                self.save_data()
-                
+                self.update_replication_subscriptions()
+                if self.sub_socket.poll(1000):
+                    self.handle_replication_frames(self.sub_socket.recv_multipart())
             except Exception as e:
                 print(f"[SERVER-{self.server_id}] Erro ao receber replicação: {e}")
     
+    def replication_routes(self, event):
+        """Partições de um evento no PUB de replicação (None: vai para todos)"""
+        partitions = self.partitions
+        keys = event_keys(event)
+        if not keys or not partitions:
+            return None
+        return sorted({partition_of(key, partitions.partitions) for key in keys})
+    
+    def update_replication_subscriptions(self, sock=None):
+        """Assina no SUB só as partições próprias (chamado por quem lê o socket)"""
+        owned = self.partitions.owned(self.server_id)
+        if owned is None:
+            wanted = {ALL_TOPIC, PARTITION_PREFIX}
+        else:
+            wanted = {ALL_TOPIC, SEQ_TOPIC} | {partition_topic(partition) for partition in owned}
+        if wanted == self.replication_subscriptions:
+            return
+        sock = sock or self.sub_socket
+        for topic in wanted - self.replication_subscriptions:
+            sock.setsockopt(zmq.SUBSCRIBE, topic)
+        for topic in self.replication_subscriptions - wanted:
+            sock.setsockopt(zmq.UNSUBSCRIBE, topic)
+        self.replication_subscriptions = wanted
+    
+    def handle_replication_frames(self, frames):
+        topic, message = frames[0], frames[-1]
+        if topic == SEQ_TOPIC:
+            self.skip_replicated(msgpack.unpackb(message))
+        else:
+            self.handle_replication(message)
+    
+    def skip_replicated(self, summaries):
+        """Marca como vistos os seqs de partições que este servidor não guarda
+        
+        Nada vai para o log: depois de um restart, o que faltar no vetor
+        volta pelo replay ou pela sincronização incremental.
+        """
+        self.history_ready.wait()
+        owned = self.partitions.owned(self.server_id)
+        if owned is None:
+            return
+        with self.data_lock:
+            for origin, seq, partitions in summaries:
+                if not owned.intersection(partitions):
+                    self.versions.add(origin, seq)
+        self.check_gaps({summary[0] for summary in summaries})
+    
+    def handle_replication(self, message):
+        """Aplica um lote replicado inteiro e grava tudo em um único registro do log"""
+        self.history_ready.wait()
+        events = unpack_batch(message)
+        
+        self.update_clock(max((event.get('lamport_clock', 0) for event in events), default=0))
+        
+        applied = self.apply_events(events)
+        if len(events) == 1:
+            for event in applied:
+                self.log_replicated_event(event)
+        elif applied:
+            print(f"[SERVER-{self.server_id}] Lote replicado: {len(applied)} de {len(events)} eventos aplicados")
+        
+        self.check_gaps({event.get('origin') for event in events})
+    
+    def check_gaps(self, origins):
+        """Agenda o reparo das origens com seqs faltando no stream de replicação"""
+        for origin in origins:
+            if origin is None or origin == self.server_id or origin in self.repairs:
+                continue
+            if self.versions.gap(origin) is None:
+                continue
+            self.repairs.add(origin)
+            timer = threading.Timer(self.gap_grace, self.repair_gap, args=(origin,))
+            timer.daemon = True
+            timer.start()
+    
+    def repair_gap(self, origin):
+        """Pede à origem só o intervalo de seqs que falta (replay)"""
+        gap = self.versions.gap(origin)
+        server = self.servers.get(origin)
+        if gap is None or server is None:
+            self.repairs.discard(origin)
+            return
+        
+        first, last = gap
+        print(f"[SERVER-{self.server_id}] Lacuna na replicação de {origin}: seq {first}-{last}, pedindo replay")
+        future = self.request_peer(server, self.peer_payload('replay', {
+            'first': first,
+            'last': last,
+            'limit': self.sync_page_size
+        }), 2.0)
+        future.add_done_callback(lambda f: self.repair_executor.submit(self.finish_repair, origin, f))
+    
+    def finish_repair(self, origin, future):
+        self.repairs.discard(origin)
+        try:
+            page = future.result().get('data', {})
+        except PeerError as e:
+            print(f"[SERVER-{self.server_id}] Replay de {origin} falhou: {e}")
+            self.sync_service.request()
+            return
+        
+        self.update_clock(page.get('clock', 0))
+        applied = self.apply_events(page.get('events') or [])
+        if applied:
+            print(f"[SERVER-{self.server_id}] Replay de {origin}: {len(applied)} eventos recuperados")
+        
+        if page.get('truncated') or not applied:
+            # A origem não tem mais o intervalo: sincronização incremental completa o resto
+            self.sync_service.request()
+        else:
+            self.check_gaps([origin])
+    
+    def log_replicated_event(self, data):
+        msg_type = data.get('type')
+        if msg_type == 'message':
+            print(f"[SERVER-{self.server_id}] Mensagem replicada: {data.get('from')} -> {data.get('to')}")
+        elif msg_type == 'publication':
+            print(f"[SERVER-{self.server_id}] Publicação replicada em #{data.get('channel')}")
+        elif msg_type == 'login':
+            print(f"[SERVER-{self.server_id}] Login replicado: {data.get('username')}")
+        elif msg_type == 'channel':
+            print(f"[SERVER-{self.server_id}] Canal replicado: {data.get('channel_name')}")
+    
+    def stamp_event(self, event):
+        """Atribui origem e número de sequência a um evento criado aqui"""
+        with self.seq_lock:
+            self.local_seq += 1
+            event['origin'] = self.server_id
+            event['seq'] = self.local_seq
+        return event
+    
+    def apply_event(self, data, persist=True):
+        """Aplica um evento (local, replicado ou sincronizado) ao estado
+        
+        Retorna False se o evento já era conhecido.
+        """
+        with self.data_lock:
+            return self._apply_event(data, persist)
+    
+    def apply_events(self, events):
+        """Aplica vários eventos com uma única aquisição do lock e um único
+        registro no log; retorna os que eram novos"""
+        with self.data_lock:
+            applied = [event for event in events if self._apply_event(event, False)]
+        if applied:
+            self.persist_many(applied)
+        return applied
+    
+    def _apply_event(self, data, persist):
+        msg_id = data.get('id')
+        msg_type = data.get('type')
+        
+        origin = data.get('origin')
+        seq = data.get('seq')
+        if origin is None or seq is None:
+            if msg_id is not None and msg_id in self.seen_ids:
+                return False
+        elif self.versions.seen(origin, seq):
+            return False
+        
+        if origin is not None and seq is not None:
+            if not self.versions.add(origin, seq):
+                return False
+        elif msg_id is not None:
+            self.seen_ids.add(msg_id)
+        
+        # Mensagens e publicações vão para o histórico como registros compactos
+        # (que podem ser selados em disco); log de eventos e árvore de Merkle
+        # guardam só uma referência a eles
+        stored = data
+        
+        if msg_type in ('message', 'publication') and not self.keeps(data):
+            # De outra partição, ou já fora da retenção (sincronização
+            # atrasada): conta como visto, não é guardado nem vai para o log
+            return True
+        
+        if msg_type == 'message':
+            stored = self.messages.ref(self.messages.append(data))
+        
+        elif msg_type == 'publication':
+            stored = self.publications.ref(self.publications.append(data))
+        
+        # ✅ Replicação de login (SEMPRE atualiza para garantir sincronização)
+        elif msg_type == 'login':
+            self.users[data.get('username')] = data
+        
+        # ✅ Replicação de canal (SEMPRE atualiza para garantir sincronização)
+        elif msg_type == 'channel':
+            self.channels[data.get('channel_name')] = data
+        
+        if msg_type in EVENT_COLLECTIONS:
+            self.dirty.add(EVENT_COLLECTIONS[msg_type])
+        
+        if origin is not None and seq is not None:
+            self.event_log.add(data, stored)
+        if msg_id is not None:
+            self.merkle.add(data, stored)
+        
+        if persist:
+            self.persist(data)
+        return True
+    
+    def keeps(self, data):
+        """Mensagem/publicação que este servidor guarda
+        
+        Eventos criados aqui sempre ficam (o dono pode estar fora do ar
+        quando o encaminhamento falha); os outros só nas partições próprias.
+        """
+        if data.get('origin') != self.server_id and not self.partitions.owns_event(self.server_id, data):
+            return False
+        return not self.expired_on_arrival(data)
+    
+    def adopt_events(self, events, persist=True):
+        """Guarda eventos de partições ganhas, que o vetor de versões já dá como vistos
+        
+        A deduplicação é pelo id na árvore de Merkle. Retorna quantos eram novos.
+        """
+        adopted = []
+        with self.data_lock:
+            for data in events:
+                store = {'message': self.messages, 'publication': self.publications}.get(data.get('type'))
+                if store is None or data.get('id') in self.merkle or not self.keeps(data):
+                    continue
+                stored = store.ref(store.append(data))
+                if data.get('origin') is not None and data.get('seq') is not None:
+                    self.event_log.add(data, stored)
+                self.merkle.add(data, stored)
+                self.dirty.add(EVENT_COLLECTIONS[data['type']])
+                adopted.append(data)
+        if persist and adopted:
+            try:
+                self.wal.append_many([{'kind': 'adopt', 'data': data} for data in adopted])
+            except Exception as e:
+                print(f"[SERVER-{self.server_id}] Erro ao gravar no log: {e}")
+        return len(adopted)
+    
     def replicate_data(self, data):
-        """Replica dados para outros servidores"""
+        """Replica dados para outros servidores (enfileira no lote atual)"""
         try:
-            data['lamport_clock'] = self.increment_clock()
+            if 'lamport_clock' not in data:
+                data['lamport_clock'] = self.increment_clock()
             
-            packed = msgpack.packb(data)
-            self.pub_socket.send(packed)
-            print(f"[SERVER-{self.server_id}] Dados replicados: {data.get('type')}")
+            if 'seq' in data:
+                self.replay_ring.add(data)
+            self.replication.add(data)
         except Exception as e:
             print(f"[SERVER-{self.server_id}] Erro ao replicar: {e}")
     
     def sync_from_other_servers(self):
-        """Sincroniza dados de todos os outros servidores ativos - ✅ COMPLETO"""
-        if len(self.servers) == 0 or self.is_syncing:
-            return  # Sem outros servidores ou já está sincronizando
+        """Sincronização incremental (anti-entropia) com os outros servidores
+        
+        Compara primeiro os digests de Merkle; só quando as réplicas divergem
+        troca vetores de versões e buckets. O tráfego é proporcional à
+        divergência.
+        """
+        if len(self.servers) == 0 or self.is_syncing or not self.history_ready.is_set():
+            return  # Sem outros servidores, já sincronizando ou histórico carregando
         
         self.is_syncing = True  # Marcar que está sincronizando
         
         try:
             print(f"[SERVER-{self.server_id}] Sincronizando com {len(self.servers)-1} servidores...")
             
-            users_synced = 0
-            channels_synced = 0
-            messages_synced = 0
-            publications_synced = 0
+            synced = 0
             
             for server in self.servers.values():
                 if server['server_id'] == self.server_id:
                     continue
                 
-                sock = None
                 try:
-                    # Criar socket temporário para pedir dados
-                    sock = self.context.socket(zmq.REQ)
-                    sock.setsockopt(zmq.RCVTIMEO, 2000)  # Timeout aumentado
-                    sock.setsockopt(zmq.LINGER, 0)  # Não esperar ao fechar
-                    sock.connect(f"tcp://server{server['server_id']}:{server['port']}")
-                    
-                    # ✅ Pedir usuários
-                    request = msgpack.packb({
-                        'service': 'users',
-                        'data': {},
-                        'lamport_clock': self.increment_clock()
-                    })
-                    sock.send(request)
-                    response = msgpack.unpackb(sock.recv())
-                    
-                    if response.get('data', {}).get('users'):
-                        for user in response['data']['users']:
-                            if user not in self.users:
-                                self.users[user] = {
-                                    'username': user,
-                                    'logged_at': datetime.now().isoformat()
-                                }
-                                users_synced += 1
-                    
-                    # ✅ Pedir canais
-                    request = msgpack.packb({
-                        'service': 'channels',
-                        'data': {},
-                        'lamport_clock': self.increment_clock()
-                    })
-                    sock.send(request)
-                    response = msgpack.unpackb(sock.recv())
-                    
-                    if response.get('data', {}).get('channels'):
-                        for channel in response['data']['channels']:
-                            if channel not in self.channels:
-                                self.channels[channel] = {
-                                    'name': channel,
-                                    'created_at': datetime.now().isoformat()
-                                }
-                                channels_synced += 1
+                    synced += self.sync_with_peer(server)
                     
-                    # ✅ Pedir mensagens (se aplicável - para servidores com poucos dados)
-                    if len(self.messages) < 100:  # Só sincroniza se tiver menos de 100 mensagens
-                        request = msgpack.packb({
-                            'service': 'sync_messages',
-                            'data': {},
-                            'lamport_clock': self.increment_clock()
-                        })
-                        sock.send(request)
-                        response = msgpack.unpackb(sock.recv())
-                        
-                        if response.get('data', {}).get('messages'):
-                            for msg in response['data']['messages']:
-                                msg_id = msg.get('id')
-                                if msg_id and msg_id not in self.processed_ids:
-                                    self.messages.append(msg)
-                                    self.processed_ids.add(msg_id)
-                                    messages_synced += 1
-                    
-                    # ✅ Pedir publicações (se aplicável - para servidores com poucos dados)
-                    if len(self.publications) < 500:  # Só sincroniza se tiver menos de 500 publicações
-                        request = msgpack.packb({
-                            'service': 'sync_publications',
-                            'data': {},
-                            'lamport_clock': self.increment_clock()
-                        })
-                        sock.send(request)
-                        response = msgpack.unpackb(sock.recv())
-                        
-                        if response.get('data', {}).get('publications'):
-                            for pub in response['data']['publications']:
-                                pub_id = pub.get('id')
-                                if pub_id and pub_id not in self.processed_ids:
-                                    self.publications.append(pub)
-                                    self.processed_ids.add(pub_id)
-                                    publications_synced += 1
-                    
-                except zmq.error.Again:
+                except PeerError:
                     # Timeout - servidor pode estar ocupado
                     pass
                 except Exception as e:
                     print(f"[SERVER-{self.server_id}] Erro ao sincronizar com server{server['server_id']}: {e}")
-                finally:
-                    if sock:
-                        sock.close()
             
-            if users_synced > 0 or channels_synced > 0 or messages_synced > 0 or publications_synced > 0:
-                print(f"[SERVER-{self.server_id}] Sincronizados: {users_synced} usuários, {channels_synced} canais, {messages_synced} mensagens, {publications_synced} publicações")
-                self.save_data()
+            if synced > 0:
+                print(f"[SERVER-{self.server_id}] Sincronizados: {synced} eventos")
         
         finally:
             self.is_syncing = False  # Liberar flag de sincronização
     
-    def periodic_sync(self):
-        """Sincronização periódica a cada 30 segundos"""
-        print(f"[SERVER-{self.server_id}] Thread de sincronização periódica iniciada", flush=True)
-        time.sleep(15)  # Espera inicial para os servidores se conectarem
-        
+    def peer_payload(self, service, data):
+        return {
+            'service': service,
+            'data': data,
+            'lamport_clock': self.increment_clock()
+        }
+    
+    def peer_request(self, server, service, data):
+        """Envia uma requisição a outro servidor e retorna o campo 'data'"""
+        response = self.call_peer(server, self.peer_payload(service, data), 2.0)
+        self.update_clock(response.get('data', {}).get('clock', 0))
+        return response.get('data', {})
+    
+    def sync_with_peer(self, server):
+        """Executa o protocolo de sincronização com chamadas bloqueantes pelo pool"""
+        protocol = self.sync_protocol(server['server_id'])
+        try:
+            service, data = next(protocol)
+            while True:
+                service, data = protocol.send(self.peer_request(server, service, data))
+        except StopIteration as stop:
+            return stop.value or 0
+    
+    def sync_protocol(self, peer_id=None):
+        """Protocolo de sincronização com um servidor, independente de I/O
+        
+        É um gerador: produz (serviço, dados) de cada requisição e recebe o
+        campo 'data' da resposta; retorna o número de eventos novos. O mesmo
+        protocolo roda nas threads (sync_with_peer) e no runtime asyncio.
+        
+        1. Compara a raiz da árvore de Merkle - se igual, nada a fazer
+        2. Sincronização incremental pelo vetor de versões
+        3. Se ainda divergir (eventos sem origem/seq), busca só os buckets
+           diferentes da árvore
+        
+        Com o histórico particionado as árvores de servidores diferentes
+        cobrem partições diferentes, então só o passo 2 é executado.
+        """
+        partial = self.partitions.partial(self.server_id)
+        if not partial:
+            remote = yield ('merkle_digest', {})
+            if remote.get('root') == self.merkle.digest()['root']:
+                return 0
+        
+        synced = 0
+        
+        # As páginas avançam por um cursor (maior seq recebida por origem), e
+        # não pelo vetor: com eventos descartados pela retenção o vetor local
+        # pode ficar parado antes de uma lacuna
+        cursor = self.versions.to_dict()
+        covered = None
         while True:
-            try:
-                if len(self.servers) > 0:  # Só sincroniza se conhecer outros servidores
-                    self.sync_from_other_servers()
-                time.sleep(30)  # Sincroniza a cada 30 segundos
-            except Exception as e:
-                print(f"[SERVER-{self.server_id}] Erro na sincronização periódica: {e}", flush=True)
+            page = yield ('sync_delta', {
+                'vector': cursor,
+                'limit': self.sync_page_size
+            })
+            if covered is None:
+                covered = page.get('vector') or {}
+            
+            events = page.get('events') or []
+            for event in events:
+                if self.apply_event(event):
+                    synced += 1
+                origin = str(event.get('origin'))
+                cursor[origin] = max(cursor.get(origin, 0), event.get('seq') or 0)
+            
+            if not page.get('has_more'):
+                # O que o servidor cobria no início e não mandou foi descartado
+                # pela retenção lá: vira "visto" aqui, sem lacuna no vetor.
+                # Só vale se ele guarda todas as partições que este guarda
+                if self.partitions.covers(self.server_id, peer_id):
+                    for origin, seq in covered.items():
+                        if str(origin) != str(self.server_id):
+                            self.versions.advance(origin, seq)
+                break
+            if not events:
+                break
+        
+        if partial:
+            return synced
+        
+        remote = yield ('merkle_digest', {})
+        local = self.merkle.digest()
+        if remote.get('root') == local['root']:
+            return synced
+        
+        subtrees = differing(local['subtrees'], remote.get('subtrees') or [])
+        if not subtrees:
+            return synced
+        
+        leaves = (yield ('merkle_leaves', {'subtrees': subtrees})).get('leaves') or {}
+        buckets = []
+        for subtree in subtrees:
+            remote_leaves = leaves.get(str(subtree)) or []
+            for offset in differing(self.merkle.leaf_hashes(subtree), remote_leaves):
+                buckets.append(subtree * FANOUT + offset)
+        
+        # Ids do outro lado em todos os buckets divergentes de uma vez, em
+        # páginas com um único cursor [bucket, id]; só os que faltam aqui são
+        # pedidos. Nenhum pedido leva a lista dos ids locais, e cada pedido
+        # avança sobre uma lista finita
+        missing = []
+        after = None
+        while True:
+            page = yield ('merkle_ids', {
+                'buckets': buckets,
+                'after': after,
+                'limit': self.sync_page_size
+            })
+            entries = page.get('entries') or []
+            missing.extend(event_id for _, event_id in entries if event_id not in self.merkle)
+            if not page.get('has_more') or not entries:
+                break
+            if after is not None and tuple(entries[-1]) <= tuple(after):
+                break  # Cursor parado: o outro lado não avança
+            after = entries[-1]
+        
+        for start in range(0, len(missing), self.sync_page_size):
+            page = yield ('merkle_fetch', {'ids': missing[start:start + self.sync_page_size]})
+            applied = 0
+            for event in page.get('events') or []:
+                if self.apply_event(event):
+                    applied += 1
+            synced += applied
+            if not applied:
+                # Nada novo nesta página (eventos de partições que este
+                # servidor não guarda, ou já expirados): para por aqui
+                break
+        
+        return synced
+    
+    def handle_merkle_digest(self, data):
+        """Handler que retorna a raiz e as subárvores da árvore de Merkle"""
+        digest = self.merkle.digest()
+        return {
+            'service': 'merkle_digest',
+            'data': {
+                'status': 'ok',
+                'root': digest['root'],
+                'subtrees': digest['subtrees'],
+                'clock': self.lamport_clock
+            }
+        }
+    
+    def handle_merkle_leaves(self, data):
+        """Handler que retorna as folhas das subárvores pedidas"""
+        leaves = {}
+        for subtree in data.get('subtrees') or []:
+            leaves[str(subtree)] = self.merkle.leaf_hashes(int(subtree))
+        return {
+            'service': 'merkle_leaves',
+            'data': {
+                'status': 'ok',
+                'leaves': leaves,
+                'clock': self.lamport_clock
+            }
+        }
+    
+    def handle_merkle_ids(self, data):
+        """Handler que retorna [bucket, id] dos buckets pedidos depois do cursor, em ordem"""
+        limit = max(1, min(int(data.get('limit') or self.sync_page_size), self.max_page_size))
+        buckets = [int(bucket) for bucket in data.get('buckets') or []]
+        entries = self.merkle.ids_after(buckets, data.get('after'), limit)
+        return {
+            'service': 'merkle_ids',
+            'data': {
+                'status': 'ok',
+                'entries': entries[:limit],
+                'has_more': len(entries) > limit,
+                'clock': self.lamport_clock
+            }
+        }
+    
+    def handle_merkle_fetch(self, data):
+        """Handler que retorna os eventos pedidos (por id)"""
+        ids = (data.get('ids') or [])[:self.max_page_size]
+        return {
+            'service': 'merkle_fetch',
+            'data': {
+                'status': 'ok',
+                'events': self.merkle.events_for(ids),
+                'clock': self.lamport_clock
+            }
+        }
+    
+    def handle_sync_delta(self, data):
+        """Handler de sincronização incremental: eventos além do vetor recebido"""
+        vector = {str(k): v for k, v in (data.get('vector') or {}).items()}
+        limit = max(1, min(int(data.get('limit') or self.sync_page_size), self.max_page_size))
+        
+        # O vetor é lido antes do log: tudo o que ele cobre e não vier nesta
+        # nem nas próximas páginas foi descartado pela retenção (ver sync_protocol)
+        with self.data_lock:
+            covered = self.versions.to_dict()
+        events, has_more = self.event_log.since(vector, limit)
+        
+        return {
+            'service': 'sync_delta',
+            'data': {
+                'status': 'ok',
+                'events': events,
+                'has_more': has_more,
+                'vector': covered,
+                'timestamp': datetime.now().isoformat(),
+                'clock': self.lamport_clock
+            }
+        }
+    
+    def handle_replay(self, data):
+        """Handler de replay: eventos recentes deste servidor em um intervalo de seq"""
+        first = int(data.get('first') or 1)
+        last = int(data.get('last') or first)
+        limit = max(1, min(int(data.get('limit') or self.sync_page_size), self.max_page_size))
+        
+        events, truncated = self.replay_ring.range(first, last, limit)
+        
+        return {
+            'service': 'replay',
+            'data': {
+                'status': 'ok',
+                'events': events,
+                'truncated': truncated,
+                'timestamp': datetime.now().isoformat(),
+                'clock': self.lamport_clock
+            }
+        }
+    
+    def handle_partition_fetch(self, data):
+        """Handler de cópia de partições: eventos guardados aqui das partições pedidas
+        
+        Paginado pelo offset no histórico ('after' é o último offset já
+        visto pelo pedinte).
+        """
+        partitions = set(data.get('partitions') or [])
+        store = self.messages if data.get('collection') == 'messages' else self.publications
+        limit = max(1, min(int(data.get('limit') or self.sync_page_size), self.max_page_size))
+        count = self.partitions.partitions or 1
+        
+        events = []
+        last = int(data.get('after', -1))
+        has_more = False
+        for offset, record in store.scan(last + 1):
+            if len(events) >= limit:
+                has_more = True
+                break
+            last = offset
+            if any(partition_of(key, count) in partitions for key in event_keys(record)):
+                events.append(record.to_event())
+        
+        return {
+            'service': 'partition_fetch',
+            'data': {
+                'status': 'ok',
+                'events': events,
+                'has_more': has_more,
+                'last': last,
+                'clock': self.lamport_clock
+            }
+        }
     
     # ========== HANDLERS CORRIGIDOS ==========
     
@@ -736,7 +1378,13 @@ class Server:
         """Handler de login - ✅ CORRIGIDO COM REPLICAÇÃO"""
         username = data.get('user')  # Cliente envia 'user'
         
-        if username in self.users:
+        with self.data_lock:
+            exists = username in self.users
+            if not exists:
+                # Reserva o nome antes de liberar o lock (evita login duplicado)
+                self.users[username] = {'username': username}
+        
+        if exists:
             return {
                 'service': 'login',
                 'data': {
@@ -747,25 +1395,19 @@ class Server:
                 }
             }
         
-        # Criar registro do usuário
-        user_data = {
-            'username': username,
-            'logged_at': datetime.now().isoformat()
-        }
-        
-        self.users[username] = user_data
-        self.save_data()
-        
-        # ✅ Replicar login para outros servidores
-        login_replica = {
+        # Criar registro do usuário (o próprio evento de login)
+        login_replica = self.stamp_event({
             'id': str(uuid.uuid4()),
             'type': 'login',
             'username': username,
-            'logged_at': user_data['logged_at'],
+            'logged_at': datetime.now().isoformat(),
             'timestamp': datetime.now().isoformat(),
-            'lamport_clock': self.lamport_clock
-        }
+            'lamport_clock': self.increment_clock()
+        })
         
+        self.apply_event(login_replica)
+        
+        # ✅ Replicar login para outros servidores
         self.replicate_data(login_replica)
         print(f"[SERVER-{self.server_id}] Login de '{username}' replicado")
         
@@ -779,15 +1421,14 @@ class Server:
         }
     
     def handle_list_users(self, data):
-        """Handler de listagem de usuários - ✅ COM SINCRONIZAÇÃO FORÇADA"""
-        # Sincronizar com outros servidores ANTES de retornar (se não estiver já sincronizando)
-        if not self.is_syncing:
-            self.sync_from_other_servers()
+        """Handler de listagem de usuários - responde com o estado local"""
+        # Agenda uma sincronização em segundo plano sem bloquear a resposta
+        self.sync_service.request()
         
         return {
             'service': 'users',
             'data': {
-                'users': list(self.users.keys()),
+                'users': self.list_keys(self.users),
                 'timestamp': datetime.now().isoformat(),
                 'clock': self.lamport_clock
             }
@@ -797,36 +1438,53 @@ class Server:
         """Handler de criação de canal - ✅ CORRIGIDO COM REPLICAÇÃO"""
         channel_name = data.get('channel')  # Cliente envia 'channel'
         
-        if channel_name in self.channels:
+        try:
+            retention = RetentionPolicy.from_dict(data.get('retention'))
+        except (TypeError, ValueError) as e:
             return {
                 'service': 'channel',
                 'data': {
                     'status': 'erro',
-                    'description': 'Canal já existe',
+                    'description': str(e),
                     'timestamp': datetime.now().isoformat(),
                     'clock': self.lamport_clock
                 }
             }
         
-        # Criar canal
-        channel_data = {
-            'name': channel_name,
-            'created_at': datetime.now().isoformat()
-        }
+        with self.data_lock:
+            exists = channel_name in self.channels
+            if not exists:
+                # Reserva o nome antes de liberar o lock (evita canal duplicado)
+                self.channels[channel_name] = {'name': channel_name}
         
-        self.channels[channel_name] = channel_data
-        self.save_data()
+        if exists:
+            return {
+                'service': 'channel',
+                'data': {
+                    'status': 'erro',
+                    'description': 'Canal já existe',
+                    'timestamp': datetime.now().isoformat(),
+                    'clock': self.lamport_clock
+                }
+            }
         
-        # ✅ Replicar criação de canal
+        # Criar canal (o próprio evento de criação)
         channel_replica = {
             'id': str(uuid.uuid4()),
             'type': 'channel',
             'channel_name': channel_name,
-            'created_at': channel_data['created_at'],
+            'created_at': datetime.now().isoformat(),
             'timestamp': datetime.now().isoformat(),
-            'lamport_clock': self.lamport_clock
+            'lamport_clock': self.increment_clock()
         }
+        if retention:
+            # Vai no próprio evento: todas as réplicas aplicam a mesma política
+            channel_replica['retention'] = retention.to_dict()
+        self.stamp_event(channel_replica)
+        
+        self.apply_event(channel_replica)
         
+        # ✅ Replicar criação de canal
         self.replicate_data(channel_replica)
         print(f"[SERVER-{self.server_id}] Canal '{channel_name}' replicado")
         
@@ -840,15 +1498,14 @@ class Server:
         }
     
     def handle_list_channels(self, data):
-        """Handler de listagem de canais - ✅ COM SINCRONIZAÇÃO FORÇADA"""
-        # Sincronizar com outros servidores ANTES de retornar (se não estiver já sincronizando)
-        if not self.is_syncing:
-            self.sync_from_other_servers()
+        """Handler de listagem de canais - responde com o estado local"""
+        # Agenda uma sincronização em segundo plano sem bloquear a resposta
+        self.sync_service.request()
         
         return {
             'service': 'channels',
             'data': {
-                'channels': list(self.channels.keys()),
+                'channels': self.list_keys(self.channels),
                 'timestamp': datetime.now().isoformat(),
                 'clock': self.lamport_clock
             }
@@ -859,10 +1516,10 @@ class Server:
         dst_user = data.get('dst')
         src_user = data.get('src')
         
-        # ✅ Validar se usuário destinatário existe - se não, tenta sincronizar primeiro
+        # ✅ Validar se usuário destinatário existe - se não, espera uma rodada de sincronização
         if dst_user not in self.users:
-            print(f"[SERVER-{self.server_id}] Usuário '{dst_user}' não encontrado, tentando sincronizar...")
-            self.sync_from_other_servers()
+            print(f"[SERVER-{self.server_id}] Usuário '{dst_user}' não encontrado, aguardando sincronização...")
+            self.sync_service.sync_once(self.sync_wait_timeout)
             
             # Verifica novamente após sincronização
             if dst_user not in self.users:
@@ -876,19 +1533,17 @@ class Server:
                     }
                 }
         
-        message = {
+        message = self.stamp_event({
             'id': str(uuid.uuid4()),
             'type': 'message',
             'from': src_user,
             'to': dst_user,
             'content': data.get('message'),
             'timestamp': datetime.now().isoformat(),
-            'lamport_clock': self.lamport_clock
-        }
+            'lamport_clock': self.increment_clock()
+        })
         
-        self.messages.append(message)
-        self.processed_ids.add(message['id'])
-        self.save_data()
+        self.apply_event(message)
         
         # Replicar para outros servidores
         self.replicate_data(message)
@@ -905,8 +1560,7 @@ class Server:
         }
         
         try:
-            self.proxy_pub_socket.send_string(dst_user, zmq.SNDMORE)
-            self.proxy_pub_socket.send(msgpack.packb(pub_data))
+            self.publish_to_clients(dst_user, pub_data)
             print(f"[SERVER-{self.server_id}] Mensagem publicada no proxy: {src_user} -> {dst_user}")
         except Exception as e:
             print(f"[SERVER-{self.server_id}] Erro ao publicar no proxy: {e}")
@@ -921,33 +1575,19 @@ class Server:
         }
     
     def handle_get_messages(self, data):
-        """Handler de obtenção de mensagens"""
-        username = data.get('username')
-        
-        user_messages = [
-            msg for msg in self.messages
-            if msg.get('to') == username or msg.get('from') == username
-        ]
-        
-        return {
-            'service': 'get_messages',
-            'data': {
-                'status': 'ok',
-                'messages': user_messages,
-                'timestamp': datetime.now().isoformat(),
-                'clock': self.lamport_clock
-            }
-        }
+        """Handler de obtenção de mensagens (paginado)"""
+        return self.query_history('get_messages', 'messages', self.messages,
+                                  data.get('username'), data)
     
     def handle_publish(self, data):
         """Handler de publicação - ✅ CORRIGIDO COM PROXY E VALIDAÇÃO"""
         channel = data.get('channel')
         user = data.get('user')
         
-        # ✅ Validar se canal existe - se não, tenta sincronizar primeiro
+        # ✅ Validar se canal existe - se não, espera uma rodada de sincronização
         if channel not in self.channels:
-            print(f"[SERVER-{self.server_id}] Canal '{channel}' não encontrado, tentando sincronizar...")
-            self.sync_from_other_servers()
+            print(f"[SERVER-{self.server_id}] Canal '{channel}' não encontrado, aguardando sincronização...")
+            self.sync_service.sync_once(self.sync_wait_timeout)
             
             # Verifica novamente após sincronização
             if channel not in self.channels:
@@ -961,19 +1601,17 @@ class Server:
                     }
                 }
         
-        publication = {
+        publication = self.stamp_event({
             'id': str(uuid.uuid4()),
             'type': 'publication',
             'channel': channel,
             'from': user,
             'content': data.get('message'),
             'timestamp': datetime.now().isoformat(),
-            'lamport_clock': self.lamport_clock
-        }
+            'lamport_clock': self.increment_clock()
+        })
         
-        self.publications.append(publication)
-        self.processed_ids.add(publication['id'])
-        self.save_data()
+        self.apply_event(publication)
         
         # Replicar para outros servidores
         self.replicate_data(publication)
@@ -990,8 +1628,7 @@ class Server:
         }
         
         try:
-            self.proxy_pub_socket.send_string(channel, zmq.SNDMORE)
-            self.proxy_pub_socket.send(msgpack.packb(pub_data))
+            self.publish_to_clients(channel, pub_data)
             print(f"[SERVER-{self.server_id}] Publicação no canal '{channel}' enviada ao proxy")
         except Exception as e:
             print(f"[SERVER-{self.server_id}] Erro ao publicar no proxy: {e}")
@@ -1006,122 +1643,502 @@ class Server:
         }
     
     def handle_get_publications(self, data):
-        """Handler de obtenção de publicações"""
-        channel = data.get('channel')
-        
-        channel_pubs = [
-            pub for pub in self.publications
-            if pub.get('channel') == channel
-        ]
-        
-        return {
-            'service': 'get_publications',
-            'data': {
-                'status': 'ok',
-                'publications': channel_pubs,
-                'timestamp': datetime.now().isoformat(),
-                'clock': self.lamport_clock
-            }
-        }
+        """Handler de obtenção de publicações (paginado)"""
+        return self.query_history('get_publications', 'publications', self.publications,
+                                  data.get('channel'), data)
     
     def handle_sync_messages(self, data):
-        """Handler para sincronização de mensagens entre servidores"""
+        """Handler para sincronização de mensagens entre servidores (paginado)"""
+        return self.query_history('sync_messages', 'messages', self.messages, None, data)
+    
+    def handle_sync_publications(self, data):
+        """Handler para sincronização de publicações entre servidores (paginado)"""
+        return self.query_history('sync_publications', 'publications', self.publications, None, data)
+    
+    def query_history(self, service, field, store, key, data):
+        """Consulta paginada ao histórico
+        
+        Campos opcionais da requisição: limit, before/after (cursor
+        'lamport:id' ou só o lamport) e since/until (timestamps ISO).
+        """
+        limit = data.get('limit')
+        if limit is not None:
+            try:
+                limit = max(1, min(int(limit), self.max_page_size))
+            except (TypeError, ValueError):
+                return self.query_error(service, f'limit inválido: {limit!r}')
+        
+        try:
+            events, has_more, next_cursor = store.query(
+                key,
+                limit=limit,
+                before=data.get('before'),
+                after=data.get('after'),
+                since=data.get('since'),
+                until=data.get('until')
+            )
+        except ValueError:
+            return self.query_error(service, 'Cursor inválido')
+        
         return {
-            'service': 'sync_messages',
+            'service': service,
             'data': {
                 'status': 'ok',
-                'messages': self.messages,
+                field: events,
+                'has_more': has_more,
+                'next_cursor': next_cursor,
                 'timestamp': datetime.now().isoformat(),
                 'clock': self.lamport_clock
             }
         }
     
-    def handle_sync_publications(self, data):
-        """Handler para sincronização de publicações entre servidores"""
+    def query_error(self, service, message):
         return {
-            'service': 'sync_publications',
+            'service': service,
             'data': {
-                'status': 'ok',
-                'publications': self.publications,
+                'status': 'erro',
+                'message': message,
                 'timestamp': datetime.now().isoformat(),
                 'clock': self.lamport_clock
             }
         }
     
     def load_data(self):
-        """Carrega dados do disco"""
+        """Carrega dados do disco: último snapshot + cauda do log
+        
+        Com um snapshot binário, usuários, canais e a sequência local são
+        restaurados antes do registro no reference server e o histórico de
+        mensagens e publicações carrega em uma thread. Sem ele (primeira
+        execução ou snapshot antigo) tudo é carregado aqui mesmo.
+        """
         try:
-            if os.path.exists('/app/data/users.json'):
-                with open('/app/data/users.json', 'r') as f:
-                    self.users = json.load(f)
+            if not self.wal.exists():
+                self.load_legacy_json()
             
-            if os.path.exists('/app/data/channels.json'):
-                with open('/app/data/channels.json', 'r') as f:
-                    self.channels = json.load(f)
+            state, records = self.wal.load()
             
-            if os.path.exists('/app/data/messages.json'):
-                with open('/app/data/messages.json', 'r') as f:
-                    self.messages = json.load(f)
-                    self.processed_ids = {msg.get('id') for msg in self.messages if 'id' in msg}
+            state = state or {}
+            self.users = state.get('users', self.users)
+            self.channels = state.get('channels', self.channels)
+            # O mapa salvo decide o que é guardado ao reaplicar o log
+            self.partitions = PartitionMap(state.get('partitions'))
             
-            if os.path.exists('/app/data/publications.json'):
-                with open('/app/data/publications.json', 'r') as f:
-                    self.publications = json.load(f)
-                    self.processed_ids.update({pub.get('id') for pub in self.publications if 'id' in pub})
+            if 'local_seq' not in state:
+                self.load_history(state, records)
+                # Migração dos arquivos JSON antigos: grava o primeiro snapshot
+                if not state and not records and (self.users or self.channels or self.messages or self.publications):
+                    self.take_snapshot()
+                return
             
-            print(f"[SERVER-{self.server_id}] Dados carregados do disco")
+            self.rebuild_versions(state.get('versions'))
+            for record in records:
+                if not is_history_record(record):
+                    self.apply_record(record)
+            # A sequência local precisa estar certa antes do primeiro evento criado aqui
+            local_seq = max(state['local_seq'], self.versions.max_seq(self.server_id))
+            for record in records:
+                data = record.get('data', {})
+                if data.get('origin') == self.server_id:
+                    local_seq = max(local_seq, data.get('seq') or 0)
+            with self.seq_lock:
+                self.local_seq = local_seq
+            print(f"[SERVER-{self.server_id}] {len(self.users)} usuários e {len(self.channels)} canais carregados, "
+                  f"histórico em segundo plano")
+            threading.Thread(target=self.load_history, args=(state, records), daemon=True).start()
             
         except Exception as e:
             print(f"[SERVER-{self.server_id}] Erro ao carregar dados: {e}")
+            self.history_ready.set()
     
-    def save_data(self):
-        """Salva dados no disco"""
+    def load_history(self, state, records):
+        """Histórico (segmentos frios + camada quente do snapshot) e cauda do log"""
+        started = time.time()
         try:
-            os.makedirs('/app/data', exist_ok=True)
+            for name in ('messages', 'publications'):
+                store = getattr(self, name)
+                store.reset(state[name] if name in state else store.all(), state.get(f'{name}_sealed', 0))
             
-            with open('/app/data/users.json', 'w') as f:
-                json.dump(self.users, f, indent=2)
+            with self.data_lock:
+                self.rebuild_versions(state.get('versions'))
+                for record in records:
+                    self.apply_record(record)
             
-            with open('/app/data/channels.json', 'w') as f:
-                json.dump(self.channels, f, indent=2)
+            with self.seq_lock:
+                self.local_seq = max(self.local_seq, self.versions.max_seq(self.server_id))
             
-            with open('/app/data/messages.json', 'w') as f:
-                json.dump(self.messages, f, indent=2)
+            print(f"[SERVER-{self.server_id}] Histórico carregado em {time.time() - started:.2f}s: "
+                  f"{len(self.messages)} mensagens, {len(self.publications)} publicações "
+                  f"({len(records)} registros do log reaplicados)")
+        except Exception as e:
+            print(f"[SERVER-{self.server_id}] Erro ao carregar histórico: {e}")
+        finally:
+            self.history_ready.set()
+    
+    def load_legacy_json(self):
+        """Importa os arquivos JSON do formato antigo, se existirem"""
+        for name in ('users', 'channels', 'messages', 'publications'):
+            path = os.path.join(self.data_dir, f'{name}.json')
+            if os.path.exists(path):
+                with open(path, 'r') as f:
+                    data = json.load(f)
+                if name in ('messages', 'publications'):
+                    getattr(self, name).reset(data)
+                else:
+                    setattr(self, name, data)
+                print(f"[SERVER-{self.server_id}] Importando {path} para o log")
+    
+    def rebuild_versions(self, vector=None):
+        """Reconstrói o vetor de versões e a árvore de Merkle a partir dos eventos carregados
+        
+        'vector' é o vetor salvo no snapshot: ele também cobre os eventos
+        já descartados pela retenção, que não voltam a ser aceitos.
+        """
+        self.versions = VersionVector.from_state(vector) if vector else VersionVector()
+        self.event_log.clear()
+        self.merkle.clear()
+        self.seen_ids.clear()
+        
+        events = [(event, event) for event in list(self.users.values()) + list(self.channels.values())]
+        for store in (self.messages, self.publications):
+            events += ((record, store.ref(offset)) for offset, record in store.scan())
+        
+        for event, stored in events:
+            if event.get('id') is not None:
+                self.merkle.add(event, stored)
+            if event.get('origin') is not None and event.get('seq') is not None:
+                self.versions.add(event['origin'], event['seq'])
+                self.event_log.add(event, stored)
+            elif event.get('id') is not None:
+                self.seen_ids.add(event['id'])
+    
+    def apply_record(self, record):
+        """Reaplica um registro do log (idempotente)"""
+        kind = record.get('kind')
+        data = record.get('data', {})
+        
+        if kind in ('event', 'message', 'publication'):
+            self.apply_event(data, persist=False)
+        elif kind == 'seen':
+            with self.data_lock:
+                if data.get('origin') is not None and data.get('seq') is not None:
+                    self.versions.add(data['origin'], data['seq'])
+                elif data.get('id') is not None:
+                    self.seen_ids.add(data['id'])
+        elif kind == 'adopt':
+            self.adopt_events([data], persist=False)
+        elif kind == 'user':
+            self.users[data.get('username')] = data
+        elif kind == 'channel':
+            self.channels[data.get('name')] = data
+    
+    def persist(self, data):
+        """Grava um evento no log - custo O(registro)"""
+        self.persist_many([data])
+    
+    def persist_many(self, events):
+        """Grava vários eventos de uma vez (uma escrita, um group commit)"""
+        records = [{'kind': 'event', 'data': data} for data in events if self.logs(data)]
+        if not records:
+            return
+        try:
+            self.wal.append_many(records)
+        except Exception as e:
+            print(f"[SERVER-{self.server_id}] Erro ao gravar no log: {e}")
+    
+    def logs(self, data):
+        """Evento que vai para o log (os descartados aqui não vão; registros
+        'seen' de logs antigos continuam sendo lidos)"""
+        return data.get('type') not in ('message', 'publication') or self.keeps(data)
+    
+    def list_keys(self, collection):
+        with self.data_lock:
+            return list(collection.keys())
+    
+    def snapshot_state(self):
+        """Estado do snapshot: só as coleções alteradas desde o anterior
+        
+        Do histórico só entra a camada quente. Sob o lock só são copiadas as
+        referências; a conversão dos registros em linhas compactas acontece
+        fora dele.
+        """
+        with self.data_lock:
+            dirty, self.dirty = self.dirty, set()
+            state = {
+                'local_seq': self.local_seq,
+                'versions': self.versions.to_state(),
+                'partitions': self.partitions.to_dict()
+            }
+            if 'users' in dirty:
+                state['users'] = dict(self.users)
+            if 'channels' in dirty:
+                state['channels'] = dict(self.channels)
+            hot = {name: getattr(self, name).hot_state()
+                   for name in ('messages', 'publications') if name in dirty}
+        
+        for name, (sealed, records) in hot.items():
+            state[name] = [None if record is None else record.to_row() for record in records]
+            state[f'{name}_sealed'] = sealed
+        return state
+    
+    def take_snapshot(self):
+        """Grava um snapshot do estado atual e compacta o log"""
+        try:
+            self.wal.snapshot(self.snapshot_state)
+        except Exception:
+            # Seções que não chegaram ao disco não podem ser reaproveitadas
+            with self.data_lock:
+                self.dirty.update(EVENT_COLLECTIONS.values())
+            raise
+        print(f"[SERVER-{self.server_id}] Snapshot gravado, log compactado")
+    
+    def periodic_compaction(self):
+        """Grava snapshots periodicamente para limitar o tamanho do log"""
+        last_report = time.time()
+        while True:
+            time.sleep(10)
+            try:
+                self.compact_storage()
+            except Exception as e:
+                print(f"[SERVER-{self.server_id}] Erro ao compactar log: {e}")
             
-            with open('/app/data/publications.json', 'w') as f:
-                json.dump(self.publications, f, indent=2)
+            if time.time() - last_report >= self.dedup_report_interval:
+                self.report_dedup()
+                last_report = time.time()
+    
+    def compact_storage(self):
+        """Retenção, snapshot do log (quando necessário) e selagem do histórico antigo"""
+        if not self.history_ready.is_set():
+            return  # Um snapshot agora perderia o histórico ainda não carregado
+        # Depois de descartes, o snapshot torna a remoção da camada quente durável
+        if self.pending_fetch:
+            self.fetch_partitions()
+        trimmed = self.enforce_retention() + self.drop_unowned()
+        if trimmed or self.wal.needs_snapshot():
+            self.take_snapshot()
+        for name in ('messages', 'publications'):
+            sealed = getattr(self, name).seal()
+            if sealed:
+                with self.data_lock:
+                    self.dirty.add(name)
+                print(f"[SERVER-{self.server_id}] {sealed} {name} selados em segmento frio")
+    
+    def channel_policy(self, channel):
+        """Política do canal (definida na criação) ou a padrão de RETENTION_CHANNELS"""
+        settings = (self.channels.get(channel) or {}).get('retention')
+        if settings:
+            try:
+                return RetentionPolicy.from_dict(settings)
+            except (TypeError, ValueError):
+                pass
+        return self.channel_retention
+    
+    def expired_on_arrival(self, data):
+        """Evento que já chega mais velho que o max_age do seu canal/conversa"""
+        if data.get('type') == 'publication':
+            policy = self.channel_policy(data.get('channel'))
+        else:
+            policy = self.message_retention
+        cutoff = policy.cutoff()
+        if cutoff is None:
+            return False
+        try:
+            return time_key(data.get('timestamp')) < cutoff
+        except ValueError:
+            return False
+    
+    def enforce_retention(self):
+        """Descarta o que as políticas de retenção não mantêm mais
+        
+        Os eventos saem do histórico (memória e segmentos), do log de
+        eventos e da árvore de Merkle; o vetor de versões continua cobrindo
+        as seqs deles, então réplicas atrasadas não os trazem de volta.
+        Retorna quantos eventos foram descartados.
+        """
+        now = datetime.now()
+        targets = [(self.messages, 'messages', [(None, self.message_retention)])]
+        targets.append((self.publications, 'publications',
+                        [(channel, self.channel_policy(channel)) for channel in self.publications.keys()]))
+        
+        total = 0
+        for store, name, policies in targets:
+            offsets = set()
+            for key, policy in policies:
+                if policy:
+                    offsets |= store.expired(policy, key, now)
+            if not offsets:
+                continue
             
-        except Exception as e:
-            print(f"[SERVER-{self.server_id}] Erro ao salvar dados: {e}")
+            removed = self.discard_history(store, name, offsets)
+            total += removed
+            print(f"[SERVER-{self.server_id}] Retenção: {removed} {name} descartados")
+        return total
+    
+    def discard_history(self, store, name, offsets):
+        """Tira eventos do histórico, do log de eventos e da árvore de Merkle
+        
+        O vetor de versões não muda: os eventos continuam vistos.
+        """
+        removed = store.remove(offsets)
+        with self.data_lock:
+            for record in removed:
+                if record.id is not None:
+                    self.merkle.remove(record.get('id'))
+            self.event_log.remove((record.origin, record.seq) for record in removed
+                                  if record.origin is not None and record.seq is not None)
+            self.dirty.add(name)
+        return len(removed)
+    
+    def drop_unowned(self):
+        """Depois de rebalance_grace, descarta os eventos das partições perdidas"""
+        if self.rebalance_at is None or time.time() < self.rebalance_at or self.pending_fetch:
+            return 0
+        self.rebalance_at = None
+        partitions = self.partitions
+        total = 0
+        for store, name in ((self.messages, 'messages'), (self.publications, 'publications')):
+            offsets = {offset for offset, record in store.scan()
+                       if not partitions.owns_event(self.server_id, record)}
+            if offsets:
+                removed = self.discard_history(store, name, offsets)
+                total += removed
+                print(f"[SERVER-{self.server_id}] Rebalanceamento: {removed} {name} de outras partições descartados")
+        return total
+    
+    def fetch_partitions(self):
+        """Copia dos outros servidores os eventos das partições ganhas
+        
+        O vetor de versões já cobre esses eventos (eram só marcados como
+        vistos), então a sincronização incremental não os traria. Se algum
+        servidor não responder, a cópia é repetida na próxima compactação.
+        """
+        partitions = sorted(self.pending_fetch)
+        adopted = 0
+        complete = True
+        for server in self.other_servers():
+            for collection in ('messages', 'publications'):
+                after = -1
+                while True:
+                    try:
+                        page = self.peer_request(server, 'partition_fetch', {
+                            'partitions': partitions,
+                            'collection': collection,
+                            'after': after,
+                            'limit': self.sync_page_size
+                        })
+                    except PeerError:
+                        complete = False
+                        break
+                    adopted += self.adopt_events(page.get('events') or [])
+                    after = page.get('last', after)
+                    if not page.get('has_more'):
+                        break
+        if complete:
+            with self.data_lock:
+                self.pending_fetch -= set(partitions)
+        print(f"[SERVER-{self.server_id}] Rebalanceamento: {len(partitions)} partições ganhas, "
+              f"{adopted} eventos copiados" + ("" if complete else " (incompleto, repetindo depois)"))
+    
+    def report_dedup(self):
+        """Memória e taxa estimada de falsos positivos da deduplicação"""
+        stats = self.seen_ids.stats()
+        origins = len(self.versions.to_dict())
+        print(f"[SERVER-{self.server_id}] Deduplicação: {origins} origens no vetor de versões, "
+              f"{stats['items']} ids em {stats['generations']} filtros ({stats['bytes']} bytes), "
+              f"falsos positivos ~{stats['false_positive_rate']:.2e}")
     
     def run(self):
         """Loop principal do servidor"""
+        if self.async_runtime:
+            self.async_runtime.run()
+            return
+        
+        if self.workers > 1:
+            self.run_worker_pool()
+            return
+        
+        # ROUTER e não REP: o backend do broker pode ser DEALER (zmq.proxy) ou
+        # ROUTER (modo smart), e REP não conversa com ROUTER
+        self.socket = self.context.socket(zmq.ROUTER)
+        self.socket.setsockopt(zmq.ROUTING_ID, self.broker_identity())
+        self.socket.connect("tcp://broker:5556")  # ✅ Conecta ao broker
         print(f"[SERVER-{self.server_id}] Aguardando requisições...")
+        self.serve_router(self.socket)
+    
+    def broker_identity(self):
+        """Identidade no backend do broker: no modo smart ele escolhe o servidor por ela"""
+        return f"server-{self.server_id}".encode()
+    
+    def run_worker_pool(self):
+        """Atende requisições com vários workers (ROUTER/DEALER interno)
         
+        O ROUTER recebe do broker e o DEALER distribui entre N threads com
+        sockets REP via inproc. O estado compartilhado é protegido por
+        data_lock.
+        """
+        frontend = self.context.socket(zmq.ROUTER)
+        frontend.setsockopt(zmq.ROUTING_ID, self.broker_identity())
+        frontend.connect("tcp://broker:5556")  # ✅ Conecta ao broker
+        
+        backend = self.context.socket(zmq.DEALER)
+        backend.bind("inproc://workers")
+        
+        for _ in range(self.workers):
+            threading.Thread(target=self.worker, daemon=True).start()
+        
+        print(f"[SERVER-{self.server_id}] Aguardando requisições com {self.workers} workers...")
+        zmq.proxy(frontend, backend)
+    
+    def worker(self):
+        sock = self.context.socket(zmq.REP)
+        sock.connect("inproc://workers")
+        self.serve(sock)
+    
+    def serve(self, sock):
+        """Recebe, processa e responde requisições em um socket REP"""
         while True:
-            try:
-                message = self.socket.recv()
-                data = msgpack.unpackb(message)
-                
-                response = self.handle_request(data)
-                
-                packed_response = msgpack.packb(response)
-                self.socket.send(packed_response)
-                
-            except Exception as e:
-                print(f"[SERVER-{self.server_id}] Erro: {e}")
-                error_response = msgpack.packb({
-                    'status': 'error',
-                    'message': str(e),
-                    'lamport_clock': self.increment_clock()
-                })
-                self.socket.send(error_response)
+            message = sock.recv()
+            sock.send(self.process_message(message))
+    
+    def serve_peers(self):
+        """Atende os outros servidores em um ROUTER na porta do servidor
+        
+        Os quadros são [identidade, id da requisição, payload]; a resposta
+        volta com o mesmo envelope para o DEALER do PeerPool de quem pediu.
+        """
+        sock = self.context.socket(zmq.ROUTER)
+        sock.bind(f"tcp://*:{self.port}")
+        self.serve_router(sock)
+    
+    def serve_router(self, sock):
+        """Atende um ROUTER: o envelope volta na resposta"""
+        while True:
+            frames = sock.recv_multipart()
+            sock.send_multipart(frames[:-1] + [self.process_message(frames[-1])])
+    
+    def process_message(self, message):
+        """Desempacota, processa e empacota a resposta de uma requisição"""
+        try:
+            data = msgpack.unpackb(message)
+            
+            response = self.handle_request(data)
+            
+            return msgpack.packb(response)
+            
+        except Exception as e:
+            print(f"[SERVER-{self.server_id}] Erro: {e}")
+            return msgpack.packb({
+                'status': 'error',
+                'message': str(e),
+                'lamport_clock': self.increment_clock()
+            })
 
 if __name__ == '__main__':
     import sys
     
     server_id = int(sys.argv[1]) if len(sys.argv) > 1 else 1
     port = int(sys.argv[2]) if len(sys.argv) > 2 else 5555
+    workers = int(sys.argv[3]) if len(sys.argv) > 3 else int(os.environ.get('SERVER_WORKERS', 1))
+    runtime = os.environ.get('SERVER_RUNTIME', 'threads')
     
-    server = Server(server_id=server_id, port=port)
+    server = Server(server_id=server_id, port=port, workers=workers, runtime=runtime)
     server.run()
\ No newline at end of file
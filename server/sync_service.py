@@ -0,0 +1,70 @@
+import threading
+import time
+
+
+class SyncRound:
+    """Uma rodada de sincronização compartilhada por vários pedidos"""
+
+    def __init__(self):
+        self.done = threading.Event()
+
+    def wait(self, timeout):
+        return self.done.wait(timeout)
+
+
+class SyncService:
+    """Sincronização com os outros servidores em uma thread própria
+
+    Os handlers nunca falam com os outros servidores diretamente: eles pedem
+    uma rodada com request() e, se precisarem do resultado, esperam por ela
+    com tempo limitado. Pedidos que chegam enquanto uma rodada está
+    pendente são agrupados nela (coalescência), então N requisições
+    simultâneas geram uma única rodada.
+    """
+
+    def __init__(self, name, sync_fn, interval=30, initial_delay=15, min_gap=1.0):
+        self.name = name
+        self.sync_fn = sync_fn
+        self.interval = interval
+        self.initial_delay = initial_delay
+        self.min_gap = min_gap
+        self.pending = None
+        self.last_run = 0.0
+        self.cond = threading.Condition()
+
+    def start(self):
+        threading.Thread(target=self._loop, daemon=True).start()
+
+    def request(self):
+        """Agenda (ou reaproveita) a próxima rodada e a retorna sem bloquear"""
+        with self.cond:
+            if self.pending is None:
+                self.pending = SyncRound()
+                self.cond.notify()
+            return self.pending
+
+    def sync_once(self, timeout):
+        """Espera a próxima rodada terminar por no máximo 'timeout' segundos"""
+        return self.request().wait(timeout)
+
+    def _loop(self):
+        time.sleep(self.initial_delay)  # Espera inicial para os servidores se conectarem
+
+        while True:
+            with self.cond:
+                deadline = self.last_run + self.interval
+                while self.pending is None and time.time() < deadline:
+                    self.cond.wait(deadline - time.time())
+                current = self.pending or SyncRound()
+                self.pending = None
+
+            try:
+                self.sync_fn()
+            except Exception as e:
+                print(f"[{self.name}] Erro na sincronização periódica: {e}", flush=True)
+            finally:
+                self.last_run = time.time()
+                current.done.set()
+
+            # Evita rodadas seguidas quando há muitos pedidos
+            time.sleep(self.min_gap)
@@ -0,0 +1,149 @@
+import bisect
+import threading
+
+from records import to_wire
+
+
+class VersionVector:
+    """Vetor de versões: para cada servidor de origem, a maior sequência
+    contígua já aplicada e as sequências recebidas fora de ordem.
+
+    As chaves são strings para que o vetor possa ir direto no msgpack.
+    """
+
+    def __init__(self):
+        self.hwm = {}      # origem -> maior seq contígua
+        self.pending = {}  # origem -> seqs acima do hwm já recebidas
+        self.lock = threading.Lock()
+
+    def seen(self, origin, seq):
+        origin = str(origin)
+        with self.lock:
+            return seq <= self.hwm.get(origin, 0) or seq in self.pending.get(origin, ())
+
+    def add(self, origin, seq):
+        """Marca (origem, seq) como aplicado; retorna False se já era conhecido"""
+        origin = str(origin)
+        with self.lock:
+            hwm = self.hwm.get(origin, 0)
+            pending = self.pending.setdefault(origin, set())
+            if seq <= hwm or seq in pending:
+                return False
+
+            pending.add(seq)
+            while hwm + 1 in pending:
+                hwm += 1
+                pending.discard(hwm)
+            self.hwm[origin] = hwm
+            return True
+
+    def gap(self, origin):
+        """Primeiro intervalo faltante de uma origem: (primeira, última) seq, ou None"""
+        origin = str(origin)
+        with self.lock:
+            pending = self.pending.get(origin)
+            if not pending:
+                return None
+            return self.hwm.get(origin, 0) + 1, min(pending) - 1
+
+    def max_seq(self, origin):
+        """Maior seq conhecida de uma origem (contígua ou não)"""
+        origin = str(origin)
+        with self.lock:
+            return max([self.hwm.get(origin, 0)] + list(self.pending.get(origin, ())))
+
+    def to_dict(self):
+        with self.lock:
+            return dict(self.hwm)
+
+    def advance(self, origin, seq):
+        """Considera aplicadas todas as seqs até 'seq' (eventos descartados na origem)"""
+        origin = str(origin)
+        with self.lock:
+            hwm = max(self.hwm.get(origin, 0), seq)
+            pending = {s for s in self.pending.get(origin, ()) if s > hwm}
+            while hwm + 1 in pending:
+                hwm += 1
+                pending.discard(hwm)
+            self.hwm[origin] = hwm
+            self.pending[origin] = pending
+
+    def to_state(self):
+        """Vetor completo (com as seqs fora de ordem) para o snapshot"""
+        with self.lock:
+            return {
+                'hwm': dict(self.hwm),
+                'pending': {origin: sorted(seqs) for origin, seqs in self.pending.items() if seqs}
+            }
+
+    @classmethod
+    def from_state(cls, state):
+        vector = cls()
+        vector.hwm = dict(state.get('hwm') or {})
+        vector.pending = {origin: set(seqs) for origin, seqs in (state.get('pending') or {}).items()}
+        return vector
+
+
+class EventLog:
+    """Eventos replicáveis agrupados por origem e ordenados por seq
+
+    Permite responder "tudo o que a origem X produziu depois da seq N"
+    com busca binária, sem percorrer o histórico.
+    """
+
+    def __init__(self):
+        self.seqs = {}    # origem -> [seq, ...] ordenado
+        self.events = {}  # origem -> [evento, ...] na mesma ordem
+        self.lock = threading.Lock()
+
+    def add(self, event, stored=None):
+        """Registra o evento; 'stored' (se dado) é o que fica guardado no lugar dele"""
+        origin = str(event['origin'])
+        seq = event['seq']
+        if stored is None:
+            stored = event
+        with self.lock:
+            seqs = self.seqs.setdefault(origin, [])
+            events = self.events.setdefault(origin, [])
+            if not seqs or seqs[-1] < seq:
+                seqs.append(seq)
+                events.append(stored)
+            else:
+                position = bisect.bisect_left(seqs, seq)
+                if position < len(seqs) and seqs[position] == seq:
+                    return
+                seqs.insert(position, seq)
+                events.insert(position, stored)
+
+    def remove(self, pairs):
+        """Tira (origem, seq) do log - eventos descartados pela retenção"""
+        by_origin = {}
+        for origin, seq in pairs:
+            by_origin.setdefault(str(origin), set()).add(seq)
+        with self.lock:
+            for origin, dead in by_origin.items():
+                if origin not in self.seqs:
+                    continue
+                kept = [(seq, event) for seq, event in zip(self.seqs[origin], self.events[origin])
+                        if seq not in dead]
+                self.seqs[origin] = [seq for seq, _ in kept]
+                self.events[origin] = [event for _, event in kept]
+
+    def clear(self):
+        with self.lock:
+            self.seqs = {}
+            self.events = {}
+
+    def since(self, vector, limit):
+        """Eventos que o vetor não cobre, até 'limit'. Retorna (eventos, has_more)"""
+        result = []
+        with self.lock:
+            for origin in sorted(self.seqs):
+                seqs = self.seqs[origin]
+                start = bisect.bisect_right(seqs, vector.get(origin, 0))
+                missing = self.events[origin][start:]
+                if len(result) + len(missing) > limit:
+                    result.extend(missing[:limit - len(result)])
+                    return [to_wire(event) for event in result], True
+                result.extend(missing)
+        return [to_wire(event) for event in result], False
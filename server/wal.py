@@ -0,0 +1,273 @@
+import os
+import struct
+import threading
+import time
+import zlib
+from collections.abc import Mapping
+
+import msgpack
+
+# Cabeçalho de cada registro: tamanho do payload + CRC32 do payload
+HEADER = struct.Struct('>II')
+
+# Durabilidade: 'sync' (fsync antes de responder), 'interval' (fsync em lote
+# a cada fsync_interval) ou 'async' (só entrega ao kernel, sem fsync)
+DURABILITY_MODES = ('sync', 'interval', 'async')
+
+
+class SnapshotState(Mapping):
+    """Estado de um snapshot com seções desserializadas sob demanda
+
+    Cada seção (usuários, canais, histórico...) é um msgpack à parte dentro
+    do arquivo; ler 'users' não custa a decodificação do histórico.
+    """
+
+    def __init__(self, sections):
+        self.sections = sections
+        self.decoded = {}
+
+    def __getitem__(self, name):
+        if name not in self.decoded:
+            self.decoded[name] = msgpack.unpackb(self.sections[name])
+        return self.decoded[name]
+
+    def __iter__(self):
+        return iter(self.sections)
+
+    def __len__(self):
+        return len(self.sections)
+
+
+class WriteAheadLog:
+    """Log append-only segmentado com fsync em lote, snapshots e compactação.
+
+    Cada registro é gravado como [tamanho][crc32][msgpack]. Os segmentos são
+    arquivos wal-XXXXXXXX.log; um snapshot marca a partir de qual segmento o
+    log precisa ser reaplicado, e os segmentos anteriores são apagados.
+
+    Quem chama append só enfileira: uma thread de escrita serializa e grava
+    os registros, então o disco fica fora do caminho das requisições. No
+    modo 'sync' append espera o fsync do lote em que o registro entrou.
+    """
+
+    def __init__(self, directory, segment_size=4 * 1024 * 1024,
+                 fsync_interval=0.05, snapshot_every=5000, durability='interval'):
+        if durability not in DURABILITY_MODES:
+            raise ValueError(f"durabilidade inválida: {durability!r} (use {', '.join(DURABILITY_MODES)})")
+        self.directory = directory
+        self.segment_size = segment_size
+        self.fsync_interval = fsync_interval
+        self.snapshot_every = snapshot_every
+        self.durability = durability
+        self.snapshot_path = os.path.join(directory, 'snapshot.msgpack')
+
+        self.lock = threading.Lock()  # arquivo do segmento atual
+        self.file = None
+        self.segment = 0
+        self.dirty = False
+        self.records_since_snapshot = 0
+
+        # Fila da thread de escrita; 'written' conta os registros já gravados
+        # (e sincronizados, no modo 'sync') na ordem em que foram enfileirados
+        self.cond = threading.Condition()
+        self.pending = []
+        self.enqueued = 0
+        self.written = 0
+
+        # Seções do último snapshot, reaproveitadas quando não mudaram
+        self.sections = {}
+
+        os.makedirs(directory, exist_ok=True)
+
+        threading.Thread(target=self._writer_loop, daemon=True).start()
+        if durability != 'sync':
+            # Thread que agrupa os fsyncs (group commit)
+            threading.Thread(target=self._fsync_loop, daemon=True).start()
+
+    def _segment_path(self, number):
+        return os.path.join(self.directory, f"wal-{number:08d}.log")
+
+    def _list_segments(self):
+        segments = []
+        for name in os.listdir(self.directory):
+            if name.startswith('wal-') and name.endswith('.log'):
+                try:
+                    segments.append(int(name[4:-4]))
+                except ValueError:
+                    continue
+        return sorted(segments)
+
+    def exists(self):
+        """Indica se há snapshot ou segmentos de log no diretório"""
+        return os.path.exists(self.snapshot_path) or bool(self._list_segments())
+
+    def load(self):
+        """Retorna (estado do último snapshot, registros do log a reaplicar)"""
+        state = None
+        first_segment = 0
+
+        if os.path.exists(self.snapshot_path):
+            with open(self.snapshot_path, 'rb') as f:
+                snapshot = msgpack.unpackb(f.read())
+            if 'sections' in snapshot:
+                self.sections = snapshot['sections']
+                state = SnapshotState(self.sections)
+            else:
+                state = snapshot.get('state')  # formato antigo: um único msgpack
+            first_segment = snapshot.get('segment', 0)
+
+        records = []
+        segments = [s for s in self._list_segments() if s >= first_segment]
+        for number in segments:
+            records.extend(self._read_segment(number))
+
+        self.records_since_snapshot = len(records)
+        self._open_segment((segments[-1] + 1) if segments else max(first_segment, 1))
+        return state, records
+
+    def _read_segment(self, number):
+        """Lê um segmento, descartando uma cauda truncada ou corrompida"""
+        path = self._segment_path(number)
+        records = []
+        valid_size = 0
+
+        with open(path, 'rb') as f:
+            data = f.read()
+
+        offset = 0
+        while offset + HEADER.size <= len(data):
+            size, crc = HEADER.unpack_from(data, offset)
+            start = offset + HEADER.size
+            payload = data[start:start + size]
+            if len(payload) < size or zlib.crc32(payload) != crc:
+                break
+            records.append(msgpack.unpackb(payload))
+            offset = start + size
+            valid_size = offset
+
+        if valid_size < len(data):
+            print(f"[WAL] Cauda inválida em {path}, truncando {len(data) - valid_size} bytes")
+            with open(path, 'r+b') as f:
+                f.truncate(valid_size)
+
+        return records
+
+    def _open_segment(self, number):
+        if self.file:
+            self.file.flush()
+            os.fsync(self.file.fileno())
+            self.file.close()
+        self.segment = number
+        self.file = open(self._segment_path(number), 'ab')
+
+    def append(self, record):
+        """Acrescenta um registro ao log (ver append_many)"""
+        self.append_many([record])
+
+    def append_many(self, records):
+        """Enfileira vários registros para uma única escrita
+
+        Os registros ficam no mesmo segmento e entram juntos no próximo
+        fsync (group commit). Só no modo 'sync' a chamada espera o disco.
+        """
+        with self.cond:
+            self.pending.extend(records)
+            self.enqueued += len(records)
+            self.records_since_snapshot += len(records)
+            ticket = self.enqueued
+            self.cond.notify_all()
+            if self.durability == 'sync':
+                while self.written < ticket:
+                    self.cond.wait()
+
+    def _writer_loop(self):
+        while True:
+            with self.cond:
+                while not self.pending:
+                    self.cond.wait()
+                records, self.pending = self.pending, []
+                ticket = self.enqueued
+
+            try:
+                self._write(records)
+            except Exception as e:
+                print(f"[WAL] Erro na escrita: {e}")
+
+            with self.cond:
+                self.written = ticket
+                self.cond.notify_all()
+
+    def _write(self, records):
+        frames = []
+        for record in records:
+            payload = msgpack.packb(record)
+            frames.append(HEADER.pack(len(payload), zlib.crc32(payload)))
+            frames.append(payload)
+        with self.lock:
+            self.file.write(b''.join(frames))
+            if self.durability == 'sync':
+                self.file.flush()
+                os.fsync(self.file.fileno())
+            else:
+                self.dirty = True
+
+            if self.file.tell() >= self.segment_size:
+                self._open_segment(self.segment + 1)
+
+    def needs_snapshot(self):
+        return self.records_since_snapshot >= self.snapshot_every
+
+    def snapshot(self, get_state):
+        """Grava um snapshot e apaga os segmentos cobertos por ele
+
+        get_state é chamado depois da troca de segmento, então todo registro
+        anterior ao novo segmento já está refletido no estado. Registros
+        gravados durante a captura são reaplicados de forma idempotente.
+        Cada chave do estado vira uma seção serializada separadamente (ver
+        SnapshotState); chaves ausentes do estado reaproveitam a seção do
+        snapshot anterior.
+        """
+        with self.lock:
+            self._open_segment(self.segment + 1)
+            first_segment = self.segment
+        with self.cond:
+            self.records_since_snapshot = 0
+
+        sections = dict(self.sections)
+        sections.update((name, msgpack.packb(value)) for name, value in get_state().items())
+        tmp_path = self.snapshot_path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(msgpack.packb({'segment': first_segment, 'sections': sections}))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.snapshot_path)
+        self.sections = sections
+
+        # Compactação: segmentos anteriores ao snapshot não são mais necessários
+        for number in self._list_segments():
+            if number < first_segment:
+                os.remove(self._segment_path(number))
+
+    def flush(self):
+        """Espera a escrita dos registros enfileirados e força o fsync"""
+        with self.cond:
+            ticket = self.enqueued
+            while self.written < ticket:
+                self.cond.wait()
+        self._sync()
+
+    def _sync(self):
+        with self.lock:
+            if self.dirty and self.file:
+                self.file.flush()
+                if self.durability == 'interval':
+                    os.fsync(self.file.fileno())
+                self.dirty = False
+
+    def _fsync_loop(self):
+        while True:
+            time.sleep(self.fsync_interval)
+            try:
+                self._sync()
+            except Exception as e:
+                print(f"[WAL] Erro no fsync: {e}")